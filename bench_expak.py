@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2013 Joel Baxter
+#
+# This file is part of expak.
+#
+# expak is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# expak is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with expak.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for expak.
+
+Run this script directly; it builds synthetic pak files in a temporary
+directory and prints timings for the operations being measured.
+"""
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import timeit
+
+import expak
+
+NUM_ENTRIES = 500000
+REPEAT = 3
+
+
+def write_synthetic_pak(pak_path, num_entries, data_len=0):
+    """Write a pak with num_entries resources of data_len bytes each."""
+    with open(pak_path, 'wb') as outstream:
+        data_off = len(expak.PAK_FILE_SIGNATURE) + (2 * expak.UNSIGNED_INT_LEN)
+        ftable_off = data_off + (num_entries * data_len)
+        ftable_len = num_entries * expak.TABLE_ENTRY_LEN
+        outstream.write(expak.PAK_FILE_SIGNATURE)
+        outstream.write(struct.pack('<II', ftable_off, ftable_len))
+        outstream.write(b"\xa5" * (num_entries * data_len))
+        for n in range(num_entries):
+            name = "synthetic/dir_{0}/res_{1}.dat".format(n % 97, n)
+            outstream.write(expak.TABLE_ENTRY.pack(
+                name.encode('latin-1'), data_off + (n * data_len), data_len))
+
+def legacy_read_filetable(instream, header, targets):
+    """The per-entry parser that read_filetable used before version 1.2."""
+    target_info = []
+    if targets or targets is None:
+        (ftable_off, num_files) = header
+        instream.seek(ftable_off)
+        for f in range(num_files):
+            file_name = instream.read(expak.RESOURCE_NAME_LEN)
+            if len(file_name) != expak.RESOURCE_NAME_LEN:
+                raise IOError(2, "unexpected EOF reading resource name")
+            file_name = file_name.partition(b"\0")[0]
+            file_off = expak.read_uint(instream)
+            file_len = expak.read_uint(instream)
+            if targets and file_name not in targets:
+                continue
+            target_info.append((file_name, file_off, file_len))
+    return target_info
+
+def time_parser(pak_path, parser):
+    def run():
+        with open(pak_path, 'rb') as instream:
+            header = expak.read_header(instream)
+            parser(instream, header, None)
+    return min(timeit.repeat(run, number=1, repeat=REPEAT))
+
+def bench_filetable(work_dir):
+    pak_path = os.path.join(work_dir, "table.pak")
+    write_synthetic_pak(pak_path, NUM_ENTRIES)
+    legacy = time_parser(pak_path, legacy_read_filetable)
+    current = time_parser(pak_path, expak.read_filetable)
+    print("file table parse, {0} entries:".format(NUM_ENTRIES))
+    print("    per-entry reads: {0:.3f}s".format(legacy))
+    print("    bulk read:       {0:.3f}s ({1:.1f}x)".format(
+        current, legacy / current))
+
+def bench_index_cache(work_dir):
+    pak_path = os.path.join(work_dir, "cached.pak")
+    write_synthetic_pak(pak_path, NUM_ENTRIES)
+    def run():
+        expak.resource_names(pak_path)
+    uncached = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    expak.index_cache_dir = work_dir
+    try:
+        run()
+        cached = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    finally:
+        expak.index_cache_dir = None
+    print("resource_names, {0} entries:".format(NUM_ENTRIES))
+    print("    table parse:     {0:.3f}s".format(uncached))
+    print("    index cache:     {0:.3f}s ({1:.1f}x)".format(
+        cached, uncached / cached))
+
+def bench_coalesce(work_dir):
+    num_entries = NUM_ENTRIES // 10
+    pak_path = os.path.join(work_dir, "small.pak")
+    write_synthetic_pak(pak_path, num_entries, data_len=64)
+    def converter(orig_data, name):
+        return True
+    def run():
+        expak.process_resources(pak_path, converter)
+    coalesced = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    saved_span = expak.coalesce_span
+    expak.coalesce_span = 0
+    try:
+        separate = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    finally:
+        expak.coalesce_span = saved_span
+    print("process_resources, {0} x 64-byte resources:".format(num_entries))
+    print("    separate reads:  {0:.3f}s".format(separate))
+    print("    coalesced reads: {0:.3f}s ({1:.1f}x)".format(
+        coalesced, separate / coalesced))
+
+def bench_create(work_dir):
+    num_files = 2000
+    src_dir = os.path.join(work_dir, "create_src")
+    for n in range(num_files):
+        sub_dir = os.path.join(src_dir, "dir_{0}".format(n % 20))
+        if not os.path.isdir(sub_dir):
+            os.makedirs(sub_dir)
+        with open(os.path.join(sub_dir, "res_{0}.dat".format(n)), 'wb') as f:
+            f.write(b"\x5a" * 65536)
+    pak_path = os.path.join(work_dir, "created.pak")
+    def run(workers):
+        return lambda: expak.create_pak(pak_path, src_dir, workers=workers)
+    saved_zero_copy = expak.zero_copy
+    expak.zero_copy = False
+    try:
+        buffered = min(timeit.repeat(run(None), number=1, repeat=REPEAT))
+    finally:
+        expak.zero_copy = saved_zero_copy
+    kernel = min(timeit.repeat(run(None), number=1, repeat=REPEAT))
+    threaded = min(timeit.repeat(run(4), number=1, repeat=REPEAT))
+    print("create_pak, {0} x 64 KiB files:".format(num_files))
+    print("    buffered copy:   {0:.3f}s".format(buffered))
+    print("    kernel copy:     {0:.3f}s ({1:.1f}x)".format(
+        kernel, buffered / kernel))
+    print("    4 open threads:  {0:.3f}s ({1:.1f}x)".format(
+        threaded, buffered / threaded))
+
+def bench_resource_cache(work_dir):
+    num_entries = 500
+    pak_path = os.path.join(work_dir, "served.pak")
+    write_synthetic_pak(pak_path, num_entries, data_len=16384)
+    with expak.PakArchive(pak_path) as pak:
+        names = sorted(pak.names())
+        def run():
+            for n in range(20):
+                for name in names:
+                    pak.read(name)
+        uncached = min(timeit.repeat(run, number=1, repeat=REPEAT))
+        expak.resource_cache = expak.ResourceCache(16 * 1024 * 1024)
+        try:
+            cached = min(timeit.repeat(run, number=1, repeat=REPEAT))
+        finally:
+            expak.resource_cache = None
+    print("PakArchive.read, 20 x {0} x 16 KiB resources:".format(num_entries))
+    print("    disk reads:      {0:.3f}s".format(uncached))
+    print("    resource cache:  {0:.3f}s ({1:.1f}x)".format(
+        cached, uncached / cached))
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix="expak_bench_")
+    try:
+        bench_filetable(work_dir)
+        bench_index_cache(work_dir)
+        bench_coalesce(work_dir)
+        bench_create(work_dir)
+        bench_resource_cache(work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
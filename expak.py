@@ -24,12 +24,29 @@ module enable programmatic extraction and (optional) processing of resources
 from one or more pak files.
 
 The :func:`resource_names` function retrieves a set of all the resource names
-in one or more pak files.
+in one or more pak files, and :func:`iter_entries` generates the name, size,
+and location of each resource without collecting them.
+
+The :func:`create_pak` function writes a new pak file from a set of files.
+
+The :class:`PakArchive` class keeps a single pak file open, so that programs
+which access its resources many times don't have to re-read its file table
+for each access.
 
 All of these functions have a ``sources`` parameter which can accept either a
 string specifying the filepath of a single pak file to process, or an iterable
 container of strings specifying multiple pak files to process.
 
+Programs built on :mod:`asyncio` can use :func:`aprocess_resources` and
+:func:`aiter_resources`, which read pak files without blocking the event loop
+and accept coroutine functions as converters.
+
+Programs that repeatedly read the same large pak files can set
+:data:`index_cache_dir` so that each file table is only parsed once.
+
+The :class:`PakServer` class serves the resources of pak files over HTTP from
+an :mod:`asyncio` event loop.
+
 Resource selection (using a set of names or a name map) and processing (with a
 user-provided function hook) is described in more detail in the documentation
 for each function.
@@ -195,8 +212,29 @@ This procedure also requires the qbsp utility.
 __all__ = ['process_resources',
            'extract_resources',
            'resource_names',
+           'iter_entries',
+           'create_pak',
+           'update_pak',
+           'compact_pak',
+           'trace_converter',
+           'diff_paks',
+           'PakDiff',
+           'verify_pak',
+           'write_digest_manifest',
+           'aprocess_resources',
+           'aiter_resources',
+           'PakArchive',
+           'PakServer',
+           'ResourceEntry',
+           'ResourceReader',
+           'ResourceCache',
            'nop_converter',
-           'print_err']
+           'print_err',
+           'zero_copy',
+           'resource_cache',
+           'index_cache_dir',
+           'coalesce_gap',
+           'coalesce_span']
 
 __version__ = "1.1.1"
 
@@ -205,6 +243,49 @@ import struct
 import sys
 import os
 import errno
+import hashlib
+import json
+import tempfile
+import threading
+import collections
+import weakref
+import mmap
+import io
+import contextlib
+import shutil
+import bisect
+import binascii
+import fnmatch
+import re
+import mimetypes
+import email.utils
+
+try:
+    from urllib.parse import unquote_to_bytes
+except ImportError:
+    # Python 2's unquote works on byte strings already.
+    from urllib import unquote as unquote_to_bytes
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows; file clones are then never attempted.
+    fcntl = None
+
+try:
+    import asyncio
+except ImportError:
+    # Python versions before 3.4 have no asyncio module, so the asynchronous
+    # functions aprocess_resources and aiter_resources are unavailable.
+    asyncio = None
+
+try:
+    import concurrent.futures as futures
+except ImportError:
+    # Python versions before 3.2 have no concurrent.futures module, unless the
+    # "futures" backport is installed. Without it the workers option of
+    # process_resources is ignored.
+    futures = None
 
 # Adapter for string type differences between Python 2 & 3.
 try:
@@ -215,16 +296,157 @@ except NameError:
     def is_string(candidate):
         return isinstance(candidate, str)
 
+# 2.6 COMPAT: no memoryview, so slices of buffers are copies instead.
+try:
+    memoryview
+    HAVE_MEMORYVIEW = True
+except NameError:
+    HAVE_MEMORYVIEW = False
+
+def buffer_view(buf):
+    """Return a memoryview of a bytearray, or the bytearray on Python 2.6.
+
+    :param buf: buffer to view
+    :type buf:  bytearray
+
+    :returns: object whose slices can be written or hashed
+    :rtype:   memoryview or bytearray
+
+    """
+    if HAVE_MEMORYVIEW:
+        return memoryview(buf)
+    return buf
+
+# Adapter for file path encoding differences between Python 2 & 3. Python 3
+# paths may hold undecodable bytes as surrogate escapes, which only
+# os.fsencode can turn back into bytes.
+try:
+    path_bytes = os.fsencode
+except AttributeError:
+    def path_bytes(path):
+        if isinstance(path, bytes):
+            return path
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
 PAK_FILE_SIGNATURE = b"PACK"
 RESOURCE_NAME_LEN = 56
 UNSIGNED_INT_LEN = 4
 TABLE_ENTRY_LEN = RESOURCE_NAME_LEN + (2 * UNSIGNED_INT_LEN)
+PAK_HEADER_LEN = len(PAK_FILE_SIGNATURE) + (2 * UNSIGNED_INT_LEN)
+
+# Offsets and lengths in a pak file are unsigned 32-bit values, so no
+# resource content or file table can extend past this size.
+MAX_PAK_SIZE = 0xFFFFFFFF
+
+# Precompiled layout of one file table entry: null-padded name, then the
+# little-endian offset and length of the resource data.
+TABLE_ENTRY = struct.Struct("<{0}sII".format(RESOURCE_NAME_LEN))
+
+# Size of the buffer used when copying resource content from a stream.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+#: Description of a resource in a pak file: its name, the offset and length of
+#: its content within the pak file, and the file path of the pak file.
+ResourceEntry = collections.namedtuple("ResourceEntry",
+                                       "name offset length source")
+
+#: Result of :func:`diff_paks`: sorted lists of the names of resources only in
+#: the new pak file, only in the old pak file, with different content, and
+#: with the same content.
+PakDiff = collections.namedtuple("PakDiff",
+                                 "added removed modified unchanged")
 
 #: Boolean flag that may be changed to disable or enable stderr messages; True
 #: by default. Such messages are printed when exceptions are encountered that
 #: prevent reading a pak file or processing a resource.
 print_err = True
 
+#: Directory used to cache parsed pak file tables, or None to disable caching;
+#: None by default. When set, the table of each pak file read is saved in a
+#: compact index file in this directory, and later reads of the same unchanged
+#: pak file will use that index instead of parsing the table again. A pak file
+#: is considered unchanged if its path, size, modification time, and inode
+#: number all match the values recorded in the index.
+index_cache_dir = None
+
+#: Largest gap, in bytes, between the content of two selected resources that
+#: will still be fetched with a single read; 4096 by default. Unselected bytes
+#: in such gaps are read and discarded. Combining reads this way greatly
+#: reduces the number of system calls for pak files containing many small
+#: resources; each resource's content is still copied out of the combined
+#: buffer into its own bytes object for the converter. Set to 0 to only
+#: combine exactly adjacent resources.
+coalesce_gap = 4096
+
+#: Largest number of bytes fetched by a single combined read; 1 MiB by
+#: default. Set to 0 to read each resource separately. A single resource
+#: larger than this is still read in one piece.
+coalesce_span = 1024 * 1024
+
+#: Boolean flag that may be changed to disable or enable copying resource
+#: content within the kernel; True by default. When set, and the platform
+#: provides copy_file_range or sendfile (as Linux does), extracted resources
+#: are copied straight from the pak file to the output file without passing
+#: through Python. Memory-mapped and process-pool extraction always use
+#: ordinary reads and writes.
+zero_copy = True
+
+#: :class:`ResourceCache` that keeps recently read resource content in memory,
+#: or None to disable caching; None by default. When set, resources read as
+#: bytes objects (not in streaming, memory-mapped, or process-pool mode) by
+#: :func:`process_resources` and its relatives, or by :meth:`PakArchive.read`,
+#: are looked up in the cache first and added to it after being read.
+resource_cache = None
+
+# Characters that begin the wildcard part of a glob pattern.
+GLOB_SPECIAL = re.compile(r"[*?[]")
+
+# Linux ioctl request that clones a file's content with copy-on-write.
+FICLONE = 0x40049409
+
+# Error codes meaning that a kernel copy function can't be used for the given
+# files, or at all, rather than that the copy failed.
+KERNEL_COPY_UNSUPPORTED = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                               getattr(errno, 'ENOTSUP', errno.EINVAL)])
+
+# Identifying prefix, version, and fixed-size header layout of index files
+# stored in the index_cache_dir: pak size, mtime (ns), device and inode
+# numbers, then the pak's file table offset and number of entries, then the
+# lengths of the pak path and of the names blob that follow.
+INDEX_FILE_SIGNATURE = b"EXPAKIDX"
+INDEX_FILE_VERSION = 1
+INDEX_HEADER = struct.Struct("<8sIQqQQIIII")
+
+# Name of the manifest file kept in the output directory by incremental
+# extraction, and the version of its JSON layout.
+MANIFEST_FILE_NAME = ".expak_manifest"
+MANIFEST_VERSION = 1
+
+# Version of the JSON layout of resource digest files stored in the
+# index_cache_dir.
+DIGEST_CACHE_VERSION = 1
+
+# Version of the JSON layout of digest manifests written by
+# write_digest_manifest.
+DIGEST_MANIFEST_VERSION = 1
+
+# How often, in seconds, a worker thread waiting for an AsyncResourceIterator
+# to take a resource checks whether the iterator has been abandoned.
+HANDOFF_POLL_INTERVAL = 0.5
+
+# Largest HTTP request head accepted by PakServer, and the size of the chunks
+# it sends resource content in when it can't use sendfile.
+MAX_REQUEST_HEAD = 16384
+SERVE_CHUNK_SIZE = 65536
+
+# Reason phrases for the HTTP status codes sent by PakServer.
+HTTP_REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified",
+                400: "Bad Request", 404: "Not Found",
+                405: "Method Not Allowed", 412: "Precondition Failed",
+                416: "Range Not Satisfiable", 431:
+                "Request Header Fields Too Large"}
+
 
 def read_uint(instream):
     """Read an unsigned int from a binary file object.
@@ -244,6 +466,28 @@ def read_uint(instream):
         raise IOError(2, "unexpected EOF reading integer")
     return struct.unpack('I', packed)[0]
 
+def iter_table_entries(ftable):
+    """Decode raw file table content into a sequence of entry tuples.
+
+    Interpret ``ftable`` as consecutive :const:`TABLE_ENTRY_LEN`-byte file
+    table entries, and iterate over the (name, offset, length) tuples decoded
+    from them. The names are returned as-is, including any null padding.
+
+    :param ftable: raw file table content; its length must be a multiple of
+                   :const:`TABLE_ENTRY_LEN`
+    :type ftable:  bytes
+
+    :returns: iterator over (name, offset, length) tuples
+    :rtype:   iterator(tuple(bytes,int,int))
+
+    """
+    try:
+        return TABLE_ENTRY.iter_unpack(ftable)
+    except AttributeError:
+        # Python versions before 3.4 don't have iter_unpack.
+        return (TABLE_ENTRY.unpack_from(ftable, pos)
+                for pos in range(0, len(ftable), TABLE_ENTRY_LEN))
+
 def read_header(instream):
     """Read pak header info from a binary file object.
 
@@ -274,11 +518,12 @@ def read_header(instream):
 def read_filetable(instream, header, targets):
     """Given the header info, extract info on resources contained in a pak file.
 
-    Seek to the pak file table position in the file. Iterate over the file table
-    and generate a list of (name, offset, length) tuples for some number of the
-    resources in the table. If the ``targets`` argument is None, all discovered
-    resources will be included in the list; otherwise the list will be limited
-    to resources whose names are in ``targets``.
+    Seek to the pak file table position in the file and read the entire table
+    in one operation. Decode the table and generate a list of (name, offset,
+    length) tuples for some number of the resources in the table. If the
+    ``targets`` argument is None, all discovered resources will be included in
+    the list; otherwise the list will be limited to resources whose names are
+    in ``targets``.
 
     :param instream: binary file object to read from
     :type instream:  file
@@ -297,31 +542,498 @@ def read_filetable(instream, header, targets):
     if targets or targets is None:
         (ftable_off, num_files) = header
         instream.seek(ftable_off)
-        for f in range(num_files):
-            file_name = instream.read(RESOURCE_NAME_LEN)
-            if len(file_name) != RESOURCE_NAME_LEN:
-                raise IOError(2, "unexpected EOF reading resource name")
+        ftable_len = num_files * TABLE_ENTRY_LEN
+        ftable = instream.read(ftable_len)
+        if len(ftable) != ftable_len:
+            raise IOError(2, "unexpected EOF reading file table")
+        for (file_name, file_off, file_len) in iter_table_entries(ftable):
             # Terminate the name at the first encountered null character.
             file_name = file_name.partition(b"\0")[0]
-            file_off = read_uint(instream)
-            file_len = read_uint(instream)
             if targets and file_name not in targets:
                 continue
             target = (file_name, file_off, file_len)
             target_info.append(target)
     return target_info
 
-def get_target_info(instream, targets):
+def stream_filetable(instream, header):
+    """Given the header info, generate the entries of a pak file's table.
+
+    Like :func:`read_filetable` with no ``targets``, except that the table is
+    read in chunks of about :const:`COPY_CHUNK_SIZE` bytes, and the
+    (name, offset, length) tuples are generated as each chunk is decoded.
+    Memory use therefore doesn't depend on the size of the table. An IOError
+    is raised if the file ends before the end of the table.
+
+    :param instream: binary file object to read from
+    :type instream:  file
+    :param header:   pak header info, containing the file table offset and
+                     number of entries
+    :type header:    tuple(int,int)
+
+    :returns: generator of (name, offset, length) tuples for all resources
+    :rtype:   generator(tuple(bytes,int,int))
+
+    """
+    (ftable_off, remaining) = header
+    chunk_entries = max(1, COPY_CHUNK_SIZE // TABLE_ENTRY_LEN)
+    pos = ftable_off
+    while remaining:
+        count = min(chunk_entries, remaining)
+        chunk_len = count * TABLE_ENTRY_LEN
+        # Seek before each chunk, in case the caller used the file meanwhile.
+        instream.seek(pos)
+        chunk = instream.read(chunk_len)
+        if len(chunk) != chunk_len:
+            raise IOError(2, "unexpected EOF reading file table")
+        for (file_name, file_off, file_len) in iter_table_entries(chunk):
+            yield (file_name.partition(b"\0")[0], file_off, file_len)
+        pos += chunk_len
+        remaining -= count
+
+def select_entries(table, targets):
+    """Filter a list of file table entries by resource name.
+
+    Return the entries of ``table`` selected according to ``targets`` in the
+    same way as :func:`read_filetable` would select them.
+
+    :param table:   list of (name, offset, length) tuples for all resources
+    :type table:    list(tuple(bytes,int,int))
+    :param targets: resource names to limit resource selection, or None to
+                    indicate that all resources should be selected
+    :type targets:  container(bytes) or None
+
+    :returns: list of (name, offset, length) tuples for selected resources
+    :rtype:   list(tuple(bytes,int,int))
+
+    """
+    if targets is None:
+        return table
+    return [t for t in table if t[0] in targets]
+
+class NameIndex(object):
+    """Prefix index over the resource names of a pak file.
+
+    The names are kept sorted, which lays them out in the same order as a
+    depth-first walk of a trie: all names sharing a prefix form one
+    contiguous run, found by binary search. A prefix or glob query therefore
+    only examines the names under the pattern's literal prefix, instead of
+    every name in the table.
+
+    :param names: resource names
+    :type names:  iterable(bytes)
+
+    """
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+
+    def prefix_range(self, prefix, start=0, end=None):
+        """Return the index range of the names that start with a prefix.
+
+        :param prefix: leading part of the names to find
+        :type prefix:  bytes
+        :param start:  index to start searching at
+        :type start:   int
+        :param end:    index to stop searching at, or None for the end
+        :type end:     int or None
+
+        :returns: start and end indices in the ``names`` attribute
+        :rtype:   tuple(int,int)
+
+        """
+        if end is None:
+            end = len(self.names)
+        start = bisect.bisect_left(self.names, prefix, start, end)
+        # The smallest string greater than every string with this prefix.
+        upper = prefix.rstrip(b"\xff")
+        if upper:
+            upper = upper[:-1] + struct.pack("B", bytearray(upper)[-1] + 1)
+            end = bisect.bisect_left(self.names, upper, start, end)
+        return (start, end)
+
+    def with_prefix(self, prefix):
+        """Return the names that start with a prefix.
+
+        :param prefix: leading part of the names to find
+        :type prefix:  bytes
+
+        :returns: matching names, in sorted order
+        :rtype:   list(bytes)
+
+        """
+        (start, end) = self.prefix_range(prefix)
+        return self.names[start:end]
+
+    def children(self, prefix):
+        """Return the entries directly inside a directory.
+
+        Treating "/" as the path separator, find the directory names and the
+        resource names that immediately follow ``prefix``. Each subdirectory
+        is skipped over with a binary search, so the cost depends on the
+        number of entries listed rather than the number of resources below
+        the directory.
+
+        :param prefix: path of the directory followed by "/", or empty for
+                       the top level
+        :type prefix:  bytes
+
+        :returns: subdirectory names and resource names, each in sorted order,
+                  or None if there is no such directory
+        :rtype:   tuple(list(bytes),list(bytes)) or None
+
+        """
+        (index, end) = self.prefix_range(prefix)
+        if index == end and prefix:
+            return None
+        prefix_len = len(prefix)
+        (dirs, files) = ([], [])
+        while index < end:
+            rest = self.names[index][prefix_len:]
+            slash = rest.find(b"/")
+            if slash < 0:
+                files.append(rest)
+                index += 1
+            else:
+                dir_prefix = prefix + rest[:slash + 1]
+                dirs.append(rest[:slash])
+                index = self.prefix_range(dir_prefix, index, end)[1]
+        return (dirs, files)
+
+    def match(self, pattern):
+        """Return the names that match a pattern.
+
+        :param pattern: glob pattern, in the syntax of the :mod:`fnmatch`
+                        module, or a compiled regular expression
+        :type pattern:  str or regular expression object
+
+        :returns: matching names, in sorted order
+        :rtype:   list(bytes)
+
+        """
+        if not is_string(pattern):
+            if isinstance(pattern.pattern, bytes):
+                return [n for n in self.names if pattern.match(n)]
+            return [n for n in self.names
+                    if pattern.match(n.decode('latin-1'))]
+        prefix = encode_name(GLOB_SPECIAL.split(pattern, 1)[0])
+        candidates = self.with_prefix(prefix)
+        rest = pattern[len(prefix):]
+        if not rest:
+            return [n for n in candidates if n == prefix]
+        if rest == "*":
+            return candidates
+        regex = re.compile(encode_name(fnmatch.translate(pattern)))
+        return [n for n in candidates if regex.match(n)]
+
+class PatternSelector(object):
+    """Selection of resources by name patterns, shared across pak files.
+
+    Used by :func:`process_resources` for its ``patterns`` argument. For each
+    pak file, :meth:`expand` adds the names matching any of the patterns to
+    the encoded targets dict. Each name is only added once, so a matching
+    resource is handled like a name given in ``targets``: once processed
+    from one pak file, it is not selected again from later ones.
+
+    The patterns are compiled once. Each call is a linear scan of the file
+    table: every name is checked against every pattern, though a glob
+    pattern's regular expression is only tried on names that start with its
+    literal leading part (the part before any wildcard). Unlike
+    :meth:`PakArchive.match`, no sorted index is built, since each table is
+    only expanded once.
+
+    :param patterns: glob patterns or compiled regular expressions
+    :type patterns:  iterable(str or regular expression object)
+
+    """
+
+    def __init__(self, patterns):
+        if is_string(patterns):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        self.expanded = set()
+        self.lock = threading.Lock()
+        # Literal prefix, regular expression, and whether it matches decoded
+        # names, for each pattern.
+        self.matchers = []
+        for pattern in self.patterns:
+            if is_string(pattern):
+                prefix = encode_name(GLOB_SPECIAL.split(pattern, 1)[0])
+                regex = re.compile(encode_name(fnmatch.translate(pattern)))
+                self.matchers.append((prefix, regex, False))
+            else:
+                self.matchers.append((b"", pattern,
+                                      not isinstance(pattern.pattern, bytes)))
+        self.matched = [False] * len(self.patterns)
+
+    def expand(self, table, targets):
+        """Add the names in a file table that match the patterns to targets.
+
+        :param table:   list of (name, offset, length) tuples for all
+                        resources in a pak file
+        :type table:    list(tuple(bytes,int,int))
+        :param targets: resources to select, as converted by
+                        :func:`encode_targets`; contents are modified
+        :type targets:  dict(bytes,(str,str))
+
+        """
+        matches = []
+        matched = set()
+        for target in table:
+            file_name = target[0]
+            selected = False
+            for (index, (prefix, regex, decode)) in enumerate(self.matchers):
+                if not file_name.startswith(prefix):
+                    continue
+                if decode:
+                    found = regex.match(file_name.decode('latin-1'))
+                else:
+                    found = regex.match(file_name)
+                if found:
+                    matched.add(index)
+                    selected = True
+            if selected:
+                matches.append(file_name)
+        with self.lock:
+            for index in matched:
+                self.matched[index] = True
+            for file_name in matches:
+                if file_name in self.expanded:
+                    continue
+                self.expanded.add(file_name)
+                if file_name not in targets:
+                    name = file_name.decode('latin-1')
+                    targets[file_name] = (name, name)
+
+    def unmatched(self):
+        """Return the patterns that have not matched any name so far.
+
+        :returns: patterns, in the order given
+        :rtype:   list(str or regular expression object)
+
+        """
+        with self.lock:
+            return [p for (p, m) in zip(self.patterns, self.matched) if not m]
+
+def pak_identity(instream):
+    """Return values that identify the current state of an open file.
+
+    The result is a tuple of the file's size, modification time in
+    nanoseconds, device number, and inode number. If any of those change, the
+    file content may have changed.
+
+    :param instream: binary file object to examine
+    :type instream:  file
+
+    :returns: tuple of size, mtime, device, and inode
+    :rtype:   tuple(int,int,int,int)
+
+    """
+    return stat_identity(os.fstat(instream.fileno()))
+
+def stat_identity(st):
+    """Return the identifying values of a file, as for :func:`pak_identity`.
+
+    :param st: result of os.stat or os.fstat for the file
+    :type st:  os.stat_result
+
+    :returns: tuple of size, mtime, device, and inode
+    :rtype:   tuple(int,int,int,int)
+
+    """
+    try:
+        mtime = st.st_mtime_ns
+    except AttributeError:
+        # Python versions before 3.3 only have float timestamps.
+        mtime = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime, st.st_dev, st.st_ino)
+
+def index_cache_path(pak_path, suffix=".idx"):
+    """Return the path of the index file for a pak file in the index cache.
+
+    :param pak_path: file path of the pak file
+    :type pak_path:  str
+    :param suffix:   file name suffix, for other kinds of cached data about
+                     the pak file
+    :type suffix:    str
+
+    :returns: path of the index file inside :data:`index_cache_dir`
+    :rtype:   str
+
+    """
+    key = path_bytes(os.path.abspath(pak_path))
+    return os.path.join(index_cache_dir,
+                        hashlib.sha1(key).hexdigest() + suffix)
+
+def load_index_cache(instream, header):
+    """Read the cached file table for a pak file, if it is still valid.
+
+    Look up the index file for ``instream`` in :data:`index_cache_dir`. If it
+    exists and was recorded from a pak file with the same path, identity (see
+    :func:`pak_identity`), and header info as ``instream``, return the cached
+    list of (name, offset, length) tuples for all resources. Otherwise return
+    None.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+    :param header:   pak header info, containing the file table offset and
+                     number of entries
+    :type header:    tuple(int,int)
+
+    :returns: list of (name, offset, length) tuples for all resources, or None
+    :rtype:   list(tuple(bytes,int,int)) or None
+
+    """
+    pak_path = path_bytes(os.path.abspath(instream.name))
+    try:
+        with open(index_cache_path(instream.name), 'rb') as cachestream:
+            index = cachestream.read()
+    except (IOError, OSError):
+        return None
+    if len(index) < INDEX_HEADER.size:
+        return None
+    fields = INDEX_HEADER.unpack_from(index)
+    (signature, version) = fields[:2]
+    if signature != INDEX_FILE_SIGNATURE or version != INDEX_FILE_VERSION:
+        return None
+    if fields[2:6] != pak_identity(instream) or fields[6:8] != header:
+        return None
+    (num_files, path_len, blob_len) = (fields[7], fields[8], fields[9])
+    pos = INDEX_HEADER.size
+    if index[pos:pos + path_len] != pak_path:
+        return None
+    pos += path_len
+    if len(index) != pos + blob_len + (2 * num_files * UNSIGNED_INT_LEN):
+        return None
+    if not num_files:
+        return []
+    names = index[pos:pos + blob_len].split(b"\0")
+    pos += blob_len
+    uints = struct.unpack_from("<{0}I".format(2 * num_files), index, pos)
+    return list(zip(names, uints[:num_files], uints[num_files:]))
+
+def save_index_cache(instream, header, table):
+    """Store the file table for a pak file in the index cache.
+
+    Write an index file for ``instream`` into :data:`index_cache_dir`,
+    recording the pak file's path, identity, header info, and the complete
+    list of (name, offset, length) tuples from its file table. The file is
+    written under a temporary name and then moved into place, so concurrent
+    readers never see a partial index. Failure to write the index is not an
+    error; the pak file will just be parsed again next time.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+    :param header:   pak header info, containing the file table offset and
+                     number of entries
+    :type header:    tuple(int,int)
+    :param table:    list of (name, offset, length) tuples for all resources
+    :type table:     list(tuple(bytes,int,int))
+
+    """
+    pak_path = path_bytes(os.path.abspath(instream.name))
+    names = b"\0".join([t[0] for t in table])
+    num_files = len(table)
+    fields = ((INDEX_FILE_SIGNATURE, INDEX_FILE_VERSION) +
+              pak_identity(instream) + tuple(header) +
+              (len(pak_path), len(names)))
+    uints = [t[1] for t in table] + [t[2] for t in table]
+    index = b"".join([INDEX_HEADER.pack(*fields), pak_path, names,
+                      struct.pack("<{0}I".format(2 * num_files), *uints)])
+    try:
+        (fd, temp_path) = tempfile.mkstemp(dir=index_cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as cachestream:
+                cachestream.write(index)
+            replace_file(temp_path, index_cache_path(instream.name))
+        except:
+            os.remove(temp_path)
+            raise
+    except (IOError, OSError):
+        pass
+
+def replace_file(src, dst):
+    """Rename a file, replacing any existing file at the destination.
+
+    :param src: path of the file to rename
+    :type src:  str
+    :param dst: new path for the file
+    :type dst:  str
+
+    """
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Python versions before 3.3 don't have os.replace; os.rename will
+        # replace an existing file on all platforms except Windows.
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+def create_temp_file(path, suffix=""):
+    """Create a temporary file to be moved into place as a given file.
+
+    The file is created in the same directory as ``path``. Unlike a file
+    from :func:`tempfile.mkstemp`, which only its owner can read, it gets the
+    permissions of the existing file at ``path``, or if there is none, the
+    permissions a newly created file would get (0666 less the umask).
+
+    :param path:   file path that the temporary file will be moved to
+    :type path:    str
+    :param suffix: file name suffix for the temporary file
+    :type suffix:  str
+
+    :returns: open file descriptor and path of the temporary file
+    :rtype:   tuple(int,str)
+
+    """
+    out_dir = os.path.dirname(os.path.abspath(path))
+    flags = os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        temp_name = "tmp{0}{1}".format(
+            binascii.hexlify(os.urandom(6)).decode(), suffix)
+        temp_path = os.path.join(out_dir, temp_name)
+        try:
+            fd = os.open(temp_path, flags, 0o666)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except OSError:
+        return (fd, temp_path)
+    try:
+        os.chmod(temp_path, mode)
+    except:
+        os.close(fd)
+        os.remove(temp_path)
+        raise
+    return (fd, temp_path)
+
+def get_target_info(instream, targets, selector=None):
     """Extract info on resources contained in a pak file.
 
     Read the pak header information from the file. If that succeeds, return the
     result of :func:`read_filetable`; otherwise return None.
 
+    If ``selector`` is supplied, the complete file table is read, and the
+    names in it that match the selector's patterns are added to ``targets``
+    before resources are selected.
+
+    If :data:`index_cache_dir` is set, the complete file table is instead taken
+    from the index cache when a valid index exists for this pak file, or else
+    read with :func:`read_filetable` and stored in the index cache. Either way
+    the resources are then selected according to ``targets``.
+
     :param instream: binary file object to read from
     :type instream:  file
     :param targets:  resource names to limit resource selection, or None to
                      indicate that all resources should be selected
     :type targets:   container(bytes) or None
+    :param selector: patterns of further resource names to select, or None;
+                     if supplied, ``targets`` must be a dict and may be
+                     modified
+    :type selector:  PatternSelector or None
 
     :returns: list of (name, offset, length) tuples for selected resources if
               the given file is a pak file, None otherwise
@@ -331,7 +1043,39 @@ def get_target_info(instream, targets):
     header = read_header(instream)
     if header is None:
         return None
-    return read_filetable(instream, header, targets)
+    use_cache = (index_cache_dir is not None and
+                 is_string(getattr(instream, 'name', None)))
+    if selector is None:
+        if not use_cache:
+            return read_filetable(instream, header, targets)
+        if targets is not None and not targets:
+            return []
+    table = None
+    if use_cache:
+        table = load_index_cache(instream, header)
+    if table is None:
+        table = read_filetable(instream, header, None)
+        if use_cache:
+            save_index_cache(instream, header, table)
+    if selector is not None:
+        selector.expand(table, targets)
+    return select_entries(table, targets)
+
+def encode_name(name):
+    """Return a resource name as a bytestring.
+
+    :param name: resource name
+    :type name:  str or bytes
+
+    :returns: the name encoded as a bytestring
+    :rtype:   bytes
+
+    """
+    try:
+        return name.encode('latin-1')
+    except AttributeError:
+        # Eh, probably already bytes.
+        return name
 
 def encode_targets(targets):
     """Process the targets input to encode resource names as bytestrings.
@@ -350,18 +1094,12 @@ def encode_targets(targets):
     """
     if targets is None:
         return None
-    def tobytes(in_string):
-        try:
-            return in_string.encode('latin-1')
-        except AttributeError:
-            # Eh, probably already bytes.
-            return in_string
     if isinstance(targets, dict):
         # 2.6 COMPAT: "dict comprehension" syntax
-        return dict([(tobytes(n), (n, targets[n])) for n in targets])
+        return dict([(encode_name(n), (n, targets[n])) for n in targets])
     else:
         # 2.6 COMPAT: "dict comprehension" syntax
-        return dict([(tobytes(n), (n, n)) for n in targets])
+        return dict([(encode_name(n), (n, n)) for n in targets])
 
 def update_targets(targets, enc_targets):
     """Update the input targets to reflect internal targets state.
@@ -387,253 +1125,4501 @@ def update_targets(targets, enc_targets):
     targets.clear()
     targets.update(new_targets)
 
-def process_resources_int(pak_path, converter, targets):
-    """Extract and process resources contained in a pak file.
+class PakStream(object):
+    """Positional reads from an open pak file.
 
-    Implement :func:`process_resources` for a single pak file.
+    Each read seeks to the requested position first, under a lock, so a
+    single object may be shared by multiple threads.
 
-    See :func:`process_resources` for more discussion of the return value
-    and the handling of the ``targets`` argument.
+    :param instream: binary file object of the pak file
+    :type instream:  file
 
-    :param pak_path:  file path of the pak file to process
-    :type pak_path:   str
-    :param converter: used to process each selected resource, as described for
-                      :func:`process_resources`
-    :type converter:  function(bytes,str)
-    :param targets:   resources to select, as described for
-                      :func:`process_resources` and converted by
-                      :func:`encode_targets`; contents may be modified
-    :type targets:    dict(bytes,(str,str)) or None
+    """
 
-    :returns: True if no IOError exception reading the pak file and no
-              exception processing any resource, False otherwise
-    :rtype:   bool
+    # Each read is a system call, so it's worth combining nearby reads.
+    coalesce_reads = True
 
-    """
-    try:
-        with open(pak_path, 'rb') as instream:
-            # Get resources to process and iterate over them.
-            target_info = get_target_info(instream, targets)
-            if target_info is None:
-                if print_err:
-                    sys.stderr.write("{0} is not a pak file\n".format(pak_path))
-                return False
-            processing_exception = False
-            for target in target_info:
-                # Get the individual resource info and read its content.
-                (file_name, file_off, file_len) = target
-                instream.seek(file_off)
-                orig_data = instream.read(file_len)
-                if len(orig_data) != file_len:
-                    raise IOError(2, "unexpected EOF reading resource data")
-                # Process the resource using the converter function, in the way
-                # indicated by the type of the targets argument.
-                try:
-                    if targets is None:
-                        converter(orig_data, file_name.decode())
-                    else:
-                        if converter(orig_data, targets[file_name][1]):
-                            del targets[file_name]
-                except:
-                    processing_exception = True
-                    if print_err:
-                        sys.stderr.write("{0!r} exception processing resource {1}\n".format(
-                            sys.exc_info()[1], file_name.decode()))
-        return True and not processing_exception
-    except IOError:
-        if print_err:
-            sys.stderr.write("{0!r} exception reading pak {1}\n".format(
-                sys.exc_info()[1], pak_path))
-        return False
+    def __init__(self, instream):
+        self.instream = instream
+        self.lock = threading.Lock()
+        st = os.fstat(instream.fileno())
+        self.size = st.st_size
+        # Content read through this object may be kept in resource_cache.
+        self.identity = stat_identity(st)
 
-def process_resources(sources, converter, targets=None):
-    """Extract and process resources contained in one or more pak files.
+    def read_range(self, offset, length):
+        """Return a range of bytes from the pak file.
 
-    The ``converter`` parameter accepts a function that will be used to process
-    each selected resource that is found in a pak file. This converter function
-    accepts the resource binary content and a name string as arguments. It
-    returns a boolean success status, which indicates whether the resource was
-    processed but does not affect the overall return value of process_resources.
-    The converter function may also raise any exception to stop processing a
-    given resource; this does not immediately interrupt the overall
-    process_resources loop, but will cause process_resources to return False
-    when it finishes.
+        An IOError is raised if the pak file ends before the end of the range.
 
-    The :func:`nop_converter` function in this module is an example of a simple
-    converter function that just writes out the resource content in its original
-    form.
+        :param offset: position in the pak file of the first byte to read
+        :type offset:  int
+        :param length: number of bytes to read
+        :type length:  int
 
-    The selected resources, and the name passed to the converter function for
-    each, depend on the type and content of the ``targets`` argument:
+        :returns: the bytes read
+        :rtype:   bytes
 
-    * None: Every resource in the pak file is selected. The name passed to the
-      converter function is the resource name.
+        """
+        with self.lock:
+            self.instream.seek(offset)
+            data = self.instream.read(length)
+        if len(data) != length:
+            raise IOError(2, "unexpected EOF reading resource data")
+        return data
 
-    * set: Resources are selected only if their name is in the set. The name
-      passed to the converter function is the resource name.
+    def readinto_range(self, offset, buf):
+        """Read bytes from the pak file into a writable buffer.
 
-    * dict: Resources are selected only if their name is a key in the dict. The
-      name passed to the converter function is the result of looking up the
-      resource name in the dict.
+        :param offset: position in the pak file of the first byte to read
+        :type offset:  int
+        :param buf:    buffer to fill
+        :type buf:     bytearray or memoryview
 
-    If the ``targets`` argument is a set or dict, the element corresponding to
-    each found and successfully processed resource is removed from it.
+        :returns: number of bytes read, which is less than the buffer length
+                  only if the pak file ended first
+        :rtype:   int
 
-    This function will return True if each specified source is a pak file, is
-    read without I/O errors, and is processed without converter exceptions.
-    False otherwise.
+        """
+        with self.lock:
+            self.instream.seek(offset)
+            return self.instream.readinto(buf)
 
-    .. note::
+    def copy_range(self, offset, length, out_fd):
+        """Copy a range of bytes from the pak file to another file.
 
-         In the case where ``targets`` is not None, a True result does not
-         indicate that all of the resources in ``targets`` were found and
-         processed. And if False is returned, some processing may have been
-         done. Examining the contents of ``targets`` after the function returns
-         is a good idea.
+        The bytes are copied within the kernel by :func:`kernel_copy`, to the
+        current position of ``out_fd``. Since the read position is given
+        explicitly, no lock is needed.
 
-    :param sources:   file path of the pak file to process, or an iterable
-                      specifying multiple such paths
-    :type sources:    str or iterable(str)
-    :param converter: used to process each selected resource, as described above
-    :type converter:  function(bytes,str)
-    :param targets:   resources to select, as described above; contents may be
-                      modified
-    :type targets:    dict(str,str) or set(str) or None
+        :param offset: position in the pak file of the first byte to copy
+        :type offset:  int
+        :param length: number of bytes to copy
+        :type length:  int
+        :param out_fd: file descriptor to write to
+        :type out_fd:  int
 
-    :returns: True if no IOError exception reading the pak file and no
-              exception processing any resource, False otherwise
-    :rtype:   bool
+        :returns: number of bytes copied, which is less than ``length`` only
+                  if the platform can't copy the rest within the kernel
+        :rtype:   int
 
-    """
-    enc_targets = encode_targets(targets)
-    all_success = True
-    if is_string(sources):
-        # Handle single-string input for the sources argument.
-        all_success = process_resources_int(sources, converter, enc_targets)
-    else:
-        # Handle iterable input for the sources argument.
-        for pak_path in sources:
-            success = process_resources_int(pak_path, converter, enc_targets)
-            all_success = success and all_success
-    update_targets(targets, enc_targets)
-    return all_success
+        """
+        return kernel_copy(self.instream.fileno(), offset, length, out_fd)
 
-def nop_converter(orig_data, name):
-    """Example converter function that writes out the unmodified resource.
+    def close(self):
+        """Nothing to release; the file object is closed by its owner.
 
-    Treat all but the final path segments of the resource as subdirectories, and
+        """
+        pass
+
+class PakMapping(object):
+    """Read-only memory map of an open pak file.
+
+    Resource content read through :meth:`read_range` is returned as a
+    memoryview into the map, without copying. Once :meth:`close` is called
+    the views must not be used.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+
+    """
+
+    # Reads are just slices of the map, so combining them gains nothing.
+    coalesce_reads = False
+
+    def __init__(self, instream):
+        self.map = mmap.mmap(instream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        try:
+            self.view = memoryview(self.map)
+        except (NameError, TypeError):
+            # Older Pythons can't make a memoryview of a map; slicing the map
+            # itself will return copies instead.
+            self.view = None
+
+    def read_range(self, offset, length):
+        """Return a range of bytes from the pak file.
+
+        An IOError is raised if the pak file ends before the end of the range.
+
+        :param offset: position in the pak file of the first byte to read
+        :type offset:  int
+        :param length: number of bytes to read
+        :type length:  int
+
+        :returns: view of the bytes in the map
+        :rtype:   memoryview
+
+        """
+        end = offset + length
+        if end > self.size:
+            raise IOError(2, "unexpected EOF reading resource data")
+        if self.view is None:
+            return self.map[offset:end]
+        return self.view[offset:end]
+
+    def readinto_range(self, offset, buf):
+        """Copy bytes from the map into a writable buffer.
+
+        :param offset: position in the pak file of the first byte to read
+        :type offset:  int
+        :param buf:    buffer to fill
+        :type buf:     bytearray or memoryview
+
+        :returns: number of bytes copied, which is less than the buffer length
+                  only if the pak file ended first
+        :rtype:   int
+
+        """
+        count = max(0, min(len(buf), self.size - offset))
+        buf[:count] = self.map[offset:offset + count]
+        return count
+
+    def close(self):
+        """Release the map.
+
+        """
+        if self.view is not None:
+            release_view(self.view)
+        try:
+            self.map.close()
+        except BufferError:
+            # Some view of the map is still held elsewhere. The map will be
+            # unmapped when the last such view goes away.
+            pass
+
+class ResourceReader(io.RawIOBase):
+    """Read-only binary stream over the content of one resource in a pak file.
+
+    This is the file-like object passed to converter functions in streaming
+    mode (see :func:`process_resources`). It supports the usual
+    :class:`io.RawIOBase` reading and seeking methods, limited to the byte
+    range of the resource: position 0 is the first byte of the resource, and
+    reads stop at the end of the resource. Content is read from the pak file
+    only as it is requested.
+
+    The ``offset`` and ``length`` attributes give the location of the resource
+    content within the pak file.
+
+    :param pak_data: source of the pak file bytes, such as a
+                     :class:`PakStream` or :class:`PakMapping`
+    :type pak_data:  object
+    :param offset:   position of the resource content in the pak file
+    :type offset:    int
+    :param length:   length of the resource content
+    :type length:    int
+
+    """
+
+    def __init__(self, pak_data, offset, length):
+        io.RawIOBase.__init__(self)
+        self.pak_data = pak_data
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        elif whence != io.SEEK_SET:
+            raise ValueError("invalid whence ({0})".format(whence))
+        if pos < 0:
+            raise ValueError("negative seek position {0}".format(pos))
+        self.pos = pos
+        return pos
+
+    def read(self, size=-1):
+        self._checkClosed()
+        remaining = max(0, self.length - self.pos)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.pak_data.read_range(self.offset + self.pos, size)
+        self.pos += size
+        # Hand back a copy; views into a memory-mapped pak must not escape.
+        if not isinstance(data, bytes):
+            data = data.tobytes()
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buf):
+        self._checkClosed()
+        remaining = max(0, self.length - self.pos)
+        if len(buf) <= remaining:
+            window = buf
+        elif HAVE_MEMORYVIEW:
+            window = memoryview(buf)[:remaining]
+        else:
+            # 2.6 COMPAT: no memoryview, so read into a smaller buffer and
+            # copy from it.
+            window = bytearray(remaining)
+        count = self.pak_data.readinto_range(self.offset + self.pos, window)
+        if count != len(window):
+            raise IOError(2, "unexpected EOF reading resource data")
+        if not HAVE_MEMORYVIEW and window is not buf:
+            buf[:count] = window
+        self.pos += count
+        return count
+
+    def copy_to(self, outstream):
+        """Copy the rest of the resource content to a binary file object.
+
+        If :data:`zero_copy` is set, the pak data source supports it, and
+        ``outstream`` is backed by a file descriptor, the content is copied
+        within the kernel. Otherwise (or for whatever the kernel could not
+        copy) it is copied with :func:`copy_stream`.
+
+        :param outstream: binary file object to write to
+        :type outstream:  file
+
+        """
+        self._checkClosed()
+        remaining = max(0, self.length - self.pos)
+        copy_range = getattr(self.pak_data, 'copy_range', None)
+        if zero_copy and copy_range is not None and remaining:
+            try:
+                out_fd = outstream.fileno()
+            except (AttributeError, IOError, ValueError):
+                out_fd = None
+            if out_fd is not None:
+                outstream.flush()
+                self.pos += copy_range(self.offset + self.pos, remaining,
+                                       out_fd)
+        copy_stream(self, outstream)
+
+def kernel_copy(in_fd, offset, length, out_fd):
+    """Copy a range of one file to another within the kernel.
+
+    Use os.copy_file_range if available, falling back to os.sendfile. The
+    bytes are written at the current position of ``out_fd``, and the position
+    of ``in_fd`` is not changed. Copying stops early, without an exception, if
+    neither function is available or works for these files.
+
+    An IOError is raised if ``in_fd`` ends before the end of the range.
+
+    :param in_fd:  file descriptor to read from
+    :type in_fd:   int
+    :param offset: position in ``in_fd`` of the first byte to copy
+    :type offset:  int
+    :param length: number of bytes to copy
+    :type length:  int
+    :param out_fd: file descriptor to write to
+    :type out_fd:  int
+
+    :returns: number of bytes copied
+    :rtype:   int
+
+    """
+    copied = 0
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    while copied < length:
+        count = length - copied
+        try:
+            if copy_file_range is not None:
+                count = copy_file_range(in_fd, out_fd, count,
+                                        offset + copied)
+            elif sendfile is not None:
+                count = sendfile(out_fd, in_fd, offset + copied, count)
+            else:
+                break
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+            if copy_file_range is not None:
+                copy_file_range = None
+            else:
+                sendfile = None
+            continue
+        if not count:
+            raise IOError(2, "unexpected EOF reading resource data")
+        copied += count
+    return copied
+
+class ResourceCache(object):
+    """In-memory cache of resource content, limited to a number of bytes.
+
+    Content is keyed by the identity of the pak file it was read from (see
+    :func:`pak_identity`), the resource name, and its offset, so a changed
+    pak file never serves stale content. When adding content would exceed
+    ``max_bytes``, the least recently used content is evicted; content larger
+    than ``max_bytes`` is not cached at all. The ``hits``, ``misses``, and
+    ``evictions`` attributes count lookups that found content, lookups that
+    didn't, and evicted items, and ``size`` is the number of bytes held.
+
+    The cache is used by setting :data:`resource_cache`. It may be shared by
+    multiple threads.
+
+    Example of caching up to 64 MiB of resources for a long-running server:
+
+    .. code-block:: python
+
+        expak.resource_cache = expak.ResourceCache(64 * 1024 * 1024)
+
+    :param max_bytes: largest total size of cached content
+    :type max_bytes:  int
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # 2.6 COMPAT: no OrderedDict, so keep recency order in a circular
+        # doubly-linked list of [prev, next, key, data] links, with the least
+        # recently used link after the root.
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.links)
+
+    def get(self, key):
+        """Return cached content, marking it as most recently used.
+
+        :param key: cache key
+        :type key:  tuple
+
+        :returns: the content, or None if it is not cached
+        :rtype:   bytes or None
+
+        """
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.unlink(link)
+            self.append(link)
+            return link[3]
+
+    def put(self, key, data):
+        """Add content to the cache, evicting other content to make room.
+
+        :param key:  cache key
+        :type key:   tuple
+        :param data: the content
+        :type data:  bytes
+
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self.unlink(link)
+                self.size -= len(link[3])
+            link = [None, None, key, data]
+            self.links[key] = link
+            self.append(link)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                oldest = self.root[1]
+                self.unlink(oldest)
+                del self.links[oldest[2]]
+                self.size -= len(oldest[3])
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all content from the cache. The counters are not reset.
+
+        """
+        with self.lock:
+            self.links.clear()
+            self.root[:] = [self.root, self.root, None, None]
+            self.size = 0
+
+    def unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def append(self, link):
+        last = self.root[0]
+        link[0] = last
+        link[1] = self.root
+        last[1] = link
+        self.root[0] = link
+
+def cache_key(pak_data, target):
+    """Return the :data:`resource_cache` key for a resource.
+
+    :param pak_data: source of the pak file bytes
+    :type pak_data:  object
+    :param target:   (name, offset, length) tuple for the resource
+    :type target:    tuple(bytes,int,int)
+
+    :returns: key, or None if content read from ``pak_data`` is not cached
+              (memory-mapped content is already served from the page cache
+              without a read)
+    :rtype:   tuple or None
+
+    """
+    identity = getattr(pak_data, 'identity', None)
+    if identity is None:
+        return None
+    return (identity, target[0], target[1])
+
+def release_view(data):
+    """Release a memoryview, if ``data`` is one that can be released.
+
+    :param data: resource content passed to a converter function
+    :type data:  bytes or memoryview
+
+    """
+    release = getattr(data, 'release', None)
+    if release is not None and not is_string(data):
+        release()
+
+#: Serializes updates made by :func:`add_stats`, which may be called from
+#: several threads at once for the same dict.
+stats_lock = threading.Lock()
+
+def add_stats(stats, **counts):
+    """Add counts to a statistics dict, if one was supplied.
+
+    :param stats:  dict of statistics to update, or None
+    :type stats:   dict(str,int) or None
+    :param counts: amounts to add to the dict entries of the same names
+    :type counts:  int
+
+    """
+    if stats is None:
+        return
+    with stats_lock:
+        for k in counts:
+            stats[k] = stats.get(k, 0) + counts[k]
+
+def seek_distance(target_info):
+    """Return the total seek distance to read resources in the given order.
+
+    This is the sum of the distances between the end of each resource's
+    content and the start of the next one's. The initial seek to the first
+    resource is not counted.
+
+    :param target_info: (name, offset, length) tuples for resources
+    :type target_info:  list(tuple(bytes,int,int))
+
+    :returns: total seek distance in bytes
+    :rtype:   int
+
+    """
+    distance = 0
+    for (prev, cur) in zip(target_info, target_info[1:]):
+        distance += abs(cur[1] - (prev[1] + prev[2]))
+    return distance
+
+def schedule_entries(target_info, stats=None):
+    """Order selected resources so that their content is read sequentially.
+
+    Return a copy of ``target_info`` sorted by the offset of each resource's
+    content in the pak file, so that the pak file is read front to back
+    instead of in file table order. If ``stats`` is supplied, the seek
+    distance of that order and the distance saved relative to file table
+    order are added to it as "seek_distance" and "seek_distance_saved".
+
+    Where a name appears more than once in the file table, its entries keep
+    their file table order, so that the first entry is processed first and
+    the others only if that fails (see :func:`process_entries`). A later
+    entry whose content comes before an earlier one's is placed as though it
+    came just after.
+
+    :param target_info: (name, offset, length) tuples for selected resources
+    :type target_info:  list(tuple(bytes,int,int))
+    :param stats:       dict of statistics to update, or None
+    :type stats:        dict(str,int) or None
+
+    :returns: (name, offset, length) tuples in ascending offset order
+    :rtype:   list(tuple(bytes,int,int))
+
+    """
+    keys = []
+    latest = {}
+    for (file_name, file_off, file_len) in target_info:
+        key = max(file_off, latest.get(file_name, file_off))
+        latest[file_name] = key
+        keys.append(key)
+    order = sorted(range(len(target_info)), key=lambda i: (keys[i], i))
+    scheduled = [target_info[i] for i in order]
+    if stats is not None:
+        distance = seek_distance(scheduled)
+        add_stats(stats, seek_distance=distance,
+                  seek_distance_saved=seek_distance(target_info) - distance)
+    return scheduled
+
+def coalesce_entries(target_info):
+    """Group resources whose content is close together in the pak file.
+
+    Walk ``target_info``, which should be in ascending offset order, and
+    group its entries into runs that can each be fetched with one read. An
+    entry joins the current run if its content starts within the run or no
+    more than :data:`coalesce_gap` bytes past the end of the run, and the run
+    would still span no more than :data:`coalesce_span` bytes.
+
+    :param target_info: (name, offset, length) tuples for selected resources,
+                        as ordered by :func:`schedule_entries`
+    :type target_info:  list(tuple(bytes,int,int))
+
+    :returns: list of (offset, end, entries) tuples, one per run, giving the
+              range of the pak file to read and the entries within it
+    :rtype:   list(tuple(int,int,list(tuple(bytes,int,int))))
+
+    """
+    runs = []
+    for target in target_info:
+        (file_name, file_off, file_len) = target
+        file_end = file_off + file_len
+        if runs:
+            (run_off, run_end, entries) = runs[-1]
+            if (run_off <= file_off <= run_end + coalesce_gap and
+                    max(run_end, file_end) - run_off <= coalesce_span):
+                entries.append(target)
+                runs[-1] = (run_off, max(run_end, file_end), entries)
+                continue
+        runs.append((file_off, file_end, [target]))
+    return runs
+
+def iter_entry_data(pak_data, target_info, stream=False, stats=None):
+    """Read the content of selected resources.
+
+    Generate a (target, data) tuple for each element of ``target_info``, in
+    the order determined by :func:`schedule_entries`. The data is a
+    :class:`ResourceReader` in streaming mode, a memoryview if ``pak_data`` is
+    a :class:`PakMapping`, and otherwise a bytes object. When reading into
+    bytes objects, resources close together in the pak file are fetched
+    together as described for :func:`coalesce_entries`, and each resource's
+    content is then copied out of the shared buffer into its own bytes
+    object. That copy keeps the converter's data valid after it returns, as
+    in the other buffered cases; what coalescing saves is read calls, not
+    copying. When reading into bytes objects, resources found in
+    :data:`resource_cache` are also generated first without being read, and
+    the content of the others is added to the cache.
+
+    If ``stats`` is supplied, the number of read operations and the number of
+    bytes they fetched are added to it as "reads" and "bytes_read". An IOError
+    is raised if the content of a resource extends past the end of the file.
+
+    :param pak_data:    source of the pak file bytes, such as a
+                        :class:`PakStream` or :class:`PakMapping`
+    :type pak_data:     object
+    :param target_info: (name, offset, length) tuples for selected resources
+    :type target_info:  list(tuple(bytes,int,int))
+    :param stream:      whether to generate streams instead of content
+    :type stream:       bool
+    :param stats:       dict of statistics to update, or None
+    :type stats:        dict(str,int) or None
+
+    :returns: iterator over (target, data) tuples
+    :rtype:   iterator(tuple(tuple(bytes,int,int),object))
+
+    """
+    scheduled = schedule_entries(target_info, stats)
+    cache = None
+    if not stream and getattr(pak_data, 'identity', None) is not None:
+        cache = resource_cache
+    if cache is not None:
+        # Hand over cached content first; only the rest needs reading.
+        misses = []
+        missed_names = set()
+        for target in scheduled:
+            data = None
+            # Later copies of a name must not overtake an uncached earlier one.
+            if target[0] not in missed_names:
+                data = cache.get(cache_key(pak_data, target))
+            if data is None:
+                misses.append(target)
+                missed_names.add(target[0])
+            else:
+                yield (target, data)
+        scheduled = misses
+    if stream or not pak_data.coalesce_reads:
+        for target in scheduled:
+            (file_name, file_off, file_len) = target
+            if stream:
+                # Just make sure the content is all there.
+                if file_off + file_len > pak_data.size:
+                    raise IOError(2, "unexpected EOF reading resource data")
+                yield (target, ResourceReader(pak_data, file_off, file_len))
+            else:
+                yield (target, pak_data.read_range(file_off, file_len))
+        return
+    for (run_off, run_end, entries) in coalesce_entries(scheduled):
+        if len(entries) == 1:
+            (file_name, file_off, file_len) = entries[0]
+            data = pak_data.read_range(file_off, file_len)
+            add_stats(stats, reads=1, bytes_read=file_len)
+            if cache is not None:
+                cache.put(cache_key(pak_data, entries[0]), data)
+            yield (entries[0], data)
+            continue
+        buf = bytearray(run_end - run_off)
+        count = pak_data.readinto_range(run_off, buf)
+        add_stats(stats, reads=1, bytes_read=count)
+        view = buffer_view(buf)
+        for target in entries:
+            start = target[1] - run_off
+            end = start + target[2]
+            if end > count:
+                raise IOError(2, "unexpected EOF reading resource data")
+            data = view[start:end]
+            if HAVE_MEMORYVIEW:
+                data = data.tobytes()
+            else:
+                data = bytes(data)
+            if cache is not None:
+                cache.put(cache_key(pak_data, target), data)
+            yield (target, data)
+
+def call_converter(converter, orig_data, name, stream=False):
+    """Invoke a converter function on one resource.
+
+    Any exception raised by the converter is caught and described in the
+    return value rather than propagated, so that this can be run on a worker
+    thread. Once the converter is done, ``orig_data`` is closed (if it is a
+    stream) or released (if it is a memoryview).
+
+    :param converter: used to process the resource, as described for
+                      :func:`process_resources`
+    :type converter:  function(bytes,str)
+    :param orig_data: resource content or stream to pass to the converter
+    :type orig_data:  bytes or memoryview or ResourceReader
+    :param name:      name to pass to the converter
+    :type name:       str
+    :param stream:    whether ``orig_data`` is a stream
+    :type stream:     bool
+
+    :returns: tuple of the converter's return value (or False if it raised
+              an exception) and the repr of the exception raised (or None)
+    :rtype:   tuple(bool,str)
+
+    """
+    try:
+        return (converter(orig_data, name), None)
+    except:
+        return (False, repr(sys.exc_info()[1]))
+    finally:
+        # Streams, and views into a memory-mapped pak, are only valid for the
+        # duration of the converter call.
+        discard_data(orig_data, stream)
+
+def discard_data(orig_data, stream=False):
+    """Close or release resource content that is no longer needed.
+
+    :param orig_data: resource content or stream from :func:`iter_entry_data`,
+                      or None from :func:`iter_entry_ranges`
+    :type orig_data:  bytes or memoryview or ResourceReader or None
+    :param stream:    whether ``orig_data`` is a stream
+    :type stream:     bool
+
+    """
+    if orig_data is None:
+        return
+    if stream:
+        orig_data.close()
+    else:
+        release_view(orig_data)
+
+def iter_entry_ranges(pak_data, target_info, stats=None):
+    """Check the location of selected resources without reading them.
+
+    Generate a (target, None) tuple for each element of ``target_info``, in
+    the order determined by :func:`schedule_entries`. This is used in place of
+    :func:`iter_entry_data` when resource content is read by worker
+    processes. An IOError is raised if the content of a resource extends past
+    the end of the file.
+
+    :param pak_data:    source of the pak file bytes, such as a
+                        :class:`PakStream` or :class:`PakMapping`
+    :type pak_data:     object
+    :param target_info: (name, offset, length) tuples for selected resources
+    :type target_info:  list(tuple(bytes,int,int))
+    :param stats:       dict of statistics to update, or None
+    :type stats:        dict(str,int) or None
+
+    :returns: iterator over (target, None) tuples
+    :rtype:   iterator(tuple(tuple(bytes,int,int),None))
+
+    """
+    for target in schedule_entries(target_info, stats):
+        if target[1] + target[2] > pak_data.size:
+            raise IOError(2, "unexpected EOF reading resource data")
+        yield (target, None)
+
+# Memory maps of pak files opened by call_converter_in_worker, by file path.
+# These persist for the life of the worker process.
+worker_pak_maps = {}
+
+def call_converter_in_worker(converter, pak_path, offset, length, name,
+                             stream=False, mapped=False):
+    """Invoke a converter function on one resource, in a worker process.
+
+    Read the resource from a memory map of the pak file, which is created the
+    first time a given worker process needs it and then kept for use by later
+    calls. Then pass the content to :func:`call_converter`. Only the location
+    of the resource crosses the process boundary, not its content.
+
+    :param converter: used to process the resource, as described for
+                      :func:`process_resources`; must be picklable
+    :type converter:  function(bytes,str)
+    :param pak_path:  file path of the pak file
+    :type pak_path:   str
+    :param offset:    position of the resource content in the pak file
+    :type offset:     int
+    :param length:    length of the resource content
+    :type length:     int
+    :param name:      name to pass to the converter
+    :type name:       str
+    :param stream:    whether to pass the converter a :class:`ResourceReader`
+    :type stream:     bool
+    :param mapped:    whether to pass the converter a view of the map instead
+                      of a copy of the content
+    :type mapped:     bool
+
+    :returns: result of :func:`call_converter`
+    :rtype:   tuple(bool,str)
+
+    """
+    try:
+        pak_map = worker_pak_maps.get(pak_path)
+        if pak_map is None:
+            with open(pak_path, 'rb') as instream:
+                pak_map = PakMapping(instream)
+            worker_pak_maps[pak_path] = pak_map
+        if stream:
+            orig_data = ResourceReader(pak_map, offset, length)
+        elif mapped:
+            orig_data = pak_map.read_range(offset, length)
+        else:
+            orig_data = pak_map.map[offset:offset + length]
+    except:
+        return (False, repr(sys.exc_info()[1]))
+    return call_converter(converter, orig_data, name, stream)
+
+def process_entries(pak_data, target_info, converter, targets, stream=False,
+                    stats=None, executor=None, max_pending=None,
+                    pak_path=None, mapped=False, cancel=None):
+    """Read and process the selected resources of an open pak file.
+
+    Iterate over the resources described by ``target_info``, read the content
+    of each with :func:`iter_entry_data`, and pass it to the converter
+    function. A converter exception is reported (if :data:`print_err` is set)
+    and processing continues with the next resource. An IOError reading the
+    pak file is propagated.
+
+    If ``executor`` is supplied, the converter calls are submitted to it, and
+    the calling thread continues reading resources while they run. No more
+    than ``max_pending`` calls are outstanding at once. The ``targets``
+    argument is only modified by the calling thread.
+
+    If ``pak_path`` is also supplied, ``executor`` is expected to be a pool of
+    worker processes. Resource content is then not read by the calling
+    thread. Instead each worker is sent the location of a resource and reads
+    it from its own memory map of the pak file, via
+    :func:`call_converter_in_worker`; ``mapped`` is passed along to it.
+
+    If ``cancel`` is supplied, no further resources are read once it is set.
+
+    See :func:`process_resources` for more discussion of the return value
+    and the handling of the ``targets`` and ``stream`` arguments.
+
+    :param pak_data:    source of the pak file bytes, such as a
+                        :class:`PakStream` or :class:`PakMapping`
+    :type pak_data:     object
+    :param target_info: (name, offset, length) tuples for selected resources,
+                        as returned by :func:`get_target_info`
+    :type target_info:  list(tuple(bytes,int,int))
+    :param converter:   used to process each selected resource, as described
+                        for :func:`process_resources`
+    :type converter:    function(bytes,str)
+    :param targets:     resources to select, as described for
+                        :func:`process_resources` and converted by
+                        :func:`encode_targets`; contents may be modified
+    :type targets:      dict(bytes,(str,str)) or None
+    :param stream:      whether to pass the converter a :class:`ResourceReader`
+                        instead of the resource content
+    :type stream:       bool
+    :param stats:       dict of statistics to update, or None
+    :type stats:        dict(str,int) or None
+    :param executor:    executor to run converter calls on, or None to run them
+                        on the calling thread
+    :type executor:     concurrent.futures.Executor or None
+    :param max_pending: limit on outstanding converter calls when using
+                        ``executor``
+    :type max_pending:  int
+    :param pak_path:    file path of the pak file, if ``executor`` is a
+                        process pool; otherwise None
+    :type pak_path:     str or None
+    :param mapped:      whether workers should pass the converter a view of
+                        their memory map instead of a copy
+    :type mapped:       bool
+    :param cancel:      event that stops processing when set, or None
+    :type cancel:       threading.Event or None
+
+    :returns: True if no exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    def handle_result(file_name, outcome):
+        # Record the outcome of a converter call. Return False if the
+        # converter raised an exception.
+        (result, exc) = outcome
+        if exc is not None:
+            if print_err:
+                sys.stderr.write(
+                    "{0} exception processing resource {1}\n".format(
+                        exc, file_name.decode()))
+            return False
+        if result:
+            if targets is not None:
+                del targets[file_name]
+            else:
+                handled.add(file_name)
+        return True
+    processing_exception = False
+    # Names processed successfully, when there is no targets dict to track
+    # them in.
+    handled = set()
+    # Outstanding converter calls, mapped to and from resource names.
+    pending = {}
+    in_flight = {}
+    def finish(futures_done):
+        success = True
+        for future in futures_done:
+            file_name = pending.pop(future)
+            del in_flight[file_name]
+            try:
+                outcome = future.result()
+            except Exception:
+                # The call couldn't be made at all; for example the converter
+                # couldn't be sent to a worker process.
+                outcome = (False, repr(sys.exc_info()[1]))
+            success = handle_result(file_name, outcome) and success
+        return success
+    if pak_path is None:
+        entries = iter_entry_data(pak_data, target_info, stream, stats)
+    else:
+        entries = iter_entry_ranges(pak_data, target_info, stats)
+    try:
+        for (target, orig_data) in entries:
+            if cancel is not None and cancel.is_set():
+                discard_data(orig_data, stream)
+                break
+            (file_name, file_off, file_len) = target
+            if file_name in in_flight:
+                # Another copy of this resource in the pak is being processed;
+                # only process this one if that fails.
+                success = finish([in_flight[file_name]])
+                processing_exception = processing_exception or not success
+            # Process the resource using the converter function, in the way
+            # indicated by the type of the targets argument.
+            if targets is None and file_name not in handled:
+                name = file_name.decode()
+            elif targets is not None and file_name in targets:
+                name = targets[file_name][1]
+            else:
+                # Another copy of this resource in the pak was already
+                # handled.
+                discard_data(orig_data, stream)
+                continue
+            if executor is None:
+                outcome = call_converter(converter, orig_data, name, stream)
+                success = handle_result(file_name, outcome)
+                processing_exception = processing_exception or not success
+                continue
+            if pak_path is None:
+                future = executor.submit(call_converter, converter, orig_data,
+                                         name, stream)
+            else:
+                future = executor.submit(call_converter_in_worker, converter,
+                                         pak_path, file_off, file_len, name,
+                                         stream, mapped)
+            pending[future] = file_name
+            in_flight[file_name] = future
+            if len(pending) >= max_pending:
+                done = futures.wait(list(pending),
+                                    return_when=futures.FIRST_COMPLETED)[0]
+                success = finish(done)
+                processing_exception = processing_exception or not success
+    finally:
+        # Collect the outcome of every outstanding call, even if reading the
+        # pak failed.
+        if pending:
+            success = finish(futures.wait(list(pending))[0])
+            processing_exception = processing_exception or not success
+    return not processing_exception
+
+def report_pak_exception(pak_path):
+    """Report the exception being handled as an error reading a pak file.
+
+    The message is written to stderr if :data:`print_err` is set.
+
+    :param pak_path: file path of the pak file
+    :type pak_path:  str
+
+    """
+    if print_err:
+        sys.stderr.write("{0!r} exception reading pak {1}\n".format(
+            sys.exc_info()[1], pak_path))
+
+class PakSource(object):
+    """A pak file opened for processing by :func:`process_resources`.
+
+    Use :func:`open_source` to create one.
+
+    :param pak_path:      file path of the pak file
+    :type pak_path:       str
+    :param instream:      binary file object of the pak file
+    :type instream:       file
+    :param target_info:   (name, offset, length) tuples for selected
+                          resources, as returned by :func:`get_target_info`
+    :type target_info:    list(tuple(bytes,int,int))
+    :param use_mmap:      whether to memory-map the pak file
+    :type use_mmap:       bool
+    :param use_processes: whether resources will be read by worker processes
+    :type use_processes:  bool
+
+    """
+
+    def __init__(self, pak_path, instream, target_info, use_mmap=False,
+                 use_processes=False):
+        self.path = pak_path
+        self.instream = instream
+        self.target_info = target_info
+        if use_mmap and not use_processes:
+            self.pak_data = PakMapping(instream)
+        else:
+            self.pak_data = PakStream(instream)
+        if use_processes:
+            self.worker_pak_path = os.path.abspath(pak_path)
+        else:
+            self.worker_pak_path = None
+
+    def process(self, target_info, converter, targets, **options):
+        """Process some of the selected resources.
+
+        Call :func:`process_entries` with ``target_info`` (a subset of this
+        object's ``target_info`` attribute) and ``options``. An IOError is
+        propagated.
+
+        :param target_info: (name, offset, length) tuples for the resources to
+                            process
+        :type target_info:  list(tuple(bytes,int,int))
+        :param converter:   used to process each selected resource, as
+                            described for :func:`process_resources`
+        :type converter:    function(bytes,str)
+        :param targets:     resources to select, as described for
+                            :func:`process_entries`; contents may be modified
+        :type targets:      dict(bytes,(str,str)) or None
+        :param options:     further keyword arguments for
+                            :func:`process_entries`
+
+        :returns: True if no exception processing any resource, False otherwise
+        :rtype:   bool
+
+        """
+        return process_entries(self.pak_data, target_info, converter, targets,
+                               pak_path=self.worker_pak_path, **options)
+
+    def close(self):
+        """Close the pak file.
+
+        """
+        self.pak_data.close()
+        self.instream.close()
+
+def open_source(pak_path, targets, use_mmap=False, use_processes=False,
+                selector=None):
+    """Open a pak file for processing and select resources from it.
+
+    If the file can't be read, or is not a pak file, report that (if
+    :data:`print_err` is set) and return None.
+
+    :param pak_path:      file path of the pak file
+    :type pak_path:       str
+    :param targets:       resources to select, as described for
+                          :func:`process_resources` and converted by
+                          :func:`encode_targets`
+    :type targets:        dict(bytes,(str,str)) or None
+    :param use_mmap:      whether to memory-map the pak file
+    :type use_mmap:       bool
+    :param use_processes: whether resources will be read by worker processes
+    :type use_processes:  bool
+    :param selector:      patterns of further resources to select, or None
+    :type selector:       PatternSelector or None
+
+    :returns: the opened pak file, or None
+    :rtype:   PakSource or None
+
+    """
+    try:
+        instream = open(pak_path, 'rb')
+    except IOError:
+        report_pak_exception(pak_path)
+        return None
+    try:
+        target_info = get_target_info(instream, targets, selector)
+        if target_info is None:
+            if print_err:
+                sys.stderr.write("{0} is not a pak file\n".format(pak_path))
+            instream.close()
+            return None
+        return PakSource(pak_path, instream, target_info, use_mmap,
+                         use_processes)
+    except (IOError, mmap.error):
+        instream.close()
+        report_pak_exception(pak_path)
+        return None
+
+def process_resources_int(pak_path, converter, targets, use_mmap=False,
+                          use_processes=False, selector=None, **options):
+    """Extract and process resources contained in a pak file.
+
+    Implement :func:`process_resources` for a single pak file.
+
+    See :func:`process_resources` for more discussion of the return value
+    and the handling of the ``targets`` argument.
+
+    :param pak_path:      file path of the pak file to process
+    :type pak_path:       str
+    :param converter:     used to process each selected resource, as described
+                          for :func:`process_resources`
+    :type converter:      function(bytes,str)
+    :param targets:       resources to select, as described for
+                          :func:`process_resources` and converted by
+                          :func:`encode_targets`; contents may be modified
+    :type targets:        dict(bytes,(str,str)) or None
+    :param use_mmap:      whether to memory-map the pak file, as described for
+                          :func:`process_resources`
+    :type use_mmap:       bool
+    :param use_processes: whether the ``executor`` option is a process pool,
+                          whose workers read the resources themselves
+    :type use_processes:  bool
+    :param selector:      patterns of further resources to select, or None
+    :type selector:       PatternSelector or None
+    :param options:       further keyword arguments for
+                          :func:`process_entries`, such as ``stream``,
+                          ``stats``, ``executor``, and ``max_pending``
+
+    :returns: True if no IOError exception reading the pak file and no
+              exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    source = open_source(pak_path, targets, use_mmap, use_processes, selector)
+    if source is None:
+        return False
+    try:
+        return source.process(source.target_info, converter, targets,
+                              mapped=use_mmap, **options)
+    except (IOError, mmap.error):
+        report_pak_exception(pak_path)
+        return False
+    finally:
+        source.close()
+
+def process_sources_concurrently(sources, converter, targets, concurrency,
+                                 use_mmap=False, use_processes=False,
+                                 selector=None, **options):
+    """Extract and process resources contained in several pak files at once.
+
+    Implement :func:`process_resources` for multiple pak files, using up to
+    ``concurrency`` threads to open and process them. A pak file is only
+    held open while one of those threads is using it.
+
+    The results are the same as processing the pak files one after another.
+    To guarantee this, the work is done in rounds. In each round, every
+    resource name that still needs processing is assigned to the earliest
+    pak file (in ``sources`` order) that contains it and that hasn't already
+    been tried for it, and then the pak files process their assigned
+    resources concurrently. So a name in ``targets`` is only handled by a
+    later pak file if no earlier one processed it successfully, and when
+    ``targets`` is None a resource found in several pak files is processed
+    from each of them in ``sources`` order. A pak file that can't be read is
+    dropped from later rounds.
+
+    :param sources:       file paths of the pak files to process
+    :type sources:        list(str)
+    :param converter:     used to process each selected resource, as described
+                          for :func:`process_resources`
+    :type converter:      function(bytes,str)
+    :param targets:       resources to select, as described for
+                          :func:`process_resources` and converted by
+                          :func:`encode_targets`; contents may be modified
+    :type targets:        dict(bytes,(str,str)) or None
+    :param concurrency:   number of pak files to work on at once
+    :type concurrency:    int
+    :param use_mmap:      whether to memory-map the pak files, as described
+                          for :func:`process_resources`
+    :type use_mmap:       bool
+    :param use_processes: whether the ``executor`` option is a process pool,
+                          whose workers read the resources themselves
+    :type use_processes:  bool
+    :param selector:      patterns of further resources to select, or None
+    :type selector:       PatternSelector or None
+    :param options:       further keyword arguments for
+                          :func:`process_entries`
+
+    :returns: True if no IOError exception reading any pak file and no
+              exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    def scan_one(pak_path):
+        source = open_source(pak_path, targets, selector=selector)
+        if source is None:
+            return None
+        source.close()
+        return (pak_path, source.target_info)
+    def process_one(assignment):
+        (index, target_info) = assignment
+        pak_path = scanned[index][0]
+        try:
+            instream = open(pak_path, 'rb')
+        except IOError:
+            report_pak_exception(pak_path)
+            failed.add(index)
+            return False
+        try:
+            source = PakSource(pak_path, instream, target_info, use_mmap,
+                               use_processes)
+            try:
+                return source.process(target_info, converter, targets,
+                                      mapped=use_mmap, **options)
+            finally:
+                source.close()
+        except (IOError, mmap.error):
+            instream.close()
+            report_pak_exception(pak_path)
+            failed.add(index)
+            return False
+    # Pak files are only held open while a pool thread is reading their
+    # table or processing their assigned resources, so no more than
+    # concurrency of them are open at any time.
+    pool = futures.ThreadPoolExecutor(concurrency)
+    try:
+        scanned = list(pool.map(scan_one, sources))
+        all_success = None not in scanned
+        scanned = [s for s in scanned if s is not None]
+        # For each resource name, the pak files that contain it (in sources
+        # order), and each pak file's entries grouped by name.
+        candidates = {}
+        by_name = []
+        for (index, (pak_path, target_info)) in enumerate(scanned):
+            entries = {}
+            for target in target_info:
+                entries.setdefault(target[0], []).append(target)
+            for file_name in entries:
+                candidates.setdefault(file_name, []).append(index)
+            by_name.append(entries)
+        failed = set()
+        while True:
+            assignments = {}
+            for file_name in list(candidates):
+                if targets is not None and file_name not in targets:
+                    del candidates[file_name]
+                    continue
+                remaining = [i for i in candidates[file_name]
+                             if i not in failed]
+                if not remaining:
+                    del candidates[file_name]
+                    continue
+                index = remaining[0]
+                candidates[file_name] = remaining[1:]
+                assignments.setdefault(index, []).extend(
+                    by_name[index][file_name])
+            if not assignments:
+                break
+            results = list(pool.map(process_one, assignments.items()))
+            all_success = all(results) and all_success
+    finally:
+        pool.shutdown()
+    return all_success
+
+def process_overlay(sources, converter, targets, concurrency=None,
+                    use_mmap=False, use_processes=False, selector=None,
+                    **options):
+    """Extract and process resources from pak files layered as in Quake.
+
+    Implement the ``overlay`` mode of :func:`process_resources`. The pak
+    files are opened, and their file tables read, from last to first. Each
+    resource name is resolved to the last pak file that contains it (or, if
+    that pak file contains the name more than once, to the first such entry
+    in its file table), just as Quake resolves names on its search path.
+    Once every name in ``targets`` has been resolved, the remaining pak files
+    are not opened at all (unless ``selector`` is supplied, since its
+    patterns may match names in any pak file). Then each pak file processes
+    the resources that resolved to it, in ``sources`` order, or up to
+    ``concurrency`` pak files at once.
+
+    :param sources:       file paths of the pak files to process, from lowest
+                          to highest precedence
+    :type sources:        list(str)
+    :param converter:     used to process each selected resource, as described
+                          for :func:`process_resources`
+    :type converter:      function(bytes,str)
+    :param targets:       resources to select, as described for
+                          :func:`process_resources` and converted by
+                          :func:`encode_targets`; contents may be modified
+    :type targets:        dict(bytes,(str,str)) or None
+    :param concurrency:   number of pak files to process at once, or None
+    :type concurrency:    int or None
+    :param use_mmap:      whether to memory-map the pak files, as described
+                          for :func:`process_resources`
+    :type use_mmap:       bool
+    :param use_processes: whether the ``executor`` option is a process pool,
+                          whose workers read the resources themselves
+    :type use_processes:  bool
+    :param selector:      patterns of further resources to select, or None
+    :type selector:       PatternSelector or None
+    :param options:       further keyword arguments for
+                          :func:`process_entries`
+
+    :returns: True if no IOError exception reading any pak file and no
+              exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    if targets is None:
+        unresolved = None
+    else:
+        unresolved = dict(targets)
+    all_success = True
+    resolved = set()
+    opened = []
+    try:
+        for pak_path in reversed(sources):
+            if selector is None and unresolved is not None and not unresolved:
+                break
+            source = open_source(pak_path, unresolved, use_mmap,
+                                 use_processes, selector)
+            if source is None:
+                all_success = False
+                continue
+            winners = []
+            for target in source.target_info:
+                if target[0] not in resolved:
+                    resolved.add(target[0])
+                    winners.append(target)
+                    if unresolved is not None:
+                        # Names matched by the selector were only added to
+                        # unresolved, so make sure the winner is in targets.
+                        targets.setdefault(target[0],
+                                           unresolved.pop(target[0]))
+            opened.append((source, winners))
+        opened.reverse()
+        def process_one(assignment):
+            (source, winners) = assignment
+            try:
+                return source.process(winners, converter, targets,
+                                      mapped=use_mmap, **options)
+            except (IOError, mmap.error):
+                report_pak_exception(source.path)
+                return False
+        if use_concurrency(concurrency, opened):
+            pool = futures.ThreadPoolExecutor(concurrency)
+            try:
+                results = list(pool.map(process_one, opened))
+            finally:
+                pool.shutdown()
+        else:
+            results = [process_one(a) for a in opened]
+        all_success = all(results) and all_success
+    finally:
+        for (source, winners) in opened:
+            source.close()
+    return all_success
+
+@contextlib.contextmanager
+def converter_pool(workers, processes=None):
+    """Context manager providing a worker pool for converter calls.
+
+    Yield a process pool executor with ``processes`` worker processes if that
+    is a number greater than zero, or else a thread pool executor with
+    ``workers`` threads if that is a number greater than zero. Shut down the
+    executor on exit. Yield None instead if neither kind of pool is
+    requested, or if concurrent.futures is not available.
+
+    :param workers:   number of threads, or None
+    :type workers:    int or None
+    :param processes: number of processes, or None
+    :type processes:  int or None
+
+    """
+    if futures is None:
+        yield None
+        return
+    if processes and processes > 0:
+        executor = futures.ProcessPoolExecutor(processes)
+    elif workers and workers > 0:
+        executor = futures.ThreadPoolExecutor(workers)
+    else:
+        yield None
+        return
+    try:
+        yield executor
+    finally:
+        executor.shutdown()
+
+def use_concurrency(concurrency, sources):
+    """Return whether to process the given pak files concurrently.
+
+    :param concurrency: number of pak files to work on at once, or None
+    :type concurrency:  int or None
+    :param sources:     file paths of the pak files
+    :type sources:      list(str)
+
+    :returns: True if more than one pak file should be worked on at once
+    :rtype:   bool
+
+    """
+    return bool(concurrency and concurrency > 1 and len(sources) > 1 and
+                futures is not None)
+
+def pending_limit(workers):
+    """Return how many converter calls may be outstanding for a thread pool.
+
+    Allowing a couple of calls per thread to be queued keeps every thread busy
+    while bounding the amount of resource content held in memory.
+
+    :param workers: number of threads, or None
+    :type workers:  int or None
+
+    :returns: limit on outstanding converter calls
+    :rtype:   int
+
+    """
+    return 2 * max(1, workers or 1)
+
+class DedupConverter(object):
+    """Converter wrapper that processes each distinct content only once.
+
+    The content of each resource is hashed with SHA-1 before the converter
+    function is called. If a resource with the same digest has already been
+    processed successfully, the converter function is not called; instead
+    ``on_duplicate`` (if it is a function) is called with the name used for
+    that first resource and the name of this one, and its result is returned.
+    Otherwise the resource just counts as successfully processed.
+
+    The number of converter calls and resource bytes saved are added to
+    ``stats`` under the keys "dedup_calls_saved" and "dedup_bytes_saved".
+
+    When converter calls are made on several threads, two resources with the
+    same content that are processed at the same time may both be passed to
+    the converter function.
+
+    A name passed to the converter function again, with other content (for
+    example the same resource name in a later pak file), no longer stands for
+    its earlier content; a later duplicate of that content is processed
+    afresh. The converter call waits for any ``on_duplicate`` calls still
+    using the name.
+
+    :param converter:    converter function to wrap
+    :type converter:     function(bytes,str)
+    :param on_duplicate: function to call for duplicates, or True
+    :type on_duplicate:  function(str,str) or bool
+    :param stream:       whether the converter function is given streams
+    :type stream:        bool
+    :param stats:        dict to which statistics are added, or None
+    :type stats:         dict(str,int) or None
+
+    """
+
+    def __init__(self, converter, on_duplicate, stream=False, stats=None):
+        self.converter = converter
+        self.on_duplicate = on_duplicate
+        self.stream = stream
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # Digest to the name first processed with that content, and back.
+        self.processed = {}
+        self.digests = {}
+        # Number of on_duplicate calls in progress for each first name.
+        self.linking = {}
+
+    def __call__(self, orig_data, name):
+        if self.stream:
+            digest = stream_digest(orig_data)
+            orig_data.seek(0)
+            length = orig_data.length
+        else:
+            digest = hashlib.sha1(orig_data).hexdigest()
+            length = len(orig_data)
+        with self.lock:
+            first_name = self.processed.get(digest)
+            if first_name is not None:
+                add_stats(self.stats, dedup_calls_saved=1,
+                          dedup_bytes_saved=length)
+                self.linking[first_name] = self.linking.get(first_name, 0) + 1
+            else:
+                # The converter may overwrite what it produced for this name
+                # before, so stop offering that as a duplicate.
+                old_digest = self.digests.pop(name, None)
+                if old_digest is not None:
+                    del self.processed[old_digest]
+                while self.linking.get(name):
+                    self.idle.wait()
+        if first_name is not None:
+            try:
+                if callable(self.on_duplicate):
+                    return self.on_duplicate(first_name, name)
+                return True
+            finally:
+                with self.lock:
+                    self.linking[first_name] -= 1
+                    if not self.linking[first_name]:
+                        del self.linking[first_name]
+                        self.idle.notify_all()
+        result = self.converter(orig_data, name)
+        if result:
+            with self.lock:
+                if digest not in self.processed:
+                    old_digest = self.digests.pop(name, None)
+                    if old_digest is not None:
+                        del self.processed[old_digest]
+                    self.processed[digest] = name
+                    self.digests[name] = digest
+        return result
+
+def process_resources(sources, converter, targets=None, use_mmap=False,
+                      stream=False, stats=None, workers=None, processes=None,
+                      concurrency=None, dedup=None, overlay=False,
+                      patterns=None):
+    """Extract and process resources contained in one or more pak files.
+
+    The ``converter`` parameter accepts a function that will be used to process
+    each selected resource that is found in a pak file. This converter function
+    accepts the resource binary content and a name string as arguments. It
+    returns a boolean success status, which indicates whether the resource was
+    processed but does not affect the overall return value of process_resources.
+    The converter function may also raise any exception to stop processing a
+    given resource; this does not immediately interrupt the overall
+    process_resources loop, but will cause process_resources to return False
+    when it finishes.
+
+    The :func:`nop_converter` function in this module is an example of a simple
+    converter function that just writes out the resource content in its original
+    form.
+
+    The selected resources, and the name passed to the converter function for
+    each, depend on the type and content of the ``targets`` argument:
+
+    * None: Every resource in the pak file is selected. The name passed to the
+      converter function is the resource name.
+
+    * set: Resources are selected only if their name is in the set. The name
+      passed to the converter function is the resource name.
+
+    * dict: Resources are selected only if their name is a key in the dict. The
+      name passed to the converter function is the result of looking up the
+      resource name in the dict.
+
+    If the ``targets`` argument is a set or dict, the element corresponding to
+    each found and successfully processed resource is removed from it.
+
+    Resources can also be selected by name patterns, given as a list in the
+    ``patterns`` argument. Each pattern is either a string in the glob syntax
+    of the :mod:`fnmatch` module, where "*" also matches "/" characters (so
+    "sound/*" selects everything under "sound/", and "maps/*.bsp" selects
+    every bsp file under "maps/"), or a compiled regular expression. A
+    resource whose name matches any pattern is handled just as if its name
+    had been in ``targets``, using the resource name as the converter name:
+    it is only processed from the first pak file containing it (unless that
+    fails), and if ``targets`` is a set or dict, matched names that are not
+    successfully processed are added to it. If ``targets`` is None, only the
+    matching resources are selected. Each file table is scanned linearly,
+    checking every name against the patterns, so the cost grows with the
+    size of the table rather than the number of matches;
+    :meth:`PakArchive.match` uses a sorted index instead.
+
+    The selected resources of each pak file are processed in the order that
+    their content appears in the file, rather than the order of the file
+    table, so that the file is read sequentially.
+
+    Normally each pak file is searched in ``sources`` order. A resource in
+    ``targets`` is taken from the first pak file that contains it, and when
+    ``targets`` is None, a resource found in several pak files is processed
+    once from each of them. If ``overlay`` is True, the pak files are instead
+    treated as layers of one file system, the way Quake treats the pak files
+    on its search path: a resource in a later pak file overrides the same
+    name in earlier ones. The file tables are read first, from the last pak
+    file to the first, to resolve each name to the pak file that wins, and
+    then each resource is processed exactly once, from that pak file. If
+    ``targets`` is not None, pak files are not opened at all once every name
+    in it has been resolved. A resource whose winning copy fails to process
+    is left in ``targets``, without trying the copies it overrides.
+
+    If ``workers`` is a number greater than zero, converter function calls are
+    made on a pool of that many threads, while the calling thread continues
+    reading resources from the pak file. This helps when the converter
+    function spends its time waiting on I/O or on other programs. The
+    converter function must then be safe to call from multiple threads at
+    once. The ``targets`` argument, the return value, and error reporting
+    behave just as they do without workers, except that converter calls may
+    happen in any order. (On Python versions before 3.2, this requires the
+    "futures" package; without it, ``workers`` is ignored.)
+
+    For converter functions that are limited by CPU time rather than I/O,
+    ``processes`` can instead be used to specify a number of worker processes
+    to run them on. Each worker process is only sent the location of a
+    resource, and reads the content itself from its own memory map of the pak
+    file, so resource content is never copied between processes. The
+    converter function must be picklable (for example, a function defined at
+    module level), and any other state it relies on is not shared with the
+    calling process. Each worker passes the converter the same kind of data
+    (bytes, memoryview, or stream) as a converter in the calling process
+    would receive. ``workers`` is ignored if ``processes`` is used.
+
+    If multiple pak files are specified and ``concurrency`` is a number
+    greater than one, up to that many pak files are opened and processed at
+    once, which helps when they are on different devices. The outcome is the
+    same as processing them one after another: a resource in ``targets`` is
+    processed from the first pak file (in ``sources`` order) that contains it,
+    and only processed again from a later pak file if that fails. The
+    converter function may be called from several threads at once, but never
+    for the same resource name at the same time. (As with ``workers``, this
+    requires concurrent.futures.)
+
+    If ``dedup`` is True, or a function, the content of each selected
+    resource is hashed, and the converter function is called only once for
+    each distinct content, across all of the pak files. A resource whose
+    content matches an earlier successfully processed resource counts as
+    successfully processed itself. If ``dedup`` is a function, it is called
+    for each such duplicate with two arguments, the name passed to the
+    converter for the earlier resource and the name for this one, and its
+    return value is used as the success status for the duplicate. The
+    converter calls and bytes saved are added to ``stats``. This requires
+    reading each resource before the converter sees it (twice, in streaming
+    mode), so it only pays off when converting is expensive or duplicates
+    are common. ``processes`` is ignored if ``dedup`` is used.
+
+    If ``use_mmap`` is True, each pak file is memory-mapped, and the converter
+    function receives a memoryview of the resource content within the map
+    instead of a bytes object. This avoids copying the content, and lets the
+    OS page cache serve repeated reads of the same pak file. The memoryview is
+    only valid until the converter function returns, at which point it is
+    released; a converter function that needs the content afterward must copy
+    it, for example with ``bytes(orig_data)``.
+
+    If ``stream`` is True, the converter function receives a
+    :class:`ResourceReader` instead of the resource content. This is a
+    read-only, seekable binary stream limited to the byte range of the
+    resource, which reads from the pak file only as the converter asks for
+    data. A converter that reads it in fixed-size chunks can process
+    resources of any size with constant memory use. Like a memoryview, the
+    stream is only valid until the converter function returns.
+
+    If a dict is passed as the ``stats`` argument, statistics about the work
+    done are added to it. Each value is added to any existing value for that
+    key, so the same dict can accumulate statistics over several calls. The
+    keys are:
+
+    * "seek_distance": total number of bytes skipped over or sought
+      backward between reads of resource content.
+
+    * "seek_distance_saved": how many fewer bytes of seeking were needed than
+      if resources had been read in file table order.
+
+    * "reads": number of read operations used to fetch resource content. Not
+      counted in streaming or memory-mapped modes. Nearby resources are
+      fetched with a single read, as controlled by :data:`coalesce_gap` and
+      :data:`coalesce_span`.
+
+    * "bytes_read": number of bytes fetched by those read operations.
+
+    * "dedup_calls_saved": number of converter calls avoided by ``dedup``.
+
+    * "dedup_bytes_saved": number of resource bytes in those calls.
+
+    This function will return True if each specified source is a pak file, is
+    read without I/O errors, and is processed without converter exceptions.
+    False otherwise.
+
+    .. note::
+
+         In the case where ``targets`` is not None, a True result does not
+         indicate that all of the resources in ``targets`` were found and
+         processed. And if False is returned, some processing may have been
+         done. Examining the contents of ``targets`` after the function returns
+         is a good idea.
+
+    :param sources:     file path of the pak file to process, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param converter:   used to process each selected resource, as described
+                        above
+    :type converter:    function(bytes,str)
+    :param targets:     resources to select, as described above; contents may
+                        be modified
+    :type targets:      dict(str,str) or set(str) or None
+    :param use_mmap:    whether to pass memory-mapped resource content to the
+                        converter, as described above
+    :type use_mmap:     bool
+    :param stream:      whether to pass the converter a stream instead of the
+                        resource content, as described above
+    :type stream:       bool
+    :param stats:       dict to which statistics are added, as described above
+    :type stats:        dict(str,int) or None
+    :param workers:     number of threads to run the converter on, as described
+                        above, or None
+    :type workers:      int or None
+    :param processes:   number of processes to run the converter on, as
+                        described above, or None
+    :type processes:    int or None
+    :param concurrency: number of pak files to process at once, as described
+                        above, or None
+    :type concurrency:  int or None
+    :param dedup:       whether to process identical content only once, or a
+                        function to call for duplicates, as described above
+    :type dedup:        bool or function(str,str) or None
+    :param overlay:     whether to give later pak files precedence, as
+                        described above
+    :type overlay:      bool
+    :param patterns:    glob patterns or regular expressions selecting more
+                        resources, as described above, or None
+    :type patterns:     iterable(str or regular expression object) or None
+
+    :returns: True if no IOError exception reading the pak file and no
+              exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    enc_targets = encode_targets(targets)
+    selector = None
+    if patterns:
+        if isinstance(patterns, PatternSelector):
+            selector = patterns
+        else:
+            selector = PatternSelector(patterns)
+        if enc_targets is None:
+            enc_targets = {}
+    if dedup:
+        converter = DedupConverter(converter, dedup, stream=stream,
+                                   stats=stats)
+        processes = None
+    all_success = process_sources(sources, converter, enc_targets,
+                                  use_mmap=use_mmap, stream=stream,
+                                  stats=stats, workers=workers,
+                                  processes=processes, concurrency=concurrency,
+                                  overlay=overlay, selector=selector)
+    update_targets(targets, enc_targets)
+    return all_success
+
+def process_sources(sources, converter, enc_targets, use_mmap=False,
+                    stream=False, stats=None, workers=None, processes=None,
+                    concurrency=None, overlay=False, selector=None,
+                    cancel=None):
+    """Process resources from one or more pak files, with encoded targets.
+
+    Implement :func:`process_resources` once its ``targets`` argument has been
+    encoded with :func:`encode_targets`. The caller is responsible for
+    applying the result to the original targets with :func:`update_targets`.
+    The other arguments are as described for :func:`process_resources`,
+    except ``cancel``, which is passed to :func:`process_entries`.
+
+    :param sources:     file path of the pak file to process, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param converter:   used to process each selected resource
+    :type converter:    function(bytes,str)
+    :param enc_targets: encoded resources to select; contents may be modified
+    :type enc_targets:  dict(bytes,(str,str)) or None
+    :param cancel:      event that stops processing when set, or None
+    :type cancel:       threading.Event or None
+
+    :returns: True if no IOError exception reading the pak file and no
+              exception processing any resource, False otherwise
+    :rtype:   bool
+
+    """
+    all_success = True
+    if is_string(sources):
+        sources = [sources]
+    else:
+        sources = list(sources)
+    use_processes = bool(processes and processes > 0 and futures is not None)
+    max_pending = pending_limit(processes if use_processes else workers)
+    with converter_pool(workers, processes) as executor:
+        if overlay:
+            all_success = process_overlay(
+                sources, converter, enc_targets, concurrency,
+                use_mmap=use_mmap, use_processes=use_processes,
+                selector=selector, stream=stream, stats=stats,
+                executor=executor, max_pending=max_pending, cancel=cancel)
+        elif use_concurrency(concurrency, sources):
+            all_success = process_sources_concurrently(
+                sources, converter, enc_targets, concurrency,
+                use_mmap=use_mmap, use_processes=use_processes,
+                selector=selector, stream=stream, stats=stats,
+                executor=executor, max_pending=max_pending, cancel=cancel)
+        else:
+            for pak_path in sources:
+                if cancel is not None and cancel.is_set():
+                    break
+                success = process_resources_int(
+                    pak_path, converter, enc_targets, use_mmap=use_mmap,
+                    use_processes=use_processes, selector=selector,
+                    stream=stream, stats=stats, executor=executor,
+                    max_pending=max_pending, cancel=cancel)
+                all_success = success and all_success
+    return all_success
+
+def nop_converter(orig_data, name):
+    """Example converter function that writes out the unmodified resource.
+
+    Treat all but the final path segments of the resource as subdirectories, and
     create them as needed. Then write the extracted resource out into the
     bottom subdirectory, using the final path segment of the resource name as
     the output file name.
 
-    In other words, if the ``name`` argument is "sound/hknight/grunt.wav", then:
+    In other words, if the ``name`` argument is "sound/hknight/grunt.wav", then:
+
+    * Ensure that the directory "sound" exists as a subdirectory of the current
+      working directory.
+
+    * Ensure that the directory "hknight" exists as a subdirectory of "sound".
+
+    * Write the resource's contents as "grunt.wav" in that "hknight" directory.
+
+    If ``orig_data`` is a stream (as passed to converters in streaming mode),
+    the content is copied from it in chunks of :const:`COPY_CHUNK_SIZE` bytes,
+    or within the kernel as described for :data:`zero_copy`.
+
+    If the output file already exists and has other hard links (as created by
+    deduplicating extraction), it is replaced rather than overwritten, so the
+    other links keep their content.
+
+    This function will always return True.
+
+    :param orig_data: binary content of the resource, or a stream to read it
+                      from
+    :type orig_data:  bytes or memoryview or ResourceReader
+    :param name:      resource name
+    :type name:       str
+
+    :returns: True
+    :rtype:   bool
+
+    """
+    real_path = output_path(name, create_dirs=True)
+    unshare_file(real_path)
+    with open(real_path, 'wb') as outstream:
+        if isinstance(orig_data, ResourceReader):
+            orig_data.copy_to(outstream)
+        elif hasattr(orig_data, 'readinto'):
+            copy_stream(orig_data, outstream)
+        else:
+            outstream.write(orig_data)
+    return True
+
+def unshare_file(path):
+    """Remove a file if it has other hard links.
+
+    Writing to a hard-linked file would change the content of every link to
+    it. Removing it first lets the caller write a new, unshared file.
+
+    :param path: path of the file
+    :type path:  str
+
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError:
+        pass
+
+def output_path(name, create_dirs=False):
+    """Return the path that :func:`nop_converter` writes a resource to.
+
+    :param name:        resource name
+    :type name:         str
+    :param create_dirs: whether to create the directories of the path
+    :type create_dirs:  bool
+
+    :returns: relative file path
+    :rtype:   str
+
+    """
+    real_path = os.path.join(*name.split("/"))
+    out_dir = os.path.dirname(real_path)
+    if out_dir and create_dirs:
+        try:
+            os.makedirs(out_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return real_path
+
+def copy_stream(instream, outstream, content_hash=None):
+    """Copy the rest of a binary stream to a binary file object.
+
+    Data is copied in chunks of up to :const:`COPY_CHUNK_SIZE` bytes through
+    a single reusable buffer.
+
+    :param instream:     binary stream to read from
+    :type instream:      io.RawIOBase
+    :param outstream:    binary file object to write to
+    :type outstream:     file
+    :param content_hash: hashlib object to update with the copied data, or
+                         None
+    :type content_hash:  object
+
+    """
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = buffer_view(buf)
+    while True:
+        count = instream.readinto(buf)
+        if not count:
+            break
+        if content_hash is not None:
+            content_hash.update(view[:count])
+        outstream.write(view[:count])
+
+def link_resource(first_name, name):
+    """Duplicate handler that reuses an extracted resource's output file.
+
+    Used by :func:`extract_resources` in deduplicating mode, to create the
+    output file for ``name`` (as :func:`nop_converter` would) from the
+    output file already written for ``first_name``, which has the same
+    content. A copy-on-write clone of the file is made if the platform and
+    filesystem support it; otherwise a hard link, or failing that an
+    ordinary copy.
+
+    This function will always return True, or raise an exception.
+
+    :param first_name: resource name whose output file already exists
+    :type first_name:  str
+    :param name:       resource name to create an output file for
+    :type name:        str
+
+    :returns: True
+    :rtype:   bool
+
+    """
+    src_path = output_path(first_name)
+    dst_path = output_path(name, create_dirs=True)
+    if os.path.abspath(src_path) == os.path.abspath(dst_path):
+        return True
+    try:
+        os.remove(dst_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    if reflink_file(src_path, dst_path):
+        return True
+    try:
+        os.link(src_path, dst_path)
+    except (AttributeError, OSError):
+        shutil.copyfile(src_path, dst_path)
+    return True
+
+def reflink_file(src_path, dst_path):
+    """Try to create a copy-on-write clone of a file.
+
+    This uses the FICLONE ioctl, which Linux supports on filesystems such as
+    Btrfs and XFS.
+
+    :param src_path: path of the file to clone
+    :type src_path:  str
+    :param dst_path: path of the clone, which must not exist yet
+    :type dst_path:  str
+
+    :returns: True if the clone was created, False if it's not supported
+    :rtype:   bool
+
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    with open(src_path, 'rb') as instream:
+        with open(dst_path, 'wb') as outstream:
+            try:
+                fcntl.ioctl(outstream.fileno(), FICLONE, instream.fileno())
+                return True
+            except (IOError, OSError):
+                pass
+    os.remove(dst_path)
+    return False
+
+def extract_resources(sources, targets=None, use_mmap=False, stats=None,
+                      workers=None, concurrency=None, incremental=False,
+                      dedup=False, overlay=False, patterns=None):
+    """Extract resources contained in one or more pak files.
+
+    Convenience function for invoking :func:`process_resources` with the
+    :func:`nop_converter` function as the converter argument. Streaming mode
+    is used, so memory use does not depend on the size of the resources.
+    Where the platform allows, resource content is copied from the pak file
+    to the output files within the kernel (see :data:`zero_copy`).
+
+    If ``incremental`` is True, a manifest file named ".expak_manifest" is
+    kept in the current working directory. It records the SHA-1 digest of
+    each extracted resource, along with the size, modification time, and
+    inode of its output file, and the location of the resource in its pak
+    file. A resource is not written again if its output file is unchanged
+    since it was last extracted and has the same content. While a pak file
+    is unchanged, this is decided without reading the resource at all; if a
+    pak file has changed, its resources are read and hashed, but only those
+    whose content differs are written. Resources skipped this way count as
+    successfully extracted. The ``concurrency`` argument is ignored in this
+    mode, and "skipped" and "bytes_skipped" counts are added to ``stats``.
+    When ``targets`` is None, a resource found in several pak files is only
+    extracted from the last of them, whose copy ordinary extraction would
+    leave in place. If :data:`index_cache_dir` is set, resource digests are
+    also shared with the digest cache there (see :func:`verify_pak`), which
+    :func:`update_pak` and :func:`compact_pak` carry over to the pak files
+    they write; only the resources they added then need to be read.
+
+    If ``dedup`` is True, resources with identical content (within or across
+    the pak files) are only written once. The output files for the other
+    resources are created with :func:`link_resource`, as copy-on-write
+    clones or hard links of the first. The number of bytes and converter
+    calls saved are added to ``stats`` as described for
+    :func:`process_resources`. ``dedup`` and ``overlay`` are ignored in
+    incremental mode.
+
+    See :func:`process_resources` for more discussion of the return value
+    and the handling of the ``targets`` argument.
+
+    :param sources:     file path of the pak file to process, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param targets:     resources to select, as described for
+                        :func:`process_resources`; contents may be modified
+    :type targets:      dict(str,str) or set(str) or None
+    :param use_mmap:    whether to memory-map the pak files, as described for
+                        :func:`process_resources`
+    :type use_mmap:     bool
+    :param stats:       dict to which statistics are added, as described for
+                        :func:`process_resources`
+    :type stats:        dict(str,int) or None
+    :param workers:     number of threads to write resources on, as
+                        described for :func:`process_resources`, or None
+    :type workers:      int or None
+    :param concurrency: number of pak files to process at once, as described
+                        for :func:`process_resources`, or None
+    :type concurrency:  int or None
+    :param incremental: whether to skip resources that are already extracted,
+                        as described above
+    :type incremental:  bool
+    :param dedup:       whether to write identical content only once, as
+                        described above
+    :type dedup:        bool
+    :param overlay:     whether to give later pak files precedence, as
+                        described for :func:`process_resources`
+    :type overlay:      bool
+    :param patterns:    glob patterns or regular expressions selecting more
+                        resources, as described for :func:`process_resources`,
+                        or None
+    :type patterns:     iterable(str or regular expression object) or None
+
+    :returns: True if no IOError exception reading the pak file and no
+              exception extracting any resource, False otherwise
+    :rtype:   bool
+
+    """
+    if incremental:
+        return extract_incremental(sources, targets, use_mmap=use_mmap,
+                                   stats=stats, workers=workers,
+                                   patterns=patterns)
+    return process_resources(sources, nop_converter, targets,
+                             use_mmap=use_mmap, stream=True, stats=stats,
+                             workers=workers, concurrency=concurrency,
+                             dedup=link_resource if dedup else None,
+                             overlay=overlay, patterns=patterns)
+
+class ExtractionManifest(object):
+    """Record of extracted resources, used by incremental extraction.
+
+    The manifest remembers the content digest of each output file written,
+    along with the output file's identity (see :func:`stat_identity`) at the
+    time. It also remembers the digest of each resource read from each pak
+    file, keyed by the resource's offset and length, along with the pak
+    file's identity. While a pak file is unchanged, the digests of its
+    resources are therefore known without reading them. When a pak file has
+    changed, any digests for it in the digest cache (see
+    :func:`load_digest_cache`) are used instead.
+
+    The manifest is stored as JSON. A missing or unreadable manifest file is
+    treated as an empty manifest.
+
+    :param path: file path of the manifest file
+    :type path:  str
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.paks = {}
+        self.outputs = {}
+        try:
+            with open(path, 'r') as instream:
+                contents = json.load(instream)
+            if contents.get("version") == MANIFEST_VERSION:
+                self.paks = contents["paks"]
+                self.outputs = contents["outputs"]
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def pak_digests(self, pak_path):
+        """Return the known resource digests for a pak file.
+
+        If the pak file has changed since the digests were recorded, they are
+        replaced by those in the digest cache for the pak file, if any. The
+        returned dict is updated as new digests are recorded.
+
+        :param pak_path: file path of the pak file
+        :type pak_path:  str
+
+        :returns: dict mapping "offset:length" keys to hex digests
+        :rtype:   dict(str,str)
+
+        """
+        pak_path = os.path.abspath(pak_path)
+        try:
+            identity = list(stat_identity(os.stat(pak_path)))
+        except OSError:
+            identity = None
+        with self.lock:
+            record = self.paks.get(pak_path)
+            if record is not None and record["identity"] == identity:
+                return record["digests"]
+        digests = {}
+        if identity is not None:
+            try:
+                with open(pak_path, 'rb') as instream:
+                    digests = dict(load_digest_cache(instream))
+            except IOError:
+                pass
+        with self.lock:
+            record = {"identity": identity, "digests": digests}
+            self.paks[pak_path] = record
+            return record["digests"]
+
+    def cache_digests(self, pak_path):
+        """Add the recorded resource digests for a pak file to its digest cache.
+
+        Nothing is done if :data:`index_cache_dir` is None, or if the pak file
+        has changed since the digests were recorded.
+
+        :param pak_path: file path of the pak file
+        :type pak_path:  str
+
+        """
+        if index_cache_dir is None:
+            return
+        pak_path = os.path.abspath(pak_path)
+        with self.lock:
+            record = self.paks.get(pak_path)
+            if record is None:
+                return
+            digests = dict(record["digests"])
+        try:
+            with open(pak_path, 'rb') as instream:
+                if list(pak_identity(instream)) != record["identity"]:
+                    return
+                cached = load_digest_cache(instream)
+                if all(cached.get(k) == digests[k] for k in digests):
+                    return
+                cached.update(digests)
+                save_digest_cache(instream, cached)
+        except IOError:
+            pass
+
+    def output_matches(self, name, digest):
+        """Return whether an output file is unchanged and has this content.
+
+        :param name: name the resource was extracted under
+        :type name:  str
+        :param digest: hex digest of the resource content
+        :type digest:  str
+
+        :returns: True if the recorded output has the same digest, and the
+                  output file's identity hasn't changed since
+        :rtype:   bool
+
+        """
+        with self.lock:
+            record = self.outputs.get(name)
+        if record is None or record["digest"] != digest:
+            return False
+        try:
+            identity = list(stat_identity(os.stat(output_path(name))))
+        except OSError:
+            return False
+        return identity == record["identity"]
+
+    def has_output(self, name):
+        with self.lock:
+            return name in self.outputs
+
+    def forget_output(self, name):
+        with self.lock:
+            self.outputs.pop(name, None)
+
+    def record_output(self, name, digest):
+        """Record that an output file was written with the given content.
+
+        :param name: name the resource was extracted under
+        :type name:  str
+        :param digest: hex digest of the resource content
+        :type digest:  str
+
+        """
+        identity = list(stat_identity(os.stat(output_path(name))))
+        with self.lock:
+            self.outputs[name] = {"identity": identity, "digest": digest}
+
+    def save(self):
+        """Write the manifest file.
+
+        The file is written under a temporary name and then moved into place,
+        so an interrupted save leaves the previous manifest intact. Failure
+        to write the manifest is reported (if :data:`print_err` is set) but
+        is not otherwise an error; the next extraction will just do more
+        work.
+
+        """
+        contents = {"version": MANIFEST_VERSION,
+                    "paks": self.paks,
+                    "outputs": self.outputs}
+        out_dir = os.path.dirname(os.path.abspath(self.path))
+        try:
+            (fd, temp_path) = tempfile.mkstemp(dir=out_dir)
+            try:
+                with os.fdopen(fd, 'w') as outstream:
+                    json.dump(contents, outstream)
+                replace_file(temp_path, self.path)
+            except:
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError):
+            if print_err:
+                sys.stderr.write(
+                    "{0!r} exception writing manifest {1}\n".format(
+                        sys.exc_info()[1], self.path))
+
+def incremental_converter(manifest, pak_path, stats=None):
+    """Return a converter function for incremental extraction from a pak file.
+
+    The converter expects to be used in streaming mode. A resource whose
+    content digest matches the recorded digest of its unchanged output file
+    is skipped. The digest is looked up in ``manifest`` if the pak file is
+    unchanged; otherwise, if there is an output to compare against, the
+    resource is read to compute it. Any other resource is extracted as by
+    :func:`nop_converter`, and recorded in the manifest.
+
+    :param manifest: manifest of previously extracted resources
+    :type manifest:  ExtractionManifest
+    :param pak_path: file path of the pak file the resources come from
+    :type pak_path:  str
+    :param stats:    dict to which "skipped" and "bytes_skipped" counts are
+                     added, or None
+    :type stats:     dict(str,int) or None
+
+    :returns: converter function
+    :rtype:   function(ResourceReader,str)
+
+    """
+    digests = manifest.pak_digests(pak_path)
+    def converter(orig_data, name):
+        key = "{0}:{1}".format(orig_data.offset, orig_data.length)
+        with manifest.lock:
+            digest = digests.get(key)
+        if digest is None and manifest.has_output(name):
+            digest = stream_digest(orig_data)
+            orig_data.seek(0)
+            with manifest.lock:
+                digests[key] = digest
+        if digest is not None and manifest.output_matches(name, digest):
+            with manifest.lock:
+                add_stats(stats, skipped=1, bytes_skipped=orig_data.length)
+            return True
+        manifest.forget_output(name)
+        if digest is None:
+            content_hash = hashlib.sha1()
+            real_path = output_path(name, create_dirs=True)
+            unshare_file(real_path)
+            with open(real_path, 'wb') as outstream:
+                copy_stream(orig_data, outstream, content_hash)
+            digest = content_hash.hexdigest()
+            with manifest.lock:
+                digests[key] = digest
+        else:
+            nop_converter(orig_data, name)
+        manifest.record_output(name, digest)
+        return True
+    return converter
+
+def stream_digest(instream):
+    """Return the hex SHA-1 digest of the rest of a binary stream.
+
+    :param instream: binary stream to read from
+    :type instream:  io.RawIOBase
+
+    :returns: hex digest
+    :rtype:   str
+
+    """
+    content_hash = hashlib.sha1()
+    buf = bytearray(COPY_CHUNK_SIZE)
+    view = buffer_view(buf)
+    while True:
+        count = instream.readinto(buf)
+        if not count:
+            break
+        content_hash.update(view[:count])
+    return content_hash.hexdigest()
+
+def extract_incremental(sources, targets=None, use_mmap=False, stats=None,
+                        workers=None, patterns=None):
+    """Extract resources, skipping those whose outputs are already up to date.
+
+    Implement the incremental mode of :func:`extract_resources`. The pak
+    files are processed one at a time, each with its own
+    :func:`incremental_converter`, and the manifest is saved at the end.
+    Without ``targets`` or ``patterns``, each pak file is only asked for the
+    resources that no later pak file contains.
+
+    :param sources:  file path of the pak file to process, or an iterable
+                     specifying multiple such paths
+    :type sources:   str or iterable(str)
+    :param targets:  resources to select, as described for
+                     :func:`process_resources`; contents may be modified
+    :type targets:   dict(str,str) or set(str) or None
+    :param use_mmap: whether to memory-map the pak files
+    :type use_mmap:  bool
+    :param stats:    dict to which statistics are added, or None
+    :type stats:     dict(str,int) or None
+    :param workers:  number of threads to write resources on, or None
+    :type workers:   int or None
+    :param patterns: glob patterns or regular expressions selecting more
+                     resources, or None
+    :type patterns:  iterable(str or regular expression object) or None
+
+    :returns: True if no IOError exception reading the pak file and no
+              exception extracting any resource, False otherwise
+    :rtype:   bool
+
+    """
+    if is_string(sources):
+        sources = [sources]
+    if patterns:
+        # Share one selector across the pak files, and collect unprocessed
+        # matches in a targets set, as a single process_resources call would.
+        if not isinstance(patterns, PatternSelector):
+            patterns = PatternSelector(patterns)
+        if targets is None:
+            targets = set()
+    all_success = True
+    if targets is None:
+        # Ordinary extraction writes every copy of a name in turn, leaving the
+        # one from the last pak file. Select just that copy, so that an
+        # earlier copy doesn't overwrite it on every run.
+        sources = list(sources)
+        pak_targets = [None] * len(sources)
+        claimed = set()
+        for index in reversed(range(len(sources))):
+            names = resource_names_int(sources[index])
+            if names is None:
+                all_success = False
+                continue
+            pak_targets[index] = names.difference(claimed)
+            claimed.update(names)
+    else:
+        pak_targets = [targets] * len(sources)
+    manifest = ExtractionManifest(MANIFEST_FILE_NAME)
+    try:
+        for (pak_path, selected) in zip(sources, pak_targets):
+            if selected is None:
+                continue
+            converter = incremental_converter(manifest, pak_path, stats)
+            success = process_resources(pak_path, converter, selected,
+                                        use_mmap=use_mmap, stream=True,
+                                        stats=stats, workers=workers,
+                                        patterns=patterns)
+            all_success = success and all_success
+            manifest.cache_digests(pak_path)
+    finally:
+        manifest.save()
+    return all_success
+
+def resource_names_int(pak_path):
+    """Return the name of every resource in a pak file.
+
+    Implement :func:`resource_names` for a single pak file.
+
+    :param pak_path: file path of the pak file to read
+    :type pak_path:  str
+
+    :returns: set of resource name strings if no read errors, None otherwise
+    :rtype:   set(str) or None
+
+    """
+    try:
+        with open(pak_path, 'rb') as instream:
+            target_info = get_target_info(instream, None)
+            if target_info is None:
+                if print_err:
+                    sys.stderr.write("{0} is not a pak file\n".format(pak_path))
+                return None
+        # 2.6 COMPAT: "set comprehension" syntax
+        return set(t[0].decode() for t in target_info)
+    except IOError:
+        if print_err:
+            sys.stderr.write("{0!r} exception reading pak {1}\n".format(
+                sys.exc_info()[1], pak_path))
+        return None
+
+def iter_entries(sources):
+    """Generate a description of every resource in one or more pak files.
+
+    Yield a :class:`ResourceEntry` (name, offset, length, and source pak file
+    path) for each entry of each pak file's table, in table order and
+    ``sources`` order. Unlike :func:`resource_names`, nothing is collected:
+    each table is read in chunks by :func:`stream_filetable` as the entries
+    are consumed, so memory use is constant, and a caller that stops early
+    doesn't read the rest of the table. Each pak file is closed once its
+    entries are exhausted or the generator is closed.
+
+    An IOError is raised (when the iteration reaches it) if a pak file can't
+    be read or is not a pak file.
+
+    Example of totalling the size of the sounds in some pak files:
+
+    .. code-block:: python
+
+        sound_bytes = sum(e.length for e in expak.iter_entries(sources)
+                          if e.name.startswith("sound/"))
+
+    :param sources: file path of the pak file to read, or an iterable
+                    specifying multiple such paths
+    :type sources:  str or iterable(str)
+
+    :returns: generator of resource descriptions
+    :rtype:   generator(ResourceEntry)
+
+    """
+    if is_string(sources):
+        sources = [sources]
+    for pak_path in sources:
+        with open(pak_path, 'rb') as instream:
+            header = read_header(instream)
+            if header is None:
+                raise IOError(errno.EINVAL,
+                              "{0} is not a pak file".format(pak_path))
+            for (file_name, file_off, file_len) in stream_filetable(instream,
+                                                                    header):
+                yield ResourceEntry(file_name.decode('latin-1'), file_off,
+                                    file_len, pak_path)
+
+def resource_names(sources, concurrency=None):
+    """Return the name of every resource in one or more pak files.
+
+    Return a set of resource name strings collected from all of the given pak
+    files, if each specified file is a pak file and is read without I/O errors.
+    Otherwise return None.
+
+    If multiple pak files are specified and ``concurrency`` is a number
+    greater than one, up to that many pak files are read at once (as
+    described for :func:`process_resources`).
+
+    :param sources:     file path of the pak file to read, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param concurrency: number of pak files to read at once, or None
+    :type concurrency:  int or None
+
+    :returns: set of resource name strings if no read errors, None otherwise
+    :rtype:   set(str) or None
+
+    """
+    # Handle single-string input for the sources argument.
+    if is_string(sources):
+        return resource_names_int(sources)
+    # Handle iterable input for the sources argument.
+    sources = list(sources)
+    if use_concurrency(concurrency, sources):
+        pool = futures.ThreadPoolExecutor(concurrency)
+        try:
+            results = list(pool.map(resource_names_int, sources))
+        finally:
+            pool.shutdown()
+    else:
+        results = []
+        for pak_path in sources:
+            resources = resource_names_int(pak_path)
+            if resources is None:
+                return None
+            results.append(resources)
+    all_resources = set()
+    for resources in results:
+        if resources is None:
+            return None
+        all_resources.update(resources)
+    return all_resources
+
+def running_loop():
+    """Return the event loop running in the current thread.
+
+    A RuntimeError is raised if there is none.
+
+    :returns: the running event loop
+    :rtype:   asyncio.AbstractEventLoop
+
+    """
+    # 3.6 COMPAT: no get_running_loop, but get_event_loop returns the running
+    # loop when called from a coroutine or callback.
+    get_running_loop = getattr(asyncio, 'get_running_loop', None)
+    if get_running_loop is None:
+        return asyncio.get_event_loop()
+    return get_running_loop()
+
+def loop_converter(converter, loop):
+    """Wrap a converter function so that it may be a coroutine function.
+
+    The returned function is called on a worker thread like any other
+    converter. If the wrapped converter returns a coroutine, it is run on the
+    event loop ``loop`` and the worker thread waits for its result.
+
+    :param converter: converter function or coroutine function
+    :type converter:  function(bytes,str)
+    :param loop:      event loop to run coroutines on
+    :type loop:       asyncio.AbstractEventLoop
+
+    :returns: converter function
+    :rtype:   function(bytes,str)
+
+    """
+    def run_converter(orig_data, name):
+        result = converter(orig_data, name)
+        if asyncio.iscoroutine(result):
+            result = asyncio.run_coroutine_threadsafe(result, loop).result()
+        return result
+    return run_converter
+
+def aprocess_resources(sources, converter, targets=None, use_mmap=False,
+                       stream=False, stats=None, workers=None,
+                       concurrency=None, loop=None):
+    """Extract and process resources without blocking an asyncio event loop.
+
+    Asynchronous counterpart of :func:`process_resources`, for programs built
+    around :mod:`asyncio`. Return an :class:`asyncio.Future` which, when
+    awaited, gives the result that :func:`process_resources` would return.
+    The pak files are read, and converter functions called, on threads
+    outside the event loop.
+
+    The ``converter`` argument may be an ordinary converter function or a
+    coroutine function (defined with ``async def``). Coroutines are run on
+    the event loop, and a resource's content (or stream, in streaming mode)
+    remains valid until its coroutine finishes. Note that reading a stream
+    from a coroutine reads the pak file on the event loop thread.
+
+    ``workers`` limits how many converter calls may be in progress at once;
+    by default there is only one. Each call in progress occupies one worker
+    thread, even while its coroutine is waiting. ``processes`` is not
+    supported, since coroutines can't be run in other processes.
+
+    The ``targets`` argument is modified just as it would be by
+    :func:`process_resources`. This happens on the event loop thread, after
+    the pak files have been processed and before the returned future
+    completes.
+
+    Cancelling the returned future stops the reading of further resources.
+    Converter calls already in progress are allowed to finish, and their
+    outcome is still recorded in ``targets``.
+
+    This requires Python 3.5.2 or later.
+
+    :param sources:     file path of the pak file to process, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param converter:   used to process each selected resource, as described
+                        above
+    :type converter:    function(bytes,str) or coroutine function
+    :param targets:     resources to select, as described for
+                        :func:`process_resources`; contents may be modified
+    :type targets:      dict(str,str) or set(str) or None
+    :param use_mmap:    whether to memory-map the pak files, as described for
+                        :func:`process_resources`
+    :type use_mmap:     bool
+    :param stream:      whether to pass the converter a stream, as described
+                        for :func:`process_resources`
+    :type stream:       bool
+    :param stats:       dict to which statistics are added, as described for
+                        :func:`process_resources`
+    :type stats:        dict(str,int) or None
+    :param workers:     number of converter calls that may be in progress at
+                        once, as described above, or None
+    :type workers:      int or None
+    :param concurrency: number of pak files to process at once, as described
+                        for :func:`process_resources`, or None
+    :type concurrency:  int or None
+    :param loop:        event loop to use, or None for the running event loop
+    :type loop:         asyncio.AbstractEventLoop or None
+
+    :returns: future giving True if no IOError exception reading the pak file
+              and no exception processing any resource, False otherwise
+    :rtype:   asyncio.Future
+
+    """
+    if loop is None:
+        loop = running_loop()
+    enc_targets = encode_targets(targets)
+    cancel = threading.Event()
+    def run():
+        return process_sources(sources, loop_converter(converter, loop),
+                               enc_targets, use_mmap=use_mmap, stream=stream,
+                               stats=stats, workers=workers,
+                               concurrency=concurrency, cancel=cancel)
+    result = loop.create_future()
+    def stop(result):
+        if result.cancelled():
+            cancel.set()
+    result.add_done_callback(stop)
+    def finish(work):
+        update_targets(targets, enc_targets)
+        if result.cancelled():
+            return
+        if work.cancelled():
+            result.cancel()
+        elif work.exception() is not None:
+            result.set_exception(work.exception())
+        else:
+            result.set_result(work.result())
+    loop.run_in_executor(None, run).add_done_callback(finish)
+    return result
+
+class AsyncResourceIterator(object):
+    """Asynchronous iterator over the content of selected resources.
+
+    Returned by :func:`aiter_resources`; see that function for details.
+
+    Resources are read by :func:`aprocess_resources`, with a converter
+    function that hands each resource over to the event loop and then blocks
+    until the consumer has taken it (or the iterator is closed or garbage
+    collected). A resource counts as successfully processed once it has been
+    taken.
+
+    """
+
+    def __init__(self, sources, targets, use_mmap, prefetch, concurrency,
+                 loop):
+        self.loop = loop
+        self.ready = collections.deque()
+        self.waiter = None
+        # Set once the iterator is closed or garbage collected. The worker
+        # threads only hold a weak reference to the iterator, so that one
+        # abandoned without aclose can still be collected.
+        self.closed = threading.Event()
+        closed = self.closed
+        ref = weakref.ref(self)
+        def deliver(handoff):
+            iterator = ref()
+            if iterator is None:
+                handoff[2].set()
+            else:
+                iterator.put(handoff)
+        def hand_over(orig_data, name):
+            # Runs on a worker thread.
+            if closed.is_set():
+                return False
+            handoff = (name, bytes(orig_data), threading.Event(), [])
+            try:
+                loop.call_soon_threadsafe(deliver, handoff)
+            except RuntimeError:
+                # The event loop has been closed.
+                return False
+            while not handoff[2].wait(HANDOFF_POLL_INTERVAL):
+                if closed.is_set() or loop.is_closed():
+                    break
+            return bool(handoff[3])
+        def finished(done):
+            iterator = ref()
+            if iterator is not None:
+                iterator.finished(done)
+        self.done = aprocess_resources(
+            sources, hand_over, targets, use_mmap=use_mmap,
+            workers=prefetch if prefetch and prefetch > 1 else None,
+            concurrency=concurrency, loop=loop)
+        self.done.add_done_callback(finished)
+
+    def __del__(self):
+        # Abandoned without aclose: release any waiting worker threads, and
+        # stop reading.
+        self.closed.set()
+        while self.ready:
+            self.release(self.ready.popleft(), False)
+        done = getattr(self, 'done', None)
+        if done is not None:
+            try:
+                self.loop.call_soon_threadsafe(done.cancel)
+            except RuntimeError:
+                # The event loop has been closed.
+                pass
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        next_item = self.loop.create_future()
+        if self.ready:
+            self.take(next_item, self.ready.popleft())
+        elif self.done.done() or self.closed.is_set():
+            self.stop(next_item)
+        else:
+            self.waiter = next_item
+        return next_item
+
+    def aclose(self):
+        """Stop iterating and release any resources read ahead.
+
+        Resources that have not been taken are left in ``targets``. This
+        should be called if iteration is abandoned before the end; otherwise
+        reading only stops once the iterator is garbage collected.
+
+        :returns: future giving the same result as :func:`aprocess_resources`
+                  once reading has stopped
+        :rtype:   asyncio.Future
+
+        """
+        self.closed.set()
+        while self.ready:
+            self.release(self.ready.popleft(), False)
+        if self.waiter is not None and not self.waiter.done():
+            self.stop(self.waiter)
+        self.waiter = None
+        return self.done
+
+    def put(self, handoff):
+        waiter = self.waiter
+        self.waiter = None
+        if self.closed.is_set():
+            self.release(handoff, False)
+        elif waiter is not None and not waiter.done():
+            self.take(waiter, handoff)
+        else:
+            self.ready.append(handoff)
+
+    def take(self, next_item, handoff):
+        (name, data) = handoff[:2]
+        self.release(handoff, True)
+        next_item.set_result((name, data))
+
+    def release(self, handoff, taken):
+        if taken:
+            handoff[3].append(True)
+        handoff[2].set()
+
+    def stop(self, next_item):
+        if self.done.done() and not self.done.cancelled():
+            exc = self.done.exception()
+            if exc is not None:
+                next_item.set_exception(exc)
+                return
+        next_item.set_exception(StopAsyncIteration())
+
+    def finished(self, done):
+        waiter = self.waiter
+        self.waiter = None
+        if waiter is not None and not waiter.done():
+            self.stop(waiter)
+
+def aiter_resources(sources, targets=None, use_mmap=False, prefetch=1,
+                    concurrency=None, loop=None):
+    """Asynchronously iterate over the content of resources in pak files.
+
+    Return an asynchronous iterator, for use with ``async for``, which yields
+    a (name, data) tuple for each selected resource: the name that would be
+    passed to a converter function by :func:`process_resources`, and the
+    resource content as bytes. The pak files are read on threads outside the
+    event loop.
+
+    ``prefetch`` is the number of resources that may be read ahead of the
+    consumer. With the default of 1, resources are yielded in the order
+    described for :func:`process_resources`; with more, the order of nearby
+    resources may vary.
+
+    The ``targets`` argument is modified just as it would be by
+    :func:`process_resources`, with each yielded resource counting as
+    successfully processed. This happens once iteration has finished.
+
+    If iteration is abandoned early, the iterator's ``aclose`` method should
+    be awaited to stop reading; otherwise reading stops when the iterator is
+    garbage collected. Resources that were not yielded remain in ``targets``.
+
+    This requires Python 3.5.2 or later.
+
+    :param sources:     file path of the pak file to read, or an iterable
+                        specifying multiple such paths
+    :type sources:      str or iterable(str)
+    :param targets:     resources to select, as described for
+                        :func:`process_resources`; contents may be modified
+    :type targets:      dict(str,str) or set(str) or None
+    :param use_mmap:    whether to memory-map the pak files, as described for
+                        :func:`process_resources`
+    :type use_mmap:     bool
+    :param prefetch:    number of resources to read ahead, as described above
+    :type prefetch:     int
+    :param concurrency: number of pak files to read at once, as described
+                        for :func:`process_resources`, or None
+    :type concurrency:  int or None
+    :param loop:        event loop to use, or None for the running event loop
+    :type loop:         asyncio.AbstractEventLoop or None
+
+    :returns: asynchronous iterator of (name, content) tuples
+    :rtype:   AsyncResourceIterator
+
+    """
+    if loop is None:
+        loop = running_loop()
+    return AsyncResourceIterator(sources, targets, use_mmap, prefetch,
+                                 concurrency, loop)
+
+class PakArchive(object):
+    """A pak file opened for repeated access to its resources.
+
+    The pak file is opened, and its file table read, once when the object is
+    constructed. The file stays open until :meth:`close` is called (or the
+    ``with`` block ends, if the object is used as a context manager), and
+    resources can be looked up by name and read without parsing the file
+    table again. This suits long-running programs that need resources from
+    the same pak file many times.
+
+    An IOError is raised if the file can't be read or is not a pak file.
+
+    If ``use_mmap`` is True, the pak file is memory-mapped. :meth:`read` then
+    returns a memoryview into the map rather than a copy of the resource
+    content; such views are valid only until the object is closed. Converter
+    functions used with :meth:`process` receive views as described for
+    :func:`process_resources`.
+
+    Resource names can also be browsed as a directory tree, with
+    :meth:`listdir`, :meth:`walk`, and :meth:`stat`.
+
+    Example of reading resources from an open pak file:
+
+    .. code-block:: python
+
+        with expak.PakArchive("pak0.pak") as pak:
+            if "gfx/palette.lmp" in pak.names():
+                palette = pak.read("gfx/palette.lmp")
+            pak.process(my_converter, set(["maps/e1m1.bsp"]))
+
+    :param pak_path: file path of the pak file to open
+    :type pak_path:  str
+    :param use_mmap: whether to memory-map the pak file
+    :type use_mmap:  bool
+
+    """
+
+    def __init__(self, pak_path, use_mmap=False):
+        self.path = pak_path
+        self.instream = open(pak_path, 'rb')
+        try:
+            self.table = get_target_info(self.instream, None)
+            if self.table is None:
+                raise IOError(errno.EINVAL,
+                              "{0} is not a pak file".format(pak_path))
+            if use_mmap:
+                self.pak_data = PakMapping(self.instream)
+            else:
+                self.pak_data = PakStream(self.instream)
+        except:
+            self.instream.close()
+            raise
+        # Where a name appears more than once in the file table, the first
+        # entry wins, as in Quake.
+        # 2.6 COMPAT: "dict comprehension" syntax
+        self.index = dict([(t[0], (t[1], t[2]))
+                           for t in reversed(self.table)])
+        self.name_set = None
+        self.name_index = None
+        self.dir_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the pak file.
+
+        """
+        self.pak_data.close()
+        self.instream.close()
+
+    def names(self):
+        """Return the name of every resource in the pak file.
+
+        The set is built on the first call and shared by later calls.
+
+        :returns: set of resource name strings
+        :rtype:   frozenset(str)
+
+        """
+        if self.name_set is None:
+            # 2.6 COMPAT: "set comprehension" syntax
+            self.name_set = frozenset(n.decode() for n in self.index)
+        return self.name_set
+
+    def match(self, pattern):
+        """Return the names of the resources that match a pattern.
+
+        The pattern is interpreted as described for the ``patterns`` argument
+        of :func:`process_resources`. The sorted name index used for the
+        lookup is built on first use and kept for later calls.
+
+        :param pattern: glob pattern or compiled regular expression
+        :type pattern:  str or regular expression object
+
+        :returns: matching resource names, in sorted order
+        :rtype:   list(str)
+
+        """
+        if self.name_index is None:
+            self.name_index = NameIndex(self.index)
+        return [n.decode('latin-1') for n in self.name_index.match(pattern)]
+
+    def listdir(self, path=""):
+        """Return the entries of a directory in the pak file's namespace.
+
+        Resource names are treated as paths, with "/" separating directory
+        levels, so that for instance "sound/misc/basekey.wav" is in the
+        directory "sound/misc". The top level is the empty path. Listings are
+        found with the sorted name index used by :meth:`match`, without
+        examining resources outside the directory, and are kept for later
+        calls.
+
+        A KeyError is raised if there is no such directory.
+
+        :param path: directory path, with or without a trailing "/"
+        :type path:  str
+
+        :returns: names of the subdirectories and resources in the directory,
+                  in sorted order
+        :rtype:   list(str)
+
+        """
+        (dirs, files) = self.list_entries(path)
+        return sorted(dirs + files)
+
+    def list_entries(self, path):
+        """Return the subdirectory and resource names in a directory.
+
+        Implement :meth:`listdir` and :meth:`walk`.
+
+        :param path: directory path
+        :type path:  str
+
+        :returns: subdirectory names and resource names
+        :rtype:   tuple(list(str),list(str))
+
+        """
+        path = path.strip("/")
+        listing = self.dir_cache.get(path)
+        if listing is None:
+            if self.name_index is None:
+                self.name_index = NameIndex(self.index)
+            prefix = encode_name(path + "/") if path else b""
+            children = self.name_index.children(prefix)
+            if children is None:
+                raise KeyError(path)
+            listing = ([n.decode('latin-1') for n in children[0]],
+                       [n.decode('latin-1') for n in children[1]])
+            self.dir_cache[path] = listing
+        return listing
+
+    def walk(self, top=""):
+        """Generate the directory tree of the pak file's namespace.
+
+        Like os.walk (top-down), yield a (dirpath, dirnames, filenames) tuple
+        for ``top`` and each directory below it, where dirpath is a path as
+        accepted by :meth:`listdir`. Directories are only listed as the
+        generator reaches them. Removing names from dirnames prevents the
+        walk from descending into those directories.
+
+        A KeyError is raised if ``top`` is not a directory.
+
+        :param top: path of the directory to start at
+        :type top:  str
+
+        :returns: generator of (dirpath, dirnames, filenames) tuples
+        :rtype:   generator(tuple(str,list(str),list(str)))
+
+        """
+        top = top.strip("/")
+        (dirs, files) = self.list_entries(top)
+        dirs = list(dirs)
+        yield (top, dirs, list(files))
+        for d in dirs:
+            for entry in self.walk(top + "/" + d if top else d):
+                yield entry
+
+    def stat(self, path):
+        """Return information about a resource or directory.
+
+        For a resource this is the same as :meth:`info`. For a directory, the
+        result has None for its offset and length.
+
+        A KeyError is raised if there is no resource or directory at ``path``.
+
+        :param path: resource name or directory path
+        :type path:  str
+
+        :returns: description of the resource or directory
+        :rtype:   ResourceEntry
+
+        """
+        file_name = encode_name(path)
+        if file_name in self.index:
+            return self.info(path)
+        path = path.strip("/")
+        self.list_entries(path)
+        return ResourceEntry(path, None, None, self.path)
+
+    def info(self, name):
+        """Return the location of a resource's content in the pak file.
+
+        A KeyError is raised if the pak file has no resource with that name.
+
+        :param name: resource name
+        :type name:  str
+
+        :returns: description of the resource
+        :rtype:   ResourceEntry
+
+        """
+        (file_off, file_len) = self.index[encode_name(name)]
+        return ResourceEntry(name, file_off, file_len, self.path)
+
+    def read(self, name):
+        """Return the content of a resource.
+
+        A KeyError is raised if the pak file has no resource with that name,
+        or an IOError if its content can't be read. Unless the pak file is
+        memory-mapped, the content is looked up in and added to
+        :data:`resource_cache`, if set.
+
+        :param name: resource name
+        :type name:  str
+
+        :returns: binary content of the resource
+        :rtype:   bytes or memoryview
+
+        """
+        file_name = encode_name(name)
+        (file_off, file_len) = self.index[file_name]
+        cache = resource_cache
+        key = cache_key(self.pak_data, (file_name, file_off, file_len))
+        if cache is None or key is None:
+            return self.read_range(file_off, file_len)
+        data = cache.get(key)
+        if data is None:
+            data = self.read_range(file_off, file_len)
+            cache.put(key, data)
+        return data
+
+    def open(self, name):
+        """Return a stream for reading the content of a resource.
+
+        A KeyError is raised if the pak file has no resource with that name.
+        The stream may be used until this object is closed.
+
+        :param name: resource name
+        :type name:  str
+
+        :returns: read-only stream limited to the resource content
+        :rtype:   ResourceReader
+
+        """
+        (file_off, file_len) = self.index[encode_name(name)]
+        return ResourceReader(self.pak_data, file_off, file_len)
+
+    def read_range(self, offset, length):
+        """Return a range of bytes from the pak file.
+
+        This may be safely called from multiple threads. An IOError is raised
+        if the pak file ends before the end of the range.
+
+        :param offset: position in the pak file of the first byte to read
+        :type offset:  int
+        :param length: number of bytes to read
+        :type length:  int
+
+        :returns: the bytes read
+        :rtype:   bytes or memoryview
+
+        """
+        return self.pak_data.read_range(offset, length)
+
+    def process(self, converter, targets=None, stream=False, stats=None,
+                workers=None):
+        """Process resources contained in the pak file.
+
+        This works like :func:`process_resources` for this pak file, including
+        the meaning of the return value and the handling of the ``targets``,
+        ``stream``, ``stats``, and ``workers`` arguments, but uses the file
+        table that was read when this object was created.
+
+        :param converter: used to process each selected resource, as described
+                          for :func:`process_resources`
+        :type converter:  function(bytes,str)
+        :param targets:   resources to select, as described for
+                          :func:`process_resources`; contents may be modified
+        :type targets:    dict(str,str) or set(str) or None
+        :param stream:    whether to pass the converter a stream, as described
+                          for :func:`process_resources`
+        :type stream:     bool
+        :param stats:     dict to which statistics are added, as described for
+                          :func:`process_resources`
+        :type stats:      dict(str,int) or None
+        :param workers:   number of threads to run the converter on, as
+                          described for :func:`process_resources`, or None
+        :type workers:    int or None
+
+        :returns: True if no IOError exception reading the pak file and no
+                  exception processing any resource, False otherwise
+        :rtype:   bool
+
+        """
+        enc_targets = encode_targets(targets)
+        target_info = select_entries(self.table, enc_targets)
+        try:
+            with converter_pool(workers) as executor:
+                success = process_entries(self.pak_data, target_info,
+                                          converter, enc_targets,
+                                          stream=stream, stats=stats,
+                                          executor=executor,
+                                          max_pending=pending_limit(workers))
+        except IOError:
+            if print_err:
+                sys.stderr.write("{0!r} exception reading pak {1}\n".format(
+                    sys.exc_info()[1], self.path))
+            success = False
+        update_targets(targets, enc_targets)
+        return success
+
+class PakServer(object):
+    """HTTP server for the resources of pak files, running on asyncio.
+
+    The pak files are opened as :class:`PakArchive` objects when the server
+    is constructed, and stay open until :meth:`close` is called. A request
+    path (with percent-escapes decoded and any leading "/" removed) is looked
+    up as a resource name in the file tables. As in overlay mode (see
+    :func:`process_resources`), a resource in a later pak file of
+    ``sources`` hides one of the same name in an earlier pak file.
+
+    GET and HEAD requests are supported, with persistent connections.
+    Resource content is sent from the pak file to the socket with sendfile
+    where the event loop and platform support it (and :data:`zero_copy` is
+    set), and otherwise in chunks, pausing while the client catches up.
+    Responses carry a strong ETag derived from the pak file's identity (see
+    :func:`pak_identity`) and the resource's location, and a Last-Modified
+    time from the pak file. Requests with If-Match, If-None-Match,
+    If-Modified-Since, Range (a single byte range), and If-Range headers are
+    answered accordingly.
+
+    An IOError is raised if any pak file can't be read or is not a pak file.
+
+    Example of serving pak files on a local port until interrupted:
+
+    .. code-block:: python
+
+        loop = asyncio.new_event_loop()
+        server = expak.PakServer(["pak0.pak", "pak1.pak"], loop=loop)
+        loop.run_until_complete(server.start("127.0.0.1", 8000))
+        loop.run_forever()
+
+    :param sources: file path of a pak file, or an iterable of them
+    :type sources:  str or iterable(str)
+    :param loop:    event loop to use, or None for the running event loop
+    :type loop:     asyncio.AbstractEventLoop or None
+
+    """
+
+    def __init__(self, sources, loop=None):
+        if is_string(sources):
+            sources = [sources]
+        if loop is None:
+            loop = running_loop()
+        self.loop = loop
+        self.archives = []
+        self.resources = {}
+        try:
+            for pak_path in sources:
+                self.archives.append(PakArchive(pak_path))
+        except:
+            self.close()
+            raise
+        for archive in self.archives:
+            identity = archive.pak_data.identity
+            modified = email.utils.formatdate(identity[1] / 1000000000.0,
+                                              usegmt=True)
+            for (file_name, file_off, file_len) in reversed(archive.table):
+                # Earlier table entries win within a pak file, and later pak
+                # files win over earlier ones.
+                key = "{0}:{1}:{2}".format(identity, file_off, file_len)
+                etag = '"{0}"'.format(
+                    hashlib.sha1(key.encode('ascii')).hexdigest()[:20])
+                self.resources[file_name] = (archive, file_off, file_len,
+                                             etag, modified)
+
+    def start(self, host="127.0.0.1", port=8000):
+        """Start listening for connections.
+
+        :param host: address to listen on
+        :type host:  str
+        :param port: port to listen on, or 0 for any free port
+        :type port:  int
+
+        :returns: future (or coroutine) whose result is the
+                  :class:`asyncio.Server`; its ``sockets`` attribute gives
+                  the address actually listened on
+        :rtype:   asyncio.Future
+
+        """
+        return self.loop.create_server(lambda: PakServerProtocol(self),
+                                       host, port)
+
+    def close(self):
+        """Close the pak files. Stop the :class:`asyncio.Server` first.
+
+        """
+        for archive in self.archives:
+            archive.close()
+
+    def respond(self, method, target, headers):
+        """Decide the response to a request.
+
+        :param method:  request method
+        :type method:   str
+        :param target:  request target (path and optional query)
+        :type target:   str
+        :param headers: request headers, with lowercase names
+        :type headers:  dict(str,str)
+
+        :returns: status code, response headers, and the resource content to
+                  send as (archive, offset, length), or None for no content
+        :rtype:   tuple(int,list(tuple(str,str)),tuple or None)
+
+        """
+        if method not in ("GET", "HEAD"):
+            return (405, [("Allow", "GET, HEAD")], None)
+        path = target.partition("?")[0]
+        resource = self.resources.get(unquote_to_bytes(path).lstrip(b"/"))
+        if resource is None:
+            return (404, [], None)
+        (archive, file_off, file_len, etag, modified) = resource
+        response_headers = [("ETag", etag), ("Last-Modified", modified),
+                             ("Accept-Ranges", "bytes")]
+        if "if-match" in headers:
+            if not etag_matches(headers["if-match"], etag, weak=False):
+                return (412, response_headers, None)
+        if "if-none-match" in headers:
+            if etag_matches(headers["if-none-match"], etag, weak=True):
+                return (304, response_headers, None)
+        elif "if-modified-since" in headers:
+            if not modified_since(headers["if-modified-since"], modified):
+                return (304, response_headers, None)
+        content_type = mimetypes.guess_type(path)[0]
+        response_headers.append(("Content-Type",
+                                 content_type or "application/octet-stream"))
+        byte_range = None
+        if "range" in headers:
+            if_range = headers.get("if-range")
+            if if_range is None or if_range in (etag, modified):
+                byte_range = parse_byte_range(headers["range"], file_len)
+        if byte_range is False:
+            response_headers.append(("Content-Range",
+                                     "bytes */{0}".format(file_len)))
+            return (416, response_headers, None)
+        if byte_range is None:
+            return (200, response_headers, (archive, file_off, file_len))
+        (first, last) = byte_range
+        response_headers.append(("Content-Range", "bytes {0}-{1}/{2}".format(
+            first, last, file_len)))
+        return (206, response_headers,
+                (archive, file_off + first, last + 1 - first))
+
+def etag_matches(header, etag, weak):
+    """Return whether an If-Match or If-None-Match header matches an ETag.
+
+    :param header: header value: "*" or a comma-separated list of ETags
+    :type header:  str
+    :param etag:   the resource's (strong) ETag
+    :type etag:    str
+    :param weak:   whether weak ETags in the header may match
+    :type weak:    bool
+
+    :returns: True if the header matches
+    :rtype:   bool
+
+    """
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def modified_since(header, modified):
+    """Return whether a resource changed after an If-Modified-Since date.
+
+    :param header:   header value, an HTTP date
+    :type header:    str
+    :param modified: the resource's Last-Modified value
+    :type modified:  str
+
+    :returns: True if the resource was modified after the date, or if the
+              date can't be parsed
+    :rtype:   bool
+
+    """
+    since = email.utils.parsedate_tz(header)
+    if since is None:
+        return True
+    last = email.utils.parsedate_tz(modified)
+    return email.utils.mktime_tz(last) > email.utils.mktime_tz(since)
+
+def parse_byte_range(header, length):
+    """Interpret the Range header of a request for a resource.
+
+    Only a single range of bytes is supported; other forms are ignored, and
+    the whole resource is sent, as HTTP permits.
+
+    :param header: header value, such as "bytes=0-499" or "bytes=-500"
+    :type header:  str
+    :param length: length of the resource
+    :type length:  int
+
+    :returns: (first, last) byte positions (inclusive) to send; None to send
+              the whole resource; or False if the range is not satisfiable
+    :rtype:   tuple(int,int) or None or bool
+
+    """
+    (unit, sep, spec) = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    (first, sep, last) = spec.strip().partition("-")
+    try:
+        if not sep or (not first and not last):
+            return None
+        if not first:
+            # A suffix range: the last so many bytes.
+            suffix = int(last)
+            if suffix <= 0 or not length:
+                return False
+            return (max(0, length - suffix), length - 1)
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first < 0 or (last is not None and last < first):
+        return None
+    if first >= length:
+        return False
+    if last is None or last >= length:
+        last = length - 1
+    return (first, last)
+
+class PakServerProtocol(object):
+    """asyncio protocol for one HTTP connection to a :class:`PakServer`.
+
+    Requests on the connection are handled one at a time, in order. While
+    the transport's write buffer is full, no further pipelined requests are
+    answered, and once more than :const:`MAX_REQUEST_HEAD` bytes of them are
+    waiting, reading from the connection is paused too.
+
+    :param server: the server that accepted the connection
+    :type server:  PakServer
+
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = b""
+        self.busy = False
+        self.paused = False
+        self.keep_alive = True
+        self.reading_paused = False
+        self.eof = False
+        self.closing = False
+        # Set while process_requests is running, so that a response finished
+        # from inside it doesn't start another loop.
+        self.processing = False
+        # Content still to be sent in chunks: (archive, offset, length).
+        self.sending = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        self.process_requests()
+
+    def eof_received(self):
+        # Close once the complete requests received have been answered.
+        self.eof = True
+        self.process_requests()
+        return True
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.sending = None
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.sending is not None:
+            self.send_chunks()
+        else:
+            self.process_requests()
+
+    def process_requests(self):
+        """Handle buffered requests while the connection is ready for them.
+
+        Requests are handled in a loop, rather than each finished response
+        starting the next, so that a long run of pipelined requests with
+        header-only responses doesn't recurse. The loop stops while a
+        response's content is being sent or the transport's write buffer is
+        full; it is run again when that changes.
+
+        """
+        if self.processing:
+            return
+        self.processing = True
+        try:
+            while (not self.busy and not self.paused and not self.closing and
+                   self.transport is not None):
+                if not self.handle_next():
+                    break
+        finally:
+            self.processing = False
+        if self.closing or self.transport is None:
+            return
+        if self.busy or self.paused:
+            if len(self.buffer) > MAX_REQUEST_HEAD and not self.reading_paused:
+                # Stop reading pipelined requests until they can be answered.
+                self.reading_paused = True
+                self.transport.pause_reading()
+        elif self.eof:
+            self.close()
+        elif self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def handle_next(self):
+        """Handle the next complete request in the buffer, if there is one.
+
+        :returns: True if a request was handled, False if the buffer holds no
+                  complete request
+        :rtype:   bool
+
+        """
+        end = self.buffer.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.buffer) > MAX_REQUEST_HEAD:
+                self.keep_alive = False
+                self.send_head(431, [])
+                self.finish()
+                return True
+            return False
+        head = self.buffer[:end].decode('latin-1').split("\r\n")
+        self.buffer = self.buffer[end + 4:]
+        request = head[0].split()
+        headers = {}
+        for line in head[1:]:
+            (name, sep, value) = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if (len(request) != 3 or not request[2].startswith("HTTP/") or
+                "transfer-encoding" in headers or
+                headers.get("content-length", "0") != "0"):
+            # Request bodies aren't expected; don't try to skip over one.
+            self.keep_alive = False
+            self.send_head(400, [])
+            self.finish()
+            return True
+        (method, target, version) = request
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            self.keep_alive = self.keep_alive and connection == "keep-alive"
+        else:
+            self.keep_alive = self.keep_alive and connection != "close"
+        (status, response_headers, content) = self.server.respond(
+            method, target, headers)
+        if content is None:
+            self.send_head(status, response_headers, 0)
+            self.finish()
+            return True
+        (archive, offset, length) = content
+        self.send_head(status, response_headers, length)
+        if method == "HEAD" or not length:
+            self.finish()
+        elif zero_copy and hasattr(self.server.loop, 'sendfile'):
+            self.busy = True
+            task = self.server.loop.create_task(self.server.loop.sendfile(
+                self.transport, archive.instream, offset, length,
+                fallback=False))
+            task.add_done_callback(
+                lambda t: self.sendfile_done(t, content))
+        else:
+            self.busy = True
+            self.sending = content
+            self.send_chunks()
+        return True
+
+    def send_head(self, status, headers, length=0):
+        """Send the status line and headers of a response.
+
+        """
+        lines = ["HTTP/1.1 {0} {1}".format(status, HTTP_REASONS[status])]
+        lines.extend(["{0}: {1}".format(*h) for h in headers])
+        if status != 304:
+            lines.append("Content-Length: {0}".format(length))
+        if not self.keep_alive:
+            lines.append("Connection: close")
+        self.transport.write(("\r\n".join(lines) + "\r\n\r\n").encode(
+            'latin-1'))
+
+    def sendfile_done(self, task, content):
+        """Finish a response after sendfile, or fall back to chunks.
+
+        """
+        if self.transport is None:
+            return
+        exc = task.exception()
+        if exc is None:
+            self.finish()
+        elif isinstance(exc, RuntimeError):
+            # Sendfile is not available for this transport (no bytes have
+            # been sent); send the content in chunks instead.
+            self.sending = content
+            self.send_chunks()
+        else:
+            self.close()
+
+    def send_chunks(self):
+        """Send content in chunks until done or the transport's buffer fills.
+
+        """
+        while self.sending is not None and not self.paused:
+            (archive, offset, length) = self.sending
+            count = min(length, SERVE_CHUNK_SIZE)
+            try:
+                data = archive.read_range(offset, count)
+            except IOError:
+                self.sending = None
+                self.close()
+                return
+            self.transport.write(data)
+            if count == length:
+                self.sending = None
+                self.finish()
+            else:
+                self.sending = (archive, offset + count, length - count)
+
+    def finish(self):
+        """Complete a response, then close or go on to the next request.
+
+        """
+        self.busy = False
+        if self.transport is None:
+            return
+        if not self.keep_alive:
+            self.close()
+            return
+        self.process_requests()
+
+    def close(self):
+        """Close the connection, dropping any requests not yet handled.
+
+        """
+        self.closing = True
+        self.buffer = b""
+        self.sending = None
+        if self.transport is not None:
+            self.transport.close()
+
+def directory_inputs(root):
+    """Return the files under a directory as inputs for :func:`create_pak`.
+
+    Each file below ``root`` is given a resource name made from its path
+    relative to ``root``, using "/" as the separator. The inputs are sorted
+    by resource name.
+
+    :param root: path of the directory
+    :type root:  str
+
+    :returns: list of (resource name, file path) tuples
+    :rtype:   list(tuple(str,str))
+
+    """
+    inputs = []
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        for f in filenames:
+            file_path = os.path.join(dirpath, f)
+            rel_path = os.path.relpath(file_path, root)
+            inputs.append(("/".join(rel_path.split(os.sep)), file_path))
+    inputs.sort()
+    return inputs
+
+def check_input_names(inputs):
+    """Validate and encode the resource names of inputs for a new pak file.
+
+    A ValueError is raised if a name is empty, too long to fit in a file
+    table entry (which also needs room for a terminating null character), or
+    used more than once.
+
+    :param inputs: (resource name, file path) tuples
+    :type inputs:  list(tuple(str,str))
+
+    :returns: list of (encoded name, file path) tuples
+    :rtype:   list(tuple(bytes,str))
+
+    """
+    encoded = []
+    seen = set()
+    for (name, file_path) in inputs:
+        file_name = encode_name(name)
+        if not file_name or len(file_name) >= RESOURCE_NAME_LEN:
+            raise ValueError("invalid resource name length: {0!r}".format(
+                name))
+        if file_name in seen:
+            raise ValueError("duplicate resource name: {0!r}".format(name))
+        seen.add(file_name)
+        encoded.append((file_name, file_path))
+    return encoded
+
+def open_input(file_path):
+    """Open an input file for :func:`create_pak` and start reading it ahead.
+
+    The OS is asked (where supported) to start reading the whole file into
+    the page cache in the background, so that many input files are fetched
+    from disk at once while the pak file is written sequentially.
+
+    :param file_path: path of the input file
+    :type file_path:  str
+
+    :returns: binary file object and size of the file
+    :rtype:   tuple(file,int)
+
+    """
+    instream = open(file_path, 'rb')
+    try:
+        size = os.fstat(instream.fileno()).st_size
+        fadvise = getattr(os, 'posix_fadvise', None)
+        if fadvise is not None:
+            try:
+                fadvise(instream.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            except OSError:
+                pass
+    except:
+        instream.close()
+        raise
+    return (instream, size)
+
+def write_input(instream, size, outstream):
+    """Write the content of an input file into a pak file being written.
+
+    The content is copied within the kernel if :data:`zero_copy` is set and
+    the platform supports it, and otherwise through a buffer. An IOError is
+    raised if the input file is shorter than ``size``.
+
+    :param instream:  binary file object of the input file
+    :type instream:   file
+    :param size:      number of bytes to copy
+    :type size:       int
+    :param outstream: binary file object of the pak file, positioned at the
+                      end of the data written so far
+    :type outstream:  file
+
+    """
+    copied = 0
+    if zero_copy and size:
+        outstream.flush()
+        start = outstream.tell()
+        copied = kernel_copy(instream.fileno(), 0, size, outstream.fileno())
+        if copied:
+            # The kernel moved the file position; keep the file object's
+            # notion of it in step.
+            outstream.seek(start + copied)
+    if copied < size:
+        reader = ResourceReader(PakStream(instream), copied, size - copied)
+        copy_stream(reader, outstream)
+
+def create_pak(pak_path, inputs, workers=None):
+    """Create a pak file from a set of files.
+
+    ``inputs`` specifies the resources to store, either as a dict mapping
+    resource names to file paths, or as an iterable of (resource name, file
+    path) tuples, or as the path of a directory whose files should all be
+    stored (named by their paths relative to it; see
+    :func:`directory_inputs`). Resource content is written in the given
+    order (or sorted by name, for a dict or directory), in a single
+    sequential pass, and followed by the file table, in the layout read by
+    :func:`read_header` and :func:`read_filetable`.
+
+    If ``workers`` is a number greater than zero, input files are opened on a
+    pool of that many threads, and read ahead by the OS, while earlier ones
+    are copied; this helps when there are many small input files. Content is
+    copied within the kernel where possible, as described for
+    :data:`zero_copy`.
+
+    The pak file is written under a temporary name in the same directory
+    and moved into place once complete, so an existing file at ``pak_path``
+    is only replaced by a complete pak file. It keeps the permissions of the
+    file it replaces.
+
+    A ValueError is raised for an invalid resource name (see
+    :func:`check_input_names`) or if the pak file would be too large for
+    its 32-bit offsets. An IOError or OSError is raised if an input file
+    can't be read or the pak file can't be written.
+
+    Example of packing a directory tree, and of packing specific files:
+
+    .. code-block:: python
+
+        expak.create_pak("pak2.pak", "my_mod_dir")
+        expak.create_pak("pak3.pak", {"maps/start.bsp": "build/start.bsp",
+                                      "progs.dat": "build/progs.dat"})
+
+    :param pak_path: file path of the pak file to create
+    :type pak_path:  str
+    :param inputs:   resources to store, as described above
+    :type inputs:    str or dict(str,str) or iterable(tuple(str,str))
+    :param workers:  number of threads to open input files on, or None
+    :type workers:   int or None
+
+    :returns: descriptions of the stored resources, in file table order
+    :rtype:   list(ResourceEntry)
+
+    """
+    if is_string(inputs):
+        inputs = directory_inputs(inputs)
+    elif isinstance(inputs, dict):
+        inputs = sorted(inputs.items())
+    inputs = check_input_names(list(inputs))
+    (fd, temp_path) = create_temp_file(pak_path, ".pak")
+    try:
+        with os.fdopen(fd, 'w+b') as outstream:
+            outstream.write(b"\0" * PAK_HEADER_LEN)
+            table = write_pak_data(outstream, inputs, workers)
+            finish_pak(outstream, table)
+        replace_file(temp_path, pak_path)
+    except:
+        os.remove(temp_path)
+        raise
+    return [ResourceEntry(n.decode('latin-1'), o, l, pak_path)
+            for (n, o, l) in table]
+
+def write_pak_data(outstream, inputs, workers=None):
+    """Write the content of input files into a pak file.
+
+    The content is written sequentially from the current position of
+    ``outstream``.
+
+    :param outstream: binary file object of the pak file
+    :type outstream:  file
+    :param inputs:    (encoded name, file path) tuples, as returned by
+                      :func:`check_input_names`
+    :type inputs:     list(tuple(bytes,str))
+    :param workers:   number of threads to open input files on, or None
+    :type workers:    int or None
+
+    :returns: list of (name, offset, length) tuples for the written content
+    :rtype:   list(tuple(bytes,int,int))
+
+    """
+    table = []
+    paths = [i[1] for i in inputs]
+    if workers and workers > 0 and futures is not None:
+        pool = futures.ThreadPoolExecutor(workers)
+        try:
+            pending = collections.deque()
+            for file_path in paths:
+                pending.append(pool.submit(open_input, file_path))
+                if len(pending) >= pending_limit(workers):
+                    write_opened(pending.popleft(), outstream, table, inputs)
+            while pending:
+                write_opened(pending.popleft(), outstream, table, inputs)
+        finally:
+            # Close any files opened after a failure.
+            for p in pending:
+                if not p.cancel() and p.exception() is None:
+                    p.result()[0].close()
+            pool.shutdown()
+    else:
+        for file_path in paths:
+            write_opened(open_input(file_path), outstream, table, inputs)
+    return table
+
+def write_opened(opened, outstream, table, inputs):
+    """Copy one opened input file into a pak file and record its table entry.
+
+    Used by :func:`write_pak_data`, for the next input not yet in ``table``.
+
+    :param opened:    result of :func:`open_input`, or a future for it
+    :type opened:     tuple(file,int) or concurrent.futures.Future
+    :param outstream: binary file object of the pak file
+    :type outstream:  file
+    :param table:     (name, offset, length) tuples written so far; appended
+                      to
+    :type table:      list(tuple(bytes,int,int))
+    :param inputs:    (encoded name, file path) tuples for all inputs
+    :type inputs:     list(tuple(bytes,str))
+
+    """
+    if not isinstance(opened, tuple):
+        opened = opened.result()
+    (instream, size) = opened
+    with instream:
+        offset = outstream.tell()
+        if offset + size > MAX_PAK_SIZE:
+            raise ValueError("pak file would exceed {0} bytes".format(
+                MAX_PAK_SIZE))
+        write_input(instream, size, outstream)
+    table.append((inputs[len(table)][0], offset, size))
+
+def finish_pak(outstream, table):
+    """Write the file table at the current end of a pak file, and its header.
+
+    Anything in the file after the new table is truncated. The table is
+    flushed to disk before the header is written to point at it, and the
+    header is flushed in turn, so that if the process or system crashes
+    partway through, the header still points at a complete table: the old
+    one, when updating an existing pak file, or the new one.
+
+    :param outstream: binary file object of the pak file, positioned at the
+                      end of the resource content
+    :type outstream:  file
+    :param table:     (name, offset, length) tuples for all resources
+    :type table:      list(tuple(bytes,int,int))
+
+    :returns: offset of the file table
+    :rtype:   int
+
+    """
+    ftable_off = outstream.tell()
+    ftable_len = len(table) * TABLE_ENTRY_LEN
+    if ftable_off + ftable_len > MAX_PAK_SIZE:
+        raise ValueError("pak file would exceed {0} bytes".format(
+            MAX_PAK_SIZE))
+    outstream.write(b"".join([TABLE_ENTRY.pack(*t) for t in table]))
+    outstream.truncate()
+    outstream.flush()
+    os.fsync(outstream.fileno())
+    # The header fits in the first disk sector, so it is written atomically.
+    outstream.seek(0)
+    outstream.write(PAK_FILE_SIGNATURE + struct.pack("<II", ftable_off,
+                                                     ftable_len))
+    outstream.flush()
+    os.fsync(outstream.fileno())
+    return ftable_off
+
+def update_pak(pak_path, inputs=None, remove=None, workers=None):
+    """Add, replace, or remove resources in an existing pak file.
+
+    ``inputs`` specifies resources to add or replace, in any of the forms
+    accepted by :func:`create_pak`. An input whose name is already in the
+    pak file replaces that resource (keeping its place in the file table);
+    other inputs are added at the end of the table. ``remove`` is an
+    iterable of resource names to remove from the table; names not in the
+    pak file are ignored.
+
+    The existing resource content is not touched. The content of the inputs
+    is appended after the current end of the pak file's content and table,
+    followed by a complete new file table, and then the header is changed to
+    point at the new table (see :func:`finish_pak`). The cost of an update
+    therefore depends on the size of the new content plus the size of the
+    table, not the size of the pak file. The update is crash-safe: until the
+    12-byte header is rewritten, the old header and table are intact and
+    still describe the old content, so an interrupted update leaves the pak
+    file as it was (plus some unreferenced bytes at the end, which the next
+    update reuses). Programs that already have the pak file open, such as a
+    :class:`PakArchive`, can keep reading the old content.
+
+    Replaced and removed content, and old file tables, remain in the file as
+    unreferenced bytes; :func:`compact_pak` can be used to reclaim them.
+
+    Digests cached in :data:`index_cache_dir` (see :func:`verify_pak`) for
+    the unchanged content are kept.
+
+    An IOError is raised if the file can't be read or is not a pak file, or
+    as described for :func:`create_pak`. A ValueError is raised for invalid
+    input names, as for :func:`create_pak`.
+
+    :param pak_path: file path of the pak file to update
+    :type pak_path:  str
+    :param inputs:   resources to add or replace, as described above, or
+                     None
+    :type inputs:    str or dict(str,str) or iterable(tuple(str,str)) or None
+    :param remove:   names of resources to remove, or None
+    :type remove:    iterable(str) or None
+    :param workers:  number of threads to open input files on, as described
+                     for :func:`create_pak`, or None
+    :type workers:   int or None
+
+    :returns: descriptions of the resources in the updated pak file, in file
+              table order
+    :rtype:   list(ResourceEntry)
+
+    """
+    if inputs is None:
+        inputs = []
+    elif is_string(inputs):
+        inputs = directory_inputs(inputs)
+    elif isinstance(inputs, dict):
+        inputs = sorted(inputs.items())
+    inputs = check_input_names(list(inputs))
+    removed = set([encode_name(n) for n in (remove or [])])
+    with open(pak_path, 'r+b') as outstream:
+        header = read_header(outstream)
+        if header is None:
+            raise IOError(errno.EINVAL,
+                          "{0} is not a pak file".format(pak_path))
+        old_table = read_filetable(outstream, header, None)
+        digests = load_digest_cache(outstream)
+        # Start writing after everything the current header refers to.
+        (ftable_off, num_files) = header
+        end = max([PAK_HEADER_LEN, ftable_off + num_files * TABLE_ENTRY_LEN] +
+                  [t[1] + t[2] for t in old_table])
+        outstream.seek(end)
+        added = write_pak_data(outstream, inputs, workers)
+        replacements = dict([(t[0], t) for t in added])
+        table = []
+        written = set()
+        for t in old_table:
+            if t[0] in removed or t[0] in written:
+                continue
+            written.add(t[0])
+            table.append(replacements.get(t[0], t))
+        table.extend([t for t in added if t[0] not in written])
+        finish_pak(outstream, table)
+        # Content outside the header that the old table refers to has not
+        # changed, so its cached digests are still valid.
+        kept = set(["{0}:{1}".format(o, l) for (n, o, l) in table
+                    if o >= PAK_HEADER_LEN])
+        digests = dict([(k, d) for (k, d) in digests.items() if k in kept])
+        if digests:
+            save_digest_cache(outstream, digests)
+    return [ResourceEntry(n.decode('latin-1'), o, l, pak_path)
+            for (n, o, l) in table]
 
-    * Ensure that the directory "sound" exists as a subdirectory of the current
-      working directory.
+def trace_converter(converter, trace):
+    """Wrap a converter to record the order in which resources are processed.
 
-    * Ensure that the directory "hknight" exists as a subdirectory of "sound".
+    The returned converter appends each resource name to ``trace`` and then
+    calls ``converter``. A trace recorded this way, for example while loading
+    a map, can be passed to :func:`compact_pak` to lay out the resources in
+    that order. If the targets given to :func:`process_resources` map
+    resource names to other names, the trace holds the mapped names, so
+    record traces with a targets set (or None) instead.
 
-    * Write the resource's contents as "grunt.wav" in that "hknight" directory.
+    :param converter: converter to wrap
+    :type converter:  function(bytes,str)
+    :param trace:     list to append resource names to
+    :type trace:      list(str)
 
-    This function will always return True.
+    :returns: converter that records names in ``trace``
+    :rtype:   function(bytes,str)
 
-    :param orig_data: binary content of the resource
-    :type orig_data:  bytes
-    :param name:      resource name
-    :type name:       str
+    """
+    def converter_with_trace(orig_data, name):
+        trace.append(name)
+        return converter(orig_data, name)
+    return converter_with_trace
 
-    :returns: True
-    :rtype:   bool
+def compact_pak(pak_path, trace=None, out_path=None):
+    """Rewrite a pak file without unreferenced bytes.
+
+    Resource content that no file table entry refers to, such as content
+    replaced or removed by :func:`update_pak`, is left out of the new pak
+    file, as is any gap between resources. Table entries that refer to the
+    same byte range keep sharing one copy of it. The file table keeps its
+    order.
+
+    If ``trace`` is given, the content of the resources it names is placed
+    first, in the order of their first appearance in ``trace``, so that
+    resources used together are contiguous and can be read sequentially
+    (see :func:`trace_converter` for one way to record a trace). Names in
+    ``trace`` that are not in the pak file are ignored. The content of the
+    other resources follows, in its current order.
+
+    Where the new layout has resources next to each other that were also
+    next to each other in the old pak file, their content is copied in one
+    operation, within the kernel if :data:`zero_copy` is set and the platform
+    supports it.
+
+    The new pak file is written to a temporary file that then replaces
+    ``out_path``, or ``pak_path`` itself if ``out_path`` is None, so an
+    interrupted compaction leaves the original intact. A replaced file's
+    permissions are kept. Digests cached in :data:`index_cache_dir` (see
+    :func:`verify_pak`) are carried over to the new pak file.
+
+    An IOError is raised if the pak file can't be read, is not a pak file,
+    or refers to content past its end, or if the new pak file can't be
+    written.
+
+    :param pak_path: file path of the pak file to compact
+    :type pak_path:  str
+    :param trace:    resource names in the order they should be laid out,
+                     or None
+    :type trace:     iterable(str) or None
+    :param out_path: file path to write the compacted pak file to, or None
+                     to replace ``pak_path``
+    :type out_path:  str or None
+
+    :returns: descriptions of the resources in the compacted pak file, in
+              file table order
+    :rtype:   list(ResourceEntry)
 
     """
-    real_path = os.path.join(*name.split("/"))
-    out_dir = os.path.dirname(real_path)
-    if out_dir:
+    if out_path is None:
+        out_path = pak_path
+    with open(pak_path, 'rb') as instream:
+        header = read_header(instream)
+        if header is None:
+            raise IOError(errno.EINVAL,
+                          "{0} is not a pak file".format(pak_path))
+        old_table = read_filetable(instream, header, None)
+        pak_size = os.fstat(instream.fileno()).st_size
+        for (file_name, file_off, file_len) in old_table:
+            if file_off + file_len > pak_size:
+                raise IOError(2, "unexpected EOF reading resource data")
+        # Decide the new order of the distinct byte ranges.
+        ranges_by_name = collections.defaultdict(list)
+        for (file_name, file_off, file_len) in old_table:
+            ranges_by_name[file_name].append((file_off, file_len))
+        layout = []
+        placed = set()
+        for name in (trace or []):
+            for r in ranges_by_name.get(encode_name(name), []):
+                if r not in placed:
+                    placed.add(r)
+                    layout.append(r)
+        for r in sorted(set([(t[1], t[2]) for t in old_table])):
+            if r not in placed:
+                layout.append(r)
+        new_offsets = {}
+        pos = PAK_HEADER_LEN
+        for r in layout:
+            new_offsets[r] = pos
+            pos += r[1]
+        table = [(n, new_offsets[(o, l)], l) for (n, o, l) in old_table]
+        # Cached digests stay valid for the content at its new position.
+        digests = {}
+        for (k, d) in load_digest_cache(instream).items():
+            r = tuple([int(v) for v in k.split(":")])
+            if r in new_offsets:
+                digests["{0}:{1}".format(new_offsets[r], r[1])] = d
+        (fd, temp_path) = create_temp_file(out_path, ".pak")
         try:
-            os.makedirs(out_dir)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-    with open(real_path, 'wb') as outstream:
-        outstream.write(orig_data)
-    return True
+            with os.fdopen(fd, 'w+b') as outstream:
+                outstream.write(b"\0" * PAK_HEADER_LEN)
+                pak_data = PakStream(instream)
+                for (copy_off, copy_len) in merge_layout(layout):
+                    start = outstream.tell()
+                    reader = ResourceReader(pak_data, copy_off, copy_len)
+                    reader.copy_to(outstream)
+                    # Keep the file position in step after a kernel copy.
+                    outstream.seek(start + copy_len)
+                finish_pak(outstream, table)
+            replace_file(temp_path, out_path)
+        except:
+            os.remove(temp_path)
+            raise
+    if digests:
+        with open(out_path, 'rb') as outstream:
+            save_digest_cache(outstream, digests)
+    return [ResourceEntry(n.decode('latin-1'), o, l, out_path)
+            for (n, o, l) in table]
 
-def extract_resources(sources, targets=None):
-    """Extract resources contained in one or more pak files.
+def merge_layout(layout):
+    """Merge byte ranges that stay next to each other in a new pak layout.
 
-    Convenience function for invoking :func:`process_resources` with the
-    :func:`nop_converter` function as the converter argument.
+    Used by :func:`compact_pak` to copy runs of resources that are contiguous
+    in both the old and new pak files with one operation each.
 
-    See :func:`process_resources` for more discussion of the return value
-    and the handling of the ``targets`` argument.
+    :param layout: (offset, length) tuples of old pak file content, in their
+                   new order
+    :type layout:  list(tuple(int,int))
 
-    :param sources: file path of the pak file to process, or an iterable
-                    specifying multiple such paths
-    :type sources:  str or iterable(str)
-    :param targets: resources to select, as described for
-                    :func:`process_resources`; contents may be modified
-    :type targets:  dict(str,str) or set(str) or None
+    :returns: list of (offset, length) tuples of old pak file content to
+              copy, in order
+    :rtype:   list(tuple(int,int))
 
-    :returns: True if no IOError exception reading the pak file and no
-              exception extracting any resource, False otherwise
-    :rtype:   bool
+    """
+    merged = []
+    for (file_off, file_len) in layout:
+        if merged and merged[-1][0] + merged[-1][1] == file_off:
+            merged[-1] = (merged[-1][0], merged[-1][1] + file_len)
+        else:
+            merged.append((file_off, file_len))
+    return merged
+
+def load_digest_cache(instream):
+    """Read the cached resource digests for a pak file, if still valid.
+
+    Digests are cached in :data:`index_cache_dir`, next to the index file of
+    the pak file, and are only valid while the pak file's identity (see
+    :func:`pak_identity`) is unchanged.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+
+    :returns: dict mapping "offset:length" keys to hex digests; empty if the
+              cache is disabled or holds nothing valid for this pak file
+    :rtype:   dict(str,str)
 
     """
-    return process_resources(sources, nop_converter, targets)
+    if index_cache_dir is None:
+        return {}
+    try:
+        with open(index_cache_path(instream.name, ".dig"), 'r') as cachestream:
+            contents = json.load(cachestream)
+        if (contents.get("version") == DIGEST_CACHE_VERSION and
+                contents["path"] == os.path.abspath(instream.name) and
+                contents["identity"] == list(pak_identity(instream))):
+            return contents["digests"]
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
 
-def resource_names_int(pak_path):
-    """Return the name of every resource in a pak file.
+def save_digest_cache(instream, digests):
+    """Store resource digests for a pak file in the index cache.
 
-    Implement :func:`resource_names` for a single pak file.
+    As for :func:`save_index_cache`, the file is replaced atomically and a
+    failure to write it is not an error.
 
-    :param pak_path: file path of the pak file to read
+    :param instream: binary file object of the pak file
+    :type instream:  file
+    :param digests:  dict mapping "offset:length" keys to hex digests
+    :type digests:   dict(str,str)
+
+    """
+    if index_cache_dir is None:
+        return
+    contents = {"version": DIGEST_CACHE_VERSION,
+                "path": os.path.abspath(instream.name),
+                "identity": list(pak_identity(instream)),
+                "digests": digests}
+    try:
+        (fd, temp_path) = tempfile.mkstemp(dir=index_cache_dir)
+        try:
+            with os.fdopen(fd, 'w') as cachestream:
+                json.dump(contents, cachestream)
+            replace_file(temp_path, index_cache_path(instream.name, ".dig"))
+        except:
+            os.remove(temp_path)
+            raise
+    except (IOError, OSError):
+        pass
+
+def range_digest(pak_data, offset, length):
+    """Return the hex SHA-1 digest of a range of bytes of a pak file.
+
+    The bytes are read in chunks through a :class:`ResourceReader`. An
+    IOError is raised if the pak file ends before the end of the range.
+
+    :param pak_data: data source for the pak file
+    :type pak_data:  PakStream
+    :param offset:   position in the pak file of the first byte
+    :type offset:    int
+    :param length:   number of bytes
+    :type length:    int
+
+    :returns: hex digest
+    :rtype:   str
+
+    """
+    return stream_digest(ResourceReader(pak_data, offset, length))
+
+def range_digests(instream, ranges, workers=None, stats=None):
+    """Return the content digests of byte ranges of a pak file.
+
+    Digests cached by an earlier call (see :func:`load_digest_cache`) are
+    reused, and each other distinct range is read and hashed once, with
+    ordinary file reads (see :func:`range_digest`). A memory map is not
+    used, since touching a mapped page past the end of a file that has
+    been truncated kills the process. If ``workers`` is a positive number,
+    ranges are hashed in parallel on that many threads; hashing large
+    buffers does not hold the global interpreter lock. New digests are
+    added to the cache.
+
+    An IOError is raised if a range extends past the end of the pak file.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+    :param ranges:   (offset, length) tuples
+    :type ranges:    iterable(tuple(int,int))
+    :param workers:  number of threads to hash on, or None
+    :type workers:   int or None
+    :param stats:    dict to accumulate "hashed" and "bytes_hashed" counts in
+                     (see :func:`process_resources`), or None
+    :type stats:     dict or None
+
+    :returns: dict mapping (offset, length) tuples to hex digests
+    :rtype:   dict(tuple(int,int),str)
+
+    """
+    cached = load_digest_cache(instream)
+    digests = {}
+    missing = []
+    for r in set(ranges):
+        digest = cached.get("{0}:{1}".format(*r))
+        if digest is None:
+            missing.append(r)
+        else:
+            digests[r] = digest
+    if not missing:
+        return digests
+    # Hash in pak data order so that the reads sweep through the file.
+    missing.sort()
+    pak_data = PakStream(instream)
+    if workers and workers > 0 and futures is not None:
+        pool = futures.ThreadPoolExecutor(workers)
+        try:
+            results = list(pool.map(
+                lambda r: range_digest(pak_data, r[0], r[1]), missing))
+        finally:
+            pool.shutdown()
+    else:
+        results = [range_digest(pak_data, o, l) for (o, l) in missing]
+    for (r, digest) in zip(missing, results):
+        digests[r] = digest
+        cached["{0}:{1}".format(*r)] = digest
+    add_stats(stats, hashed=len(missing),
+              bytes_hashed=sum([l for (o, l) in missing]))
+    save_digest_cache(instream, cached)
+    return digests
+
+def table_ranges(pak_path, instream):
+    """Return the resource names and content ranges of an open pak file.
+
+    Where a name appears more than once in the file table, the first entry
+    is used, as in overlay mode (see :func:`process_resources`).
+
+    :param pak_path: file path of the pak file, for error messages
     :type pak_path:  str
+    :param instream: binary file object of the pak file
+    :type instream:  file
 
-    :returns: set of resource name strings if no read errors, None otherwise
-    :rtype:   set(str) or None
+    :returns: dict mapping encoded names to (offset, length) tuples
+    :rtype:   dict(bytes,tuple(int,int))
+
+    """
+    table = get_target_info(instream, None)
+    if table is None:
+        raise IOError(errno.EINVAL, "{0} is not a pak file".format(pak_path))
+    ranges = {}
+    for (file_name, file_off, file_len) in table:
+        if file_name not in ranges:
+            ranges[file_name] = (file_off, file_len)
+    return ranges
+
+def diff_paks(old_path, new_path, workers=None, stats=None):
+    """Compare the resources in two versions of a pak file.
+
+    Each resource name is classified as added (only in the new pak file),
+    removed (only in the old one), modified, or unchanged. Only the file
+    tables are read to find added and removed resources, and resources whose
+    lengths differ are modified without reading their content. The content
+    of the remaining resources is compared by SHA-1 digest, reading each
+    distinct byte range of each pak file at most once. If both paths refer to
+    the same unchanged file, resources at the same range are unchanged
+    without being read.
+
+    Digests are hashed on ``workers`` threads if it is a positive number. If
+    :data:`index_cache_dir` is set, the digests of each pak file are cached
+    there, so that comparing against an unchanged pak file again (for
+    example, the previous release in a series of builds) doesn't read it
+    again.
+
+    An IOError is raised if either file can't be read or is not a pak file.
+
+    Example of listing the resources to ship in an update:
+
+    .. code-block:: python
+
+        diff = expak.diff_paks("pak1_old.pak", "pak1.pak", workers=4)
+        for name in diff.added + diff.modified:
+            print(name)
+
+    :param old_path: file path of the old pak file
+    :type old_path:  str
+    :param new_path: file path of the new pak file
+    :type new_path:  str
+    :param workers:  number of threads to hash on, or None
+    :type workers:   int or None
+    :param stats:    dict to accumulate "hashed" and "bytes_hashed" counts in
+                     (see :func:`process_resources`), or None
+    :type stats:     dict or None
+
+    :returns: the classified resource names
+    :rtype:   PakDiff
+
+    """
+    with open(old_path, 'rb') as old_stream:
+        with open(new_path, 'rb') as new_stream:
+            old_ranges = table_ranges(old_path, old_stream)
+            new_ranges = table_ranges(new_path, new_stream)
+            same_file = pak_identity(old_stream) == pak_identity(new_stream)
+            modified = []
+            unchanged = []
+            compare = []
+            for file_name in set(old_ranges).intersection(new_ranges):
+                old_range = old_ranges[file_name]
+                new_range = new_ranges[file_name]
+                if old_range[1] != new_range[1]:
+                    modified.append(file_name)
+                elif not old_range[1] or (same_file and
+                                          old_range == new_range):
+                    unchanged.append(file_name)
+                else:
+                    compare.append(file_name)
+            old_digests = range_digests(
+                old_stream, [old_ranges[n] for n in compare], workers, stats)
+            new_digests = range_digests(
+                new_stream, [new_ranges[n] for n in compare], workers, stats)
+    for file_name in compare:
+        if (old_digests[old_ranges[file_name]] ==
+                new_digests[new_ranges[file_name]]):
+            unchanged.append(file_name)
+        else:
+            modified.append(file_name)
+    def names(encoded):
+        return sorted([n.decode('latin-1') for n in encoded])
+    return PakDiff(names(set(new_ranges).difference(old_ranges)),
+                   names(set(old_ranges).difference(new_ranges)),
+                   names(modified), names(unchanged))
+
+def check_pak_structure(pak_path, instream):
+    """Check that a pak file's header and file table are consistent.
+
+    The header must be complete, and the file table must be a whole number of
+    entries lying after the header and within the file. Each entry must have
+    a name, and its content must lie after the header and within the file.
+
+    :param pak_path: file path of the pak file, for problem descriptions
+    :type pak_path:  str
+    :param instream: binary file object of the pak file
+    :type instream:  file
+
+    :returns: list of (name, offset, length) tuples for all resources, or
+              None if the file table can't be read; and a list of problem
+              descriptions
+    :rtype:   tuple(list(tuple(bytes,int,int)) or None,list(str))
+
+    """
+    problems = []
+    pak_size = os.fstat(instream.fileno()).st_size
+    instream.seek(0)
+    header = instream.read(PAK_HEADER_LEN)
+    if header[:len(PAK_FILE_SIGNATURE)] != PAK_FILE_SIGNATURE:
+        return (None, ["{0}: not a pak file".format(pak_path)])
+    if len(header) != PAK_HEADER_LEN:
+        return (None, ["{0}: truncated header".format(pak_path)])
+    (ftable_off, ftable_len) = struct.unpack("<II", header[4:])
+    if ftable_len % TABLE_ENTRY_LEN:
+        problems.append("{0}: file table length {1} is not a multiple of "
+                        "{2}".format(pak_path, ftable_len, TABLE_ENTRY_LEN))
+    if ftable_off < PAK_HEADER_LEN or ftable_off + ftable_len > pak_size:
+        problems.append("{0}: file table at {1} (length {2}) is outside the "
+                        "file".format(pak_path, ftable_off, ftable_len))
+        return (None, problems)
+    num_files = ftable_len // TABLE_ENTRY_LEN
+    table = read_filetable(instream, (ftable_off, num_files), None)
+    for (file_name, file_off, file_len) in table:
+        name = file_name.decode('latin-1')
+        if not file_name:
+            problems.append("{0}: file table entry with no name".format(
+                pak_path))
+        if file_len and (file_off < PAK_HEADER_LEN or
+                         file_off + file_len > pak_size):
+            problems.append("{0}: {1} content at {2} (length {3}) is outside "
+                            "the file".format(pak_path, name, file_off,
+                                              file_len))
+    return (table, problems)
+
+def pak_digests(instream, table, workers=None, stats=None):
+    """Return the length and content digest of each resource of a pak file.
+
+    Resources whose content lies outside the file are left out. Where a name
+    appears more than once in the file table, the first entry is used.
+    Digests are computed by :func:`range_digests`.
+
+    :param instream: binary file object of the pak file
+    :type instream:  file
+    :param table:    (name, offset, length) tuples for all resources, as
+                     returned by :func:`check_pak_structure`
+    :type table:     list(tuple(bytes,int,int))
+    :param workers:  number of threads to hash on, or None
+    :type workers:   int or None
+    :param stats:    dict to accumulate "hashed" and "bytes_hashed" counts in,
+                     or None
+    :type stats:     dict or None
+
+    :returns: dict mapping resource names to (length, hex digest) tuples
+    :rtype:   dict(str,tuple(int,str))
 
     """
+    pak_size = os.fstat(instream.fileno()).st_size
+    ranges = {}
+    for (file_name, file_off, file_len) in table:
+        name = file_name.decode('latin-1')
+        if name in ranges or file_off + file_len > pak_size:
+            continue
+        ranges[name] = (file_off, file_len)
+    digests = range_digests(instream, ranges.values(), workers, stats)
+    return dict([(n, (r[1], digests[r])) for (n, r) in ranges.items()])
+
+def write_digest_manifest(pak_path, manifest_path, workers=None):
+    """Record the content digests of a pak file's resources for verification.
+
+    The manifest is a JSON file mapping each resource name to its length and
+    SHA-1 digest. It is written under a temporary name and then moved into
+    place. :func:`verify_pak` can later check the pak file against it.
+
+    An IOError is raised if the pak file can't be read or fails the checks
+    of :func:`verify_pak` that don't need a manifest, or if the manifest
+    can't be written.
+
+    :param pak_path:      file path of the pak file
+    :type pak_path:       str
+    :param manifest_path: file path of the manifest to write
+    :type manifest_path:  str
+    :param workers:       number of threads to hash on, or None
+    :type workers:        int or None
+
+    """
+    with open(pak_path, 'rb') as instream:
+        (table, problems) = check_pak_structure(pak_path, instream)
+        if problems:
+            raise IOError(errno.EINVAL, problems[0])
+        digests = pak_digests(instream, table, workers)
+    contents = {"version": DIGEST_MANIFEST_VERSION,
+                "resources": dict([(n, {"length": l, "sha1": d})
+                                   for (n, (l, d)) in digests.items()])}
+    (fd, temp_path) = create_temp_file(manifest_path)
     try:
-        with open(pak_path, 'rb') as instream:
-            target_info = get_target_info(instream, None)
-            if target_info is None:
-                if print_err:
-                    sys.stderr.write("{0} is not a pak file\n".format(pak_path))
-                return None
-        # 2.6 COMPAT: "set comprehension" syntax
-        return set(t[0].decode() for t in target_info)
-    except IOError:
-        if print_err:
-            sys.stderr.write("{0!r} exception reading pak {1}\n".format(
-                sys.exc_info()[1], pak_path))
-        return None
+        with os.fdopen(fd, 'w') as outstream:
+            json.dump(contents, outstream, indent=1, sort_keys=True)
+        replace_file(temp_path, manifest_path)
+    except:
+        os.remove(temp_path)
+        raise
 
-def resource_names(sources):
-    """Return the name of every resource in one or more pak files.
+def verify_pak(pak_path, manifest_path=None, workers=None, stats=None):
+    """Check a pak file for damage.
 
-    Return a set of resource name strings collected from all of the given pak
-    files, if each specified file is a pak file and is read without I/O errors.
-    Otherwise return None.
+    The header and file table are checked for consistency: the file table
+    and the content of every resource must lie within the file. Then the
+    content of every resource is read and hashed, on ``workers`` threads if
+    it is a positive number. If ``manifest_path`` is given, the lengths and
+    digests are compared with those recorded in it by
+    :func:`write_digest_manifest`, and resources missing from either side
+    are reported.
 
-    :param sources: file path of the pak file to read, or an iterable
-                    specifying multiple such paths
-    :type sources:  str or iterable(str)
+    If :data:`index_cache_dir` is set, digests are cached there as for
+    :func:`diff_paks`, so verifying an unchanged pak file again doesn't read
+    its content. :func:`update_pak` and :func:`compact_pak` keep the cached
+    digests of the content they leave unchanged or move, so after an update
+    only the new content is hashed. Cached digests are trusted while the pak
+    file's identity (see :func:`pak_identity`) is unchanged, so damage that
+    leaves its size and modification time alone, such as a failing disk,
+    is only found with the cache disabled.
 
-    :returns: set of resource name strings if no read errors, None otherwise
-    :rtype:   set(str) or None
+    An IOError is raised if the pak file or manifest can't be opened or
+    read, including a read error in resource content that is hashed; any
+    other damage is reported in the returned list.
+
+    Example of checking a pak file against a manifest recorded at release
+    time:
+
+    .. code-block:: python
+
+        expak.write_digest_manifest("pak1.pak", "pak1.sha1.json")
+        for problem in expak.verify_pak("pak1.pak", "pak1.sha1.json"):
+            print(problem)
+
+    :param pak_path:      file path of the pak file
+    :type pak_path:       str
+    :param manifest_path: file path of a digest manifest, or None
+    :type manifest_path:  str or None
+    :param workers:       number of threads to hash on, or None
+    :type workers:        int or None
+    :param stats:         dict to accumulate "hashed" and "bytes_hashed"
+                          counts in (see :func:`process_resources`), or None
+    :type stats:          dict or None
+
+    :returns: descriptions of the problems found; empty if none
+    :rtype:   list(str)
 
     """
-    # Handle single-string input for the sources argument.
-    if is_string(sources):
-        return resource_names_int(sources)
-    # Handle iterable input for the sources argument.
-    all_resources = set()
-    for pak_path in sources:
-        resources = resource_names_int(pak_path)
-        if resources is None:
-            return None
-        all_resources.update(resources)
-    return all_resources
+    expected = None
+    if manifest_path is not None:
+        with open(manifest_path, 'r') as manifest:
+            try:
+                contents = json.load(manifest)
+                if contents.get("version") != DIGEST_MANIFEST_VERSION:
+                    raise ValueError("unknown manifest version")
+                expected = dict([(n, (r["length"], r["sha1"]))
+                                 for (n, r) in contents["resources"].items()])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise IOError(errno.EINVAL, "{0} is not a digest manifest"
+                              .format(manifest_path))
+    with open(pak_path, 'rb') as instream:
+        (table, problems) = check_pak_structure(pak_path, instream)
+        if table is None:
+            return problems
+        digests = pak_digests(instream, table, workers, stats)
+    if expected is not None:
+        names = set([t[0].decode('latin-1') for t in table])
+        for name in sorted(set(expected).union(names)):
+            if name not in names:
+                problems.append("{0}: {1} is missing".format(pak_path, name))
+            elif name not in expected:
+                problems.append("{0}: {1} is not in the manifest".format(
+                    pak_path, name))
+            elif name not in digests:
+                # Already reported as outside the file.
+                continue
+            elif digests[name][0] != expected[name][0]:
+                problems.append("{0}: {1} has length {2}, expected {3}".format(
+                    pak_path, name, digests[name][0], expected[name][0]))
+            elif digests[name][1] != expected[name][1]:
+                problems.append("{0}: {1} content does not match the "
+                                "manifest".format(pak_path, name))
+    return problems
 
 def usage():
     """Print the usage message for :func:`simple_expak`.
@@ -652,6 +5638,204 @@ def usage():
     print("    {0} pak1.pak sound/misc/basekey.wav".format(script))
     print("    {0} pak0.pak pak1.pak maps/e1m1.bsp maps/e2m1.bsp maps/e3m1.bsp".format(script))
     print("")
+    print("Resource names may also be glob patterns (quoted for the shell):")
+    print("    {0} pak0.pak pak1.pak 'maps/*.bsp' 'sound/*'".format(script))
+    print("")
+    print("To skip resources that are already extracted and unchanged, add:")
+    print("    --incremental")
+    print("")
+    print("To create a pak file from files and directory trees:")
+    print("    {0} --create <new.pak> <file_or_dir> [<file_or_dir> ...]".format(script))
+    print("examples:")
+    print("    {0} --create pak2.pak my_mod".format(script))
+    print("")
+    print("To add or replace resources in an existing pak file:")
+    print("    {0} --update <pak.pak> <file_or_dir> [<file_or_dir> ...]".format(script))
+    print("examples:")
+    print("    {0} --update pak2.pak maps/start.bsp".format(script))
+    print("")
+    print("To rewrite a pak file without unused space, optionally laying out")
+    print("resources in the order listed (one name per line) in a trace file:")
+    print("    {0} --compact <pak.pak> [<trace.txt>]".format(script))
+    print("")
+    print("To list resources added (A), deleted (D), or modified (M) between")
+    print("two versions of a pak file:")
+    print("    {0} --diff <old.pak> <new.pak>".format(script))
+    print("")
+    print("To record the content digests of a pak file in a manifest, and to")
+    print("check a pak file for damage, optionally against such a manifest:")
+    print("    {0} --digest <pak.pak> <manifest.json>".format(script))
+    print("    {0} --verify <pak.pak> [<manifest.json>]".format(script))
+    print("")
+    print("To serve the resources of pak files over HTTP on a local port:")
+    print("    {0} --serve <port> <pak_a.pak> [<pak_b.pak> ...]".format(script))
+    print("examples:")
+    print("    {0} --serve 8000 pak0.pak pak1.pak".format(script))
+    print("")
+
+def simple_create(args, update=False):
+    """Create or update a pak file for ``simple_expak --create/--update``.
+
+    :param args:   path of the pak file to create or update, then the files
+                   and directories to store in it
+    :type args:    list(str)
+    :param update: whether to update an existing pak file with
+                   :func:`update_pak` instead of creating a new one
+    :type update:  bool
+
+    :returns: exit status
+    :rtype:   int
+
+    """
+    if len(args) < 2:
+        usage()
+        return 1
+    pak_path = args[0]
+    inputs = []
+    try:
+        for a in args[1:]:
+            if os.path.isdir(a):
+                inputs.extend(directory_inputs(a))
+            else:
+                name = "/".join(os.path.normpath(a).split(os.sep))
+                inputs.append((name.lstrip("/"), a))
+        # A few threads are enough to keep the disk busy with small files.
+        if update:
+            update_pak(pak_path, inputs, workers=4)
+        else:
+            create_pak(pak_path, inputs, workers=4)
+    except (IOError, OSError, ValueError):
+        action = "updating" if update else "creating"
+        sys.stderr.write("{0!r} exception {1} pak {2}\n".format(
+            sys.exc_info()[1], action, pak_path))
+        return 1
+    return 0
+
+def simple_compact(args):
+    """Compact a pak file for ``simple_expak --compact``.
+
+    :param args: path of the pak file to compact, optionally followed by the
+                 path of a trace file listing resource names, one per line
+    :type args:  list(str)
+
+    :returns: exit status
+    :rtype:   int
+
+    """
+    if len(args) not in (1, 2):
+        usage()
+        return 1
+    pak_path = args[0]
+    try:
+        trace = None
+        if len(args) == 2:
+            with open(args[1]) as trace_file:
+                trace = [line.strip() for line in trace_file if line.strip()]
+        compact_pak(pak_path, trace)
+    except (IOError, OSError, ValueError):
+        sys.stderr.write("{0!r} exception compacting pak {1}\n".format(
+            sys.exc_info()[1], pak_path))
+        return 1
+    return 0
+
+def simple_diff(args):
+    """Compare two pak files for ``simple_expak --diff``.
+
+    Print one line for each resource that was added, deleted, or modified,
+    in name order, marked "A", "D", or "M" respectively.
+
+    :param args: paths of the old and new pak files
+    :type args:  list(str)
+
+    :returns: exit status
+    :rtype:   int
+
+    """
+    if len(args) != 2:
+        usage()
+        return 1
+    try:
+        diff = diff_paks(args[0], args[1], workers=4)
+    except (IOError, OSError):
+        sys.stderr.write("{0!r} exception comparing paks {1} and {2}\n".format(
+            sys.exc_info()[1], args[0], args[1]))
+        return 1
+    changes = ([(n, "A") for n in diff.added] +
+               [(n, "D") for n in diff.removed] +
+               [(n, "M") for n in diff.modified])
+    for (name, mark) in sorted(changes):
+        print("{0} {1}".format(mark, name))
+    return 0
+
+def simple_verify(args, record=False):
+    """Check or record pak file digests for ``simple_expak --verify/--digest``.
+
+    When verifying, each problem found is printed on its own line.
+
+    :param args:   path of the pak file, then the path of the digest manifest
+                   (optional when verifying)
+    :type args:    list(str)
+    :param record: whether to write the manifest with
+                   :func:`write_digest_manifest` instead of verifying
+    :type record:  bool
+
+    :returns: exit status; 1 if the pak file is damaged
+    :rtype:   int
+
+    """
+    if len(args) not in ((2,) if record else (1, 2)):
+        usage()
+        return 1
+    pak_path = args[0]
+    try:
+        if record:
+            write_digest_manifest(pak_path, args[1], workers=4)
+            return 0
+        problems = verify_pak(pak_path, (args[1:] or [None])[0], workers=4)
+    except (IOError, OSError):
+        sys.stderr.write("{0!r} exception verifying pak {1}\n".format(
+            sys.exc_info()[1], pak_path))
+        return 1
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+def simple_serve(args):
+    """Serve pak files over HTTP for ``simple_expak --serve``.
+
+    The server listens on the loopback interface until interrupted.
+
+    :param args: port number to listen on, then the pak file paths
+    :type args:  list(str)
+
+    :returns: exit status
+    :rtype:   int
+
+    """
+    if len(args) < 2 or not args[0].isdigit() or asyncio is None:
+        usage()
+        return 1
+    port = int(args[0])
+    loop = asyncio.new_event_loop()
+    server = None
+    try:
+        server = PakServer(args[1:], loop)
+        listener = loop.run_until_complete(server.start("127.0.0.1", port))
+        print("serving on http://127.0.0.1:{0}/".format(port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        listener.close()
+    except (IOError, OSError):
+        sys.stderr.write("{0!r} exception serving paks\n".format(
+            sys.exc_info()[1]))
+        return 1
+    finally:
+        if server is not None:
+            server.close()
+        loop.close()
+    return 0
 
 def simple_expak(argv=None):
     """
@@ -670,6 +5854,11 @@ def simple_expak(argv=None):
     If one or more pak files are specified, but no resources, then all resources
     are extracted from all of the specified pak files.
 
+    An argument containing any of the characters "*", "?", or "[" is treated
+    as a glob pattern, selecting every resource whose name matches it (see
+    the ``patterns`` argument of :func:`expak.process_resources`). A pattern
+    that matches no resource is reported like a resource that isn't found.
+
     Example of extracting all resources from "pak0.pak" and "pak1.pak":
 
     .. code-block:: none
@@ -684,10 +5873,83 @@ def simple_expak(argv=None):
 
         simple_expak pak0.pak pak1.pak maps/e1m1.bsp maps/e2m1.bsp maps/e3m1.bsp
 
+        simple_expak pak0.pak pak1.pak "maps/*.bsp" "sound/*"
+
     Whenever a resource is extracted from a pak file, it will be created under
     a directory path relative to the current working directory, determined by
     the resource name as described for the :func:`expak.nop_converter` function.
 
+    If the ``--incremental`` option is given, resources that were extracted
+    into the current working directory by an earlier incremental run, and
+    that are unchanged in both the pak file and the output directory, are not
+    extracted again (see :func:`expak.extract_resources`):
+
+    .. code-block:: none
+
+        simple_expak --incremental pak0.pak pak1.pak
+
+    With ``--create`` as the first argument, :program:`simple_expak` instead
+    creates the pak file named by the next argument, using
+    :func:`expak.create_pak`. Each further argument is either a directory,
+    whose files are all stored with names relative to it, or a file, stored
+    under its relative path:
+
+    .. code-block:: none
+
+        simple_expak --create pak2.pak my_mod
+
+        simple_expak --create pak3.pak progs.dat maps/start.bsp
+
+    ``--update`` works the same way, but adds the files to an existing pak
+    file (replacing any resources of the same names) using
+    :func:`expak.update_pak`:
+
+    .. code-block:: none
+
+        simple_expak --update pak3.pak maps/start.bsp
+
+    With ``--compact``, the pak file named by the next argument is rewritten
+    without unused space by :func:`expak.compact_pak`. An optional further
+    argument names a text file listing resource names, one per line, in the
+    order their content should be laid out:
+
+    .. code-block:: none
+
+        simple_expak --compact pak3.pak
+
+        simple_expak --compact pak3.pak e1m1_trace.txt
+
+    With ``--diff``, the two pak files named by the next arguments are
+    compared by :func:`expak.diff_paks`, and each resource added to, deleted
+    from, or modified in the second one is listed, marked "A", "D", or "M":
+
+    .. code-block:: none
+
+        simple_expak --diff pak1_old.pak pak1.pak
+
+    With ``--digest``, the content digests of the pak file named by the next
+    argument are recorded in the manifest file named by the argument after
+    that, using :func:`expak.write_digest_manifest`. With ``--verify``, the
+    pak file named by the next argument is checked for damage by
+    :func:`expak.verify_pak`, against the manifest named by an optional
+    further argument. Each problem found is printed, and the exit status is
+    1 if there were any:
+
+    .. code-block:: none
+
+        simple_expak --digest pak1.pak pak1.sha1.json
+
+        simple_expak --verify pak1.pak pak1.sha1.json
+
+    With ``--serve``, the resources of the pak files named by the arguments
+    after the port number are served over HTTP by an
+    :class:`expak.PakServer` listening on that port of the loopback
+    interface, until the program is interrupted:
+
+    .. code-block:: none
+
+        simple_expak --serve 8000 pak0.pak pak1.pak
+
     If any user-specified resources are not found, or are unable to be
     extracted, then :program:`simple_expak` will print a list of such resources
     once it is done.
@@ -713,21 +5975,44 @@ def simple_expak(argv=None):
     if not argv:
         usage()
         return 0
+    if argv[0] == "--create":
+        return simple_create(argv[1:])
+    if argv[0] == "--update":
+        return simple_create(argv[1:], update=True)
+    if argv[0] == "--compact":
+        return simple_compact(argv[1:])
+    if argv[0] == "--diff":
+        return simple_diff(argv[1:])
+    if argv[0] == "--verify":
+        return simple_verify(argv[1:])
+    if argv[0] == "--digest":
+        return simple_verify(argv[1:], record=True)
+    if argv[0] == "--serve":
+        return simple_serve(argv[1:])
     # Separate args into pak files and resources.
-    pak_paths, targets = set(), set()
+    pak_paths, targets, patterns = set(), set(), []
+    incremental = False
     for a in argv:
-        if a[-4:].lower() == ".pak":
+        if a == "--incremental":
+            incremental = True
+        elif a[-4:].lower() == ".pak":
             pak_paths.add(a)
+        elif GLOB_SPECIAL.search(a):
+            patterns.append(a)
         else:
             targets.add(a)
-    if not targets:
+    if not targets and not patterns:
         targets = None
+    selector = PatternSelector(patterns)
     # Extract those resources from those pak files.
-    success = extract_resources(pak_paths, targets)
-    # Print any specified resources not found/extracted.
-    if targets:
+    success = extract_resources(pak_paths, targets, incremental=incremental,
+                                patterns=selector if patterns else None)
+    # Print any specified resources not found/extracted, and any patterns
+    # that matched nothing.
+    missing = list(targets or []) + selector.unmatched()
+    if missing:
         print("not found (or not successfully extracted):")
-        for p in targets:
+        for p in missing:
             print("    {0}".format(p))
     # All done!
     if success:
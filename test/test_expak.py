@@ -21,11 +21,27 @@
 
 
 import os
+import re
+import errno
 import contextlib
 import filecmp
+import gc
+import shutil
+import socket
+import threading
 import expak
 import pytest
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
 # Adapter for string type differences between Python 2 & 3.
 try:
     basestring
@@ -128,11 +144,37 @@ def validate(out_dir, check_dir, targets):
             validate_resource(out_dir, res_file, check_dir, unvalidated)
     assert not unvalidated
 
+def make_pak(pak_path, resources, table_order=None):
+    # Write resources (a list of (name, data) tuples) to a pak file, with the
+    # data in list order and the table in table_order (a list of indices).
+    offsets = []
+    with open(pak_path, 'wb') as outstream:
+        outstream.write(b"\0" * 12)
+        for (name, data) in resources:
+            offsets.append(outstream.tell())
+            outstream.write(data)
+        ftable_off = outstream.tell()
+        if table_order is None:
+            table_order = range(len(resources))
+        for i in table_order:
+            (name, data) = resources[i]
+            outstream.write(expak.TABLE_ENTRY.pack(
+                name.encode('latin-1'), offsets[i], len(data)))
+        outstream.seek(0)
+        outstream.write(expak.PAK_FILE_SIGNATURE)
+        outstream.write(expak.struct.pack(
+            '<II', ftable_off, len(table_order) * expak.TABLE_ENTRY_LEN))
+
 def mangler(orig_data, name):
     real_path = path_from_resname(name)
     out_dir = os.path.dirname(real_path)
-    if out_dir and not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    if out_dir:
+        try:
+            os.makedirs(out_dir)
+        except OSError:
+            # Tolerate another worker creating it at the same time.
+            if not os.path.isdir(out_dir):
+                raise
     with open(real_path, 'wb') as outstream:
         outstream.write(orig_data[::-1])
     return True
@@ -351,3 +393,1553 @@ def test_main_extract_selected(tmpdir, capsys, sources, resources_in, all_found)
         assert not str(out).strip()
     else:
         assert str(out).strip().startswith("not found (or not successfully extracted):")
+
+def test_read_filetable_bulk(tmpdir):
+    pak_path = str(tmpdir.join("table.pak"))
+    long_name = b"x" * expak.RESOURCE_NAME_LEN
+    entries = [(b"short", 100, 5), (long_name, 200, 0), (b"a/b/c", 300, 7)]
+    with open(pak_path, 'wb') as outstream:
+        outstream.write(expak.PAK_FILE_SIGNATURE)
+        outstream.write(expak.struct.pack('<II', 12, 3 * expak.TABLE_ENTRY_LEN))
+        for e in entries:
+            outstream.write(expak.TABLE_ENTRY.pack(*e))
+    with open(pak_path, 'rb') as instream:
+        header = expak.read_header(instream)
+        assert expak.read_filetable(instream, header, None) == entries
+        assert expak.read_filetable(instream, header, set([b"a/b/c"])) == entries[2:]
+        truncated_header = (header[0], header[1] + 1)
+        with pytest.raises(IOError):
+            expak.read_filetable(instream, truncated_header, None)
+
+@pytest.fixture
+def index_cache(tmpdir):
+    cache_dir = str(tmpdir.mkdir("index_cache"))
+    expak.index_cache_dir = cache_dir
+    try:
+        yield cache_dir
+    finally:
+        expak.index_cache_dir = None
+
+def test_index_cache(tmpdir, index_cache):
+    pak_path = str(tmpdir.join("cached.pak"))
+    shutil.copyfile(PAK_A, pak_path)
+    assert expak.resource_names(pak_path) == ALL_A_RES
+    assert len(os.listdir(index_cache)) == 1
+    index_path = expak.index_cache_path(pak_path)
+    # A valid index is used instead of the pak's own table.
+    with open(pak_path, 'rb') as instream:
+        header = expak.read_header(instream)
+        table = expak.read_filetable(instream, header, None)
+        table = [(b"renamed_" + t[0], t[1], t[2]) for t in table]
+        expak.save_index_cache(instream, header, table)
+    renamed = set("renamed_" + n for n in ALL_A_RES)
+    assert expak.resource_names(pak_path) == renamed
+    with temp_workdir(str(tmpdir.mkdir("out"))):
+        targets = set(["renamed_doc_a.txt"])
+        assert expak.extract_resources(pak_path, targets)
+        assert not targets
+    # A changed pak invalidates the index.
+    st = os.stat(pak_path)
+    os.utime(pak_path, (st.st_atime, st.st_mtime + 10))
+    assert expak.resource_names(pak_path) == ALL_A_RES
+    # A damaged index is ignored.
+    with open(index_path, 'r+b') as indexstream:
+        indexstream.truncate(expak.INDEX_HEADER.size + 3)
+    assert expak.resource_names(pak_path) == ALL_A_RES
+    assert expak.resource_names(TRUNCATED_PAK) is None
+
+def test_pak_archive(outdir_gen):
+    with expak.PakArchive(PAK_A) as pak:
+        assert pak.names() == ALL_A_RES
+        for name in ALL_A_RES:
+            info = pak.info(name)
+            assert info.name == name
+            assert info.source == PAK_A
+            data = pak.read(name)
+            assert len(data) == info.length
+            with open(os.path.join(FILES_PATH, path_from_resname(name)), 'rb') as f:
+                assert f.read() == data
+        with pytest.raises(KeyError):
+            pak.read("another_bogus_resource")
+        with pytest.raises(KeyError):
+            pak.info("another_bogus_resource")
+        outdir = outdir_gen.next()
+        with temp_workdir(outdir):
+            targets = renamed_targets(BAD_AND_SOME_A_RES)
+            assert pak.process(expak.nop_converter, targets)
+            assert set(targets.keys()) == BAD_RES
+            validate(outdir, FILES_PATH, renamed_targets(SOME_A_RES))
+        outdir = outdir_gen.next()
+        with temp_workdir(outdir):
+            assert pak.process(mangler)
+            validate(outdir, MANGLED_FILES_PATH, normal_targets(ALL_A_RES))
+            targets = SOME_A_RES.copy()
+            assert not pak.process(bad_converter, targets)
+            assert targets == SOME_A_RES
+
+@pytest.mark.parametrize(
+    "sources",
+   [NO_PAK,
+    BAD_PAK,
+    TRUNCATED_PAK])
+def test_pak_archive_bad(sources):
+    with pytest.raises(IOError):
+        expak.PakArchive(sources)
+
+@pytest.mark.parametrize(
+    ("sources",               "resources_out"),
+   [(PAK_A,                   ALL_A_RES),
+    ([BAD_PAK, PAK_B, PAK_A], ALL_RES)])
+def test_process_mmap(outdir_gen, sources, resources_out):
+    expected = expected_error_free(sources)
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.extract_resources(sources, use_mmap=True) == expected
+        validate(outdir, FILES_PATH, normal_targets(resources_out))
+    views = []
+    def keeping_converter(orig_data, name):
+        views.append(orig_data)
+        return mangler(bytes(orig_data), name)
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        targets = resources_out.copy()
+        error_free = expak.process_resources(sources, keeping_converter,
+                                             targets, use_mmap=True)
+        assert error_free == expected
+        assert not targets
+        validate(outdir, MANGLED_FILES_PATH, normal_targets(resources_out))
+    # Views are released once the converter returns.
+    assert len(views) == len(resources_out)
+    for v in views:
+        assert isinstance(v, memoryview)
+        with pytest.raises(ValueError):
+            bytes(v)
+
+def test_pak_archive_mmap():
+    with expak.PakArchive(PAK_B, use_mmap=True) as pak:
+        for name in ALL_B_RES:
+            data = pak.read(name)
+            assert isinstance(data, memoryview)
+            with open(os.path.join(FILES_PATH, path_from_resname(name)), 'rb') as f:
+                assert f.read() == bytes(data)
+            data.release()
+
+def test_resource_reader():
+    name = "subdir_1/subdir_2/data_a"
+    with open(os.path.join(FILES_PATH, path_from_resname(name)), 'rb') as f:
+        expected = f.read()
+    for use_mmap in (False, True):
+        with expak.PakArchive(PAK_A, use_mmap=use_mmap) as pak:
+            reader = pak.open(name)
+            assert reader.read() == expected
+            assert reader.read() == b""
+            assert reader.seek(-10, os.SEEK_END) == len(expected) - 10
+            assert reader.read(100) == expected[-10:]
+            reader.seek(5)
+            buf = bytearray(7)
+            assert reader.readinto(buf) == 7
+            assert bytes(buf) == expected[5:12]
+            assert reader.tell() == 12
+            reader.seek(len(expected) + 5)
+            assert reader.read(10) == b""
+            with pytest.raises(ValueError):
+                reader.seek(-1)
+            reader.close()
+            with pytest.raises(ValueError):
+                reader.read()
+
+@pytest.mark.parametrize(
+    ("sources",               "resources_out"),
+   [(PAK_A,                   ALL_A_RES),
+    ([BAD_PAK, PAK_B, PAK_A], ALL_RES)])
+def test_process_stream(outdir_gen, monkeypatch, sources, resources_out):
+    expected = expected_error_free(sources)
+    readers = []
+    def stream_mangler(orig_data, name):
+        readers.append(orig_data)
+        return mangler(orig_data.read(), name)
+    for use_mmap in (False, True):
+        outdir = outdir_gen.next()
+        with temp_workdir(outdir):
+            error_free = expak.process_resources(sources, stream_mangler,
+                                                 use_mmap=use_mmap, stream=True)
+            assert error_free == expected
+            validate(outdir, MANGLED_FILES_PATH, normal_targets(resources_out))
+    assert all(r.closed for r in readers)
+    # Buffered extraction copies in chunks no bigger than the configured
+    # size.
+    monkeypatch.setattr(expak, "COPY_CHUNK_SIZE", 100)
+    monkeypatch.setattr(expak, "zero_copy", False)
+    chunks = []
+    real_readinto = expak.ResourceReader.readinto
+    def recording_readinto(self, buf):
+        count = real_readinto(self, buf)
+        chunks.append((len(buf), count))
+        return count
+    monkeypatch.setattr(expak.ResourceReader, "readinto", recording_readinto)
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.extract_resources(sources) == expected
+        validate(outdir, FILES_PATH, normal_targets(resources_out))
+    assert chunks
+    assert all(size == 100 for (size, count) in chunks)
+    assert max(count for (size, count) in chunks) == 100
+
+def test_resource_reader_no_memoryview(tmpdir, monkeypatch):
+    # The Python 2.6 fallbacks, which read through plain buffers.
+    monkeypatch.setattr(expak, "HAVE_MEMORYVIEW", False)
+    monkeypatch.setattr(expak, "COPY_CHUNK_SIZE", 3)
+    pak_path = str(tmpdir.join("plain.pak"))
+    make_pak(pak_path, [("a", b"abcdefgh"), ("b", b"ij")])
+    seen = {}
+    def converter(orig_data, name):
+        if isinstance(orig_data, expak.ResourceReader):
+            buf = bytearray(5)
+            count = orig_data.readinto(buf)
+            orig_data = bytes(buf[:count]) + orig_data.read()
+        seen[name] = orig_data
+        return True
+    for stream in (False, True):
+        assert expak.process_resources(pak_path, converter, stream=stream)
+        assert seen == {"a": b"abcdefgh", "b": b"ij"}
+    with open(pak_path, 'rb') as instream:
+        reader = expak.ResourceReader(expak.PakStream(instream), 12, 8)
+        assert expak.stream_digest(reader) == expak.hashlib.sha1(
+            b"abcdefgh").hexdigest()
+
+def recording_kernel_copy(calls, func_name, func):
+    # Wrap a kernel copy function to record its use, or to fail as if the
+    # platform doesn't support it (if func is None).
+    def kernel_copy(*args):
+        calls.append(func_name)
+        if func is None:
+            raise OSError(errno.ENOSYS, "not implemented")
+        return func(*args)
+    return kernel_copy
+
+@pytest.mark.parametrize("disabled", [(), ("copy_file_range",),
+                                      ("copy_file_range", "sendfile"),
+                                      ("zero_copy",)])
+def test_extract_zero_copy(outdir_gen, monkeypatch, disabled):
+    calls = []
+    available = []
+    for func_name in ("copy_file_range", "sendfile"):
+        func = getattr(os, func_name, None)
+        if func is None:
+            continue
+        if func_name in disabled:
+            func = None
+        else:
+            available.append(func_name)
+        monkeypatch.setattr(os, func_name,
+                            recording_kernel_copy(calls, func_name, func))
+    if "zero_copy" in disabled:
+        monkeypatch.setattr(expak, "zero_copy", False)
+        available = []
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.extract_resources([PAK_A, PAK_B])
+        validate(outdir, FILES_PATH, normal_targets(ALL_RES))
+        assert not expak.extract_resources(TRUNCATED_PAK)
+    if available:
+        assert available[0] in calls
+    elif "zero_copy" in disabled:
+        assert not calls
+
+def test_extract_incremental(tmpdir):
+    pak_path = str(tmpdir.join("incr.pak"))
+    resources = [("a/one", b"1" * 10), ("a/two", b"2" * 20),
+                 ("b/three", b"3" * 30)]
+    make_pak(pak_path, resources)
+    outdir = str(tmpdir.join("out"))
+    def extract(resources_out, skipped, bytes_skipped):
+        stats = {}
+        assert expak.extract_resources(pak_path, incremental=True,
+                                       stats=stats)
+        assert stats.get("skipped", 0) == skipped
+        assert stats.get("bytes_skipped", 0) == bytes_skipped
+        for (name, data) in resources_out:
+            with open(os.path.join(*name.split("/")), 'rb') as instream:
+                assert instream.read() == data
+    with temp_workdir(outdir):
+        extract(resources, 0, 0)
+        assert os.path.exists(expak.MANIFEST_FILE_NAME)
+        extract(resources, 3, 60)
+        # A modified or deleted output is written again.
+        with open(os.path.join("a", "two"), 'wb') as outstream:
+            outstream.write(b"changed")
+        os.remove(os.path.join("b", "three"))
+        extract(resources, 1, 10)
+        # If the pak changes, only resources with new content are written.
+        resources[1] = ("a/two", b"new two")
+        make_pak(pak_path, resources)
+        extract(resources, 2, 40)
+        extract(resources, 3, 47)
+        # Without a usable manifest, everything is extracted again.
+        with open(expak.MANIFEST_FILE_NAME, 'w') as outstream:
+            outstream.write("garbage")
+        extract(resources, 0, 0)
+        # Targets are handled as for ordinary extraction.
+        targets = set(["a/one", "missing"])
+        assert expak.simple_expak(["--incremental", pak_path, "a/one"]) == 0
+        assert expak.extract_resources(pak_path, targets, incremental=True)
+        assert targets == set(["missing"])
+
+def test_extract_incremental_shared(tmpdir, index_cache, monkeypatch):
+    pak_1 = str(tmpdir.join("incr_1.pak"))
+    pak_2 = str(tmpdir.join("incr_2.pak"))
+    make_pak(pak_1, [("shared", b"old"), ("one", b"1")])
+    make_pak(pak_2, [("shared", b"new"), ("two", b"2" * 20)])
+    outdir = str(tmpdir.join("out"))
+    def extract(skipped, contents):
+        stats = {}
+        assert expak.extract_resources([pak_1, pak_2], incremental=True,
+                                       stats=stats)
+        assert stats.get("skipped", 0) == skipped
+        for (name, data) in contents:
+            with open(name, 'rb') as instream:
+                assert instream.read() == data
+    contents = [("shared", b"new"), ("one", b"1"), ("two", b"2" * 20)]
+    with temp_workdir(outdir):
+        # A name in several pak files is only extracted from the last one,
+        # so nothing is rewritten on the next run.
+        extract(0, contents)
+        extract(3, contents)
+        # After an update, only the added content is read.
+        hashed = []
+        real_digest = expak.stream_digest
+        def counting_digest(instream):
+            hashed.append(instream.length)
+            return real_digest(instream)
+        monkeypatch.setattr(expak, "stream_digest", counting_digest)
+        new_two = str(tmpdir.join("new_two"))
+        with open(new_two, 'wb') as outstream:
+            outstream.write(b"22")
+        expak.update_pak(pak_2, [("two", new_two)])
+        contents[2] = ("two", b"22")
+        extract(2, contents)
+        assert hashed == [2]
+        extract(3, contents)
+        assert hashed == [2]
+
+def test_process_dedup(tmpdir):
+    pak_1 = str(tmpdir.join("dedup_1.pak"))
+    pak_2 = str(tmpdir.join("dedup_2.pak"))
+    make_pak(pak_1, [("a", b"same"), ("b", b"other"), ("c", b"same")])
+    make_pak(pak_2, [("d", b"same"), ("e", b"new"), ("b", b"other")])
+    for stream in (False, True):
+        calls = []
+        def converter(orig_data, name):
+            data = orig_data.read() if stream else orig_data
+            calls.append((name, data))
+            return name != "B"
+        duplicates = []
+        def on_duplicate(first_name, name):
+            duplicates.append((first_name, name))
+            return True
+        stats = {}
+        targets = dict((n, n.upper()) for n in "abcdez")
+        assert expak.process_resources([pak_1, pak_2], converter, targets,
+                                       stream=stream, stats=stats,
+                                       dedup=on_duplicate)
+        assert calls == [("A", b"same"), ("B", b"other"), ("E", b"new"),
+                         ("B", b"other")]
+        assert duplicates == [("A", "C"), ("A", "D")]
+        assert stats["dedup_calls_saved"] == 2
+        assert stats["dedup_bytes_saved"] == 8
+        assert targets == {"b": "B", "z": "Z"}
+
+def test_extract_dedup(tmpdir):
+    pak_1 = str(tmpdir.join("dedup_1.pak"))
+    pak_2 = str(tmpdir.join("dedup_2.pak"))
+    make_pak(pak_1, [("x/a", b"same"), ("x/b", b"other")])
+    make_pak(pak_2, [("y/c", b"same"), ("x/a", b"same")])
+    def read_output(name):
+        with open(os.path.join(*name.split("/")), 'rb') as instream:
+            return instream.read()
+    with temp_workdir(str(tmpdir.join("out"))):
+        stats = {}
+        assert expak.extract_resources([pak_1, pak_2], stats=stats,
+                                       dedup=True)
+        assert stats["dedup_calls_saved"] == 2
+        assert read_output("y/c") == b"same"
+        # Overwriting one output leaves any linked copies unchanged.
+        make_pak(pak_1, [("x/a", b"changed")])
+        assert expak.extract_resources(pak_1)
+        assert read_output("x/a") == b"changed"
+        assert read_output("y/c") == b"same"
+    # A name extracted again with other content is no longer used as the
+    # source for its earlier content.
+    make_pak(pak_1, [("foo", b"XXXX")])
+    make_pak(pak_2, [("foo", b"YYYY"), ("bar", b"XXXX")])
+    for concurrency in (None, 2):
+        with temp_workdir(str(tmpdir.join("out_{0}".format(concurrency)))):
+            stats = {}
+            assert expak.extract_resources([pak_1, pak_2], stats=stats,
+                                           concurrency=concurrency, dedup=True)
+            if concurrency is None:
+                assert "dedup_calls_saved" not in stats
+            assert read_output("foo") == b"YYYY"
+            assert read_output("bar") == b"XXXX"
+
+@pytest.mark.parametrize("concurrency", [None, 2])
+def test_process_overlay(tmpdir, concurrency):
+    paks = [str(tmpdir.join("pak{0}.pak".format(i))) for i in range(3)]
+    make_pak(paks[0], [("a", b"0a"), ("b", b"0b"), ("c", b"0c")])
+    make_pak(paks[1], [("b", b"1b"), ("d", b"1d")])
+    make_pak(paks[2], [("c", b"2c"), ("c", b"2c_hidden")])
+    calls = {}
+    lock = threading.Lock()
+    def converter(orig_data, name):
+        with lock:
+            calls.setdefault(name, []).append(orig_data)
+        return orig_data != b"1d"
+    assert expak.process_resources(paks, converter, overlay=True,
+                                   concurrency=concurrency)
+    assert calls == {"a": [b"0a"], "b": [b"1b"], "c": [b"2c"], "d": [b"1d"]}
+    # Pak files that can't contribute to the targets are never opened.
+    calls.clear()
+    targets = set(["b", "c", "d"])
+    assert expak.process_resources([NO_PAK, BAD_PAK] + paks[1:], converter,
+                                   targets, overlay=True,
+                                   concurrency=concurrency)
+    assert calls == {"b": [b"1b"], "c": [b"2c"], "d": [b"1d"]}
+    assert targets == set(["d"])
+    calls.clear()
+    targets = set(["a", "missing"])
+    assert not expak.process_resources([NO_PAK] + paks, converter, targets,
+                                       overlay=True, concurrency=concurrency)
+    assert calls == {"a": [b"0a"]}
+    assert targets == set(["missing"])
+
+def test_name_index():
+    names = [b"maps/e1m1.bsp", b"maps/e1m2.bsp", b"maps/readme.txt",
+             b"mapsx", b"sound/misc/basekey.wav", b"sound/ambience/fl_hum1.wav",
+             b"progs/player.mdl"]
+    index = expak.NameIndex(names)
+    assert index.with_prefix(b"maps/") == names[:3]
+    assert index.with_prefix(b"zzz") == []
+    assert index.match("sound/*") == sorted(names[4:6])
+    assert index.match("maps/*.bsp") == names[:2]
+    assert index.match("*.wav") == sorted(names[4:6])
+    assert index.match("maps/e1m?.bsp") == names[:2]
+    assert index.match("mapsx") == [b"mapsx"]
+    assert index.match("maps") == []
+    assert index.match(re.compile(r".*/e1m\d")) == names[:2]
+    assert index.match(re.compile(br"progs/")) == [b"progs/player.mdl"]
+
+def test_process_patterns(tmpdir, outdir_gen, capsys):
+    pak_1 = str(tmpdir.join("pat_1.pak"))
+    pak_2 = str(tmpdir.join("pat_2.pak"))
+    make_pak(pak_1, [("maps/a.bsp", b"1a"), ("maps/b.txt", b"1b"),
+                     ("sound/c.wav", b"1c")])
+    make_pak(pak_2, [("maps/a.bsp", b"2a"), ("maps/d.bsp", b"2d"),
+                     ("progs/e.mdl", b"2e")])
+    for overlay in (False, True):
+        calls = []
+        def converter(orig_data, name):
+            calls.append((name, orig_data))
+            return name != "maps/d.bsp"
+        targets = set(["progs/e.mdl"])
+        assert expak.process_resources([pak_1, pak_2], converter, targets,
+                                       patterns=["maps/*.bsp"],
+                                       overlay=overlay)
+        winner = b"2a" if overlay else b"1a"
+        assert sorted(calls) == [("maps/a.bsp", winner), ("maps/d.bsp", b"2d"),
+                                 ("progs/e.mdl", b"2e")]
+        assert targets == set(["maps/d.bsp"])
+    calls = []
+    assert expak.process_resources([pak_1, pak_2], converter,
+                                   patterns=["sound/*", "nothing/*"],
+                                   concurrency=2)
+    assert calls == [("sound/c.wav", b"1c")]
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.simple_expak([pak_1, pak_2, "maps/*"]) == 0
+        assert sorted(os.listdir("maps")) == ["a.bsp", "b.txt", "d.bsp"]
+        (out, err) = capsys.readouterr()
+        assert not out.strip()
+        # Patterns that match nothing are reported.
+        for incremental in ([], ["--incremental"]):
+            assert expak.simple_expak(incremental + [pak_1, "sound/*", "x*",
+                                                     "maps/?.bsp"]) == 0
+            (out, err) = capsys.readouterr()
+            assert out.split() == ["not", "found", "(or", "not", "successfully",
+                                   "extracted):", "x*"]
+    selector = expak.PatternSelector(["maps/*", "*.bsp", re.compile("^s"),
+                                      "none*"])
+    targets = {}
+    selector.expand([(b"maps/a.bsp", 0, 0), (b"sound/c.wav", 0, 0)], targets)
+    assert sorted(targets) == [b"maps/a.bsp", b"sound/c.wav"]
+    assert selector.unmatched() == ["none*"]
+    with expak.PakArchive(pak_2) as pak:
+        assert pak.match("maps/*") == ["maps/a.bsp", "maps/d.bsp"]
+        assert pak.match("*.mdl") == ["progs/e.mdl"]
+
+def test_pak_archive_tree(tmpdir):
+    pak_path = str(tmpdir.join("tree.pak"))
+    make_pak(pak_path, [("maps/e1m1.bsp", b"a"), ("maps/e1m2.bsp", b"bb"),
+                        ("maps.txt", b"c"), ("sound/misc/key.wav", b"d"),
+                        ("sound/misc/door.wav", b"e"), ("sound/x.wav", b"f"),
+                        ("progs/player.mdl", b"g"), ("end", b"h")])
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.listdir() == ["end", "maps", "maps.txt", "progs", "sound"]
+        assert pak.listdir("sound/") == ["misc", "x.wav"]
+        assert pak.listdir("/sound/misc") == ["door.wav", "key.wav"]
+        for path in ("nothing", "maps/e1m1.bsp", "sound/mis"):
+            with pytest.raises(KeyError):
+                pak.listdir(path)
+        assert list(pak.walk("sound")) == [
+            ("sound", ["misc"], ["x.wav"]),
+            ("sound/misc", [], ["door.wav", "key.wav"])]
+        walked = []
+        for (dirpath, dirnames, filenames) in pak.walk():
+            if "sound" in dirnames:
+                dirnames.remove("sound")
+            walked.extend(dirpath + "/" + f if dirpath else f
+                          for f in filenames)
+        assert sorted(walked) == ["end", "maps.txt", "maps/e1m1.bsp",
+                                  "maps/e1m2.bsp", "progs/player.mdl"]
+        assert pak.stat("maps/e1m2.bsp") == pak.info("maps/e1m2.bsp")
+        assert pak.stat("maps/e1m2.bsp").length == 2
+        assert pak.stat("sound/misc/") == ("sound/misc", None, None, pak_path)
+        with pytest.raises(KeyError):
+            pak.stat("sound/nothing")
+
+def test_iter_entries(monkeypatch):
+    # Use small chunks so that each table is read in several pieces.
+    monkeypatch.setattr(expak, "COPY_CHUNK_SIZE", 2 * expak.TABLE_ENTRY_LEN)
+    entries = list(expak.iter_entries([PAK_A, PAK_B]))
+    assert set(e.name for e in entries) == ALL_RES
+    assert [e.source for e in entries] == [PAK_A] * 4 + [PAK_B] * 4
+    for e in entries:
+        with open(os.path.join(FILES_PATH, path_from_resname(e.name)),
+                  'rb') as instream:
+            assert e.length == len(instream.read())
+        with open(e.source, 'rb') as instream:
+            instream.seek(e.offset)
+            assert len(instream.read(e.length)) == e.length
+    first = next(expak.iter_entries(PAK_A))
+    assert first == entries[0]
+    for bad_pak in ALL_BAD_PAKS:
+        with pytest.raises(IOError):
+            list(expak.iter_entries([PAK_A, bad_pak]))
+
+@pytest.mark.parametrize("workers", [None, 3])
+@pytest.mark.parametrize("zero_copy", [True, False])
+def test_create_pak(tmpdir, outdir_gen, monkeypatch, workers, zero_copy):
+    monkeypatch.setattr(expak, "zero_copy", zero_copy)
+    pak_path = str(tmpdir.join("created.pak"))
+    entries = expak.create_pak(pak_path, FILES_PATH, workers=workers)
+    assert [e.name for e in entries] == sorted(ALL_RES)
+    assert expak.resource_names(pak_path) == ALL_RES
+    with expak.PakArchive(pak_path) as pak:
+        for e in entries:
+            assert pak.info(e.name) == e
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.extract_resources(pak_path)
+        validate(outdir, FILES_PATH, normal_targets(ALL_RES))
+    inputs = {"renamed/doc": os.path.join(FILES_PATH, "doc_a.txt"),
+              "empty": os.devnull}
+    entries = expak.create_pak(pak_path, inputs, workers=workers)
+    assert [(e.name, e.length) for e in entries] == [
+        ("empty", 0),
+        ("renamed/doc", os.path.getsize(inputs["renamed/doc"]))]
+    with expak.PakArchive(pak_path) as pak:
+        with open(inputs["renamed/doc"], 'rb') as instream:
+            assert pak.read("renamed/doc") == instream.read()
+
+def test_create_pak_errors(tmpdir):
+    pak_path = str(tmpdir.join("created.pak"))
+    doc = os.path.join(FILES_PATH, "doc_a.txt")
+    expak.create_pak(pak_path, [("doc", doc)])
+    with open(pak_path, 'rb') as instream:
+        original = instream.read()
+    bad_inputs = [[("x" * expak.RESOURCE_NAME_LEN, doc)],
+                  [("", doc)],
+                  [("doc", doc), ("doc", doc)]]
+    for inputs in bad_inputs:
+        with pytest.raises(ValueError):
+            expak.create_pak(pak_path, inputs)
+    with pytest.raises(IOError):
+        expak.create_pak(pak_path, [("a", doc), ("b", NO_PAK)], workers=2)
+    # A failed creation leaves the existing file alone, and no temp files.
+    with open(pak_path, 'rb') as instream:
+        assert instream.read() == original
+    assert os.listdir(str(tmpdir)) == ["created.pak"]
+
+@pytest.mark.skipif(os.name != 'posix', reason="POSIX permissions")
+def test_create_pak_mode(tmpdir):
+    pak_path = str(tmpdir.join("created.pak"))
+    doc = os.path.join(FILES_PATH, "doc_a.txt")
+    old_umask = os.umask(0o022)
+    try:
+        # A new pak file gets the usual permissions for a new file.
+        expak.create_pak(pak_path, [("doc", doc)])
+        assert os.stat(pak_path).st_mode & 0o777 == 0o644
+        # A replaced pak file keeps the permissions it had.
+        os.chmod(pak_path, 0o640)
+        expak.create_pak(pak_path, [("doc", doc)])
+        assert os.stat(pak_path).st_mode & 0o777 == 0o640
+    finally:
+        os.umask(old_umask)
+
+def test_main_create(tmpdir, capsys):
+    pak_path = str(tmpdir.join("created.pak"))
+    with temp_workdir(TEST_INPUT_PATH):
+        argv = ["--create", pak_path, "files/subdir_1", "files/doc_a.txt"]
+        assert expak.simple_expak(argv) == 0
+        assert expak.resource_names(pak_path) == set([
+            "subdir_2/data_a", "subdir_2/data_b", "subdir_2/doc_a.txt",
+            "subdir_2/doc_b.txt", "files/doc_a.txt"])
+        assert expak.simple_expak(["--create", pak_path, "nothing"]) == 1
+        assert expak.simple_expak(["--create", pak_path]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception creating pak" in err
+
+def test_update_pak(tmpdir):
+    pak_path = str(tmpdir.join("updated.pak"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb"), ("c", b"c")])
+    with open(pak_path, 'rb') as instream:
+        original = instream.read()
+    new_b = str(tmpdir.join("new_b"))
+    new_d = str(tmpdir.join("new_d"))
+    with open(new_b, 'wb') as outstream:
+        outstream.write(b"BBBBBB")
+    with open(new_d, 'wb') as outstream:
+        outstream.write(b"dd")
+    with expak.PakArchive(pak_path) as old_pak:
+        entries = expak.update_pak(pak_path, [("d", new_d), ("b", new_b)],
+                                   remove=["c", "nothing"])
+        # Readers of the old table still see the old content.
+        assert old_pak.read("b") == b"bb"
+        assert old_pak.read("c") == b"c"
+    # Replaced resources keep their table position; new ones are appended.
+    assert [(e.name, e.length) for e in entries] == [
+        ("a", 4), ("b", 6), ("d", 2)]
+    with open(pak_path, 'rb') as instream:
+        updated = instream.read()
+    # Existing content and the old table are left in place.
+    assert updated[12:len(original)] == original[12:]
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.names() == set(["a", "b", "d"])
+        assert pak.read("a") == b"aaaa"
+        assert pak.read("b") == b"BBBBBB"
+        assert pak.read("d") == b"dd"
+    entries = expak.update_pak(pak_path, remove=["d"])
+    assert [e.name for e in entries] == ["a", "b"]
+    assert expak.resource_names(pak_path) == set(["a", "b"])
+    with pytest.raises(ValueError):
+        expak.update_pak(pak_path, [("a", new_d), ("a", new_b)])
+    with pytest.raises(IOError):
+        expak.update_pak(os.path.join(FILES_PATH, "doc_a.txt"), [])
+
+def test_update_pak_interrupted(tmpdir, monkeypatch):
+    pak_path = str(tmpdir.join("updated.pak"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    new_a = str(tmpdir.join("new_a"))
+    with open(new_a, 'wb') as outstream:
+        outstream.write(b"AAAAAAAA")
+    real_fsync = os.fsync
+    def crashing_fsync(fd):
+        # Fail after the new data and table are written, before the header.
+        real_fsync(fd)
+        raise OSError(errno.EIO, "simulated crash")
+    monkeypatch.setattr(os, "fsync", crashing_fsync)
+    with pytest.raises(OSError):
+        expak.update_pak(pak_path, [("a", new_a), ("c", new_a)])
+    monkeypatch.setattr(os, "fsync", real_fsync)
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.names() == set(["a", "b"])
+        assert pak.read("a") == b"aaaa"
+    # The next update writes over the unreferenced bytes left behind.
+    interrupted_size = os.path.getsize(pak_path)
+    expak.update_pak(pak_path, [("a", new_a)])
+    assert os.path.getsize(pak_path) < interrupted_size
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.read("a") == b"AAAAAAAA"
+        assert pak.read("b") == b"bb"
+
+def test_main_update(tmpdir, capsys):
+    pak_path = str(tmpdir.join("updated.pak"))
+    with temp_workdir(TEST_INPUT_PATH):
+        assert expak.simple_expak(["--create", pak_path, "files/doc_a.txt"]) == 0
+        assert expak.simple_expak(["--update", pak_path, "files/doc_b.txt"]) == 0
+        assert expak.resource_names(pak_path) == set([
+            "files/doc_a.txt", "files/doc_b.txt"])
+        assert expak.simple_expak(["--update", NO_PAK, "files/doc_a.txt"]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception updating pak" in err
+
+@pytest.mark.skipif(os.name != 'posix', reason="POSIX permissions")
+def test_compact_pak_mode(tmpdir):
+    pak_path = str(tmpdir.join("compact.pak"))
+    out_path = str(tmpdir.join("compacted.pak"))
+    make_pak(pak_path, [("a", b"aaaa")])
+    os.chmod(pak_path, 0o640)
+    old_umask = os.umask(0o022)
+    try:
+        expak.compact_pak(pak_path)
+        assert os.stat(pak_path).st_mode & 0o777 == 0o640
+        expak.compact_pak(pak_path, out_path=out_path)
+        assert os.stat(out_path).st_mode & 0o777 == 0o644
+    finally:
+        os.umask(old_umask)
+
+def test_compact_pak(tmpdir, monkeypatch):
+    pak_path = str(tmpdir.join("compact.pak"))
+    resources = [("a", b"aaaa"), ("b", b"bb"), ("c", b"c"), ("d", b"ddd")]
+    make_pak(pak_path, resources)
+    new_c = str(tmpdir.join("new_c"))
+    with open(new_c, 'wb') as outstream:
+        outstream.write(b"CCCCC")
+    expak.update_pak(pak_path, [("c", new_c)], remove=["b"])
+    trace = []
+    converter = expak.trace_converter(lambda orig_data, name: True, trace)
+    assert expak.process_resources(pak_path, converter, set(["c", "d"]))
+    assert trace == ["d", "c"]
+    copies = []
+    real_copy_to = expak.ResourceReader.copy_to
+    def recording_copy_to(self, outstream):
+        copies.append((self.offset, self.length))
+        real_copy_to(self, outstream)
+    monkeypatch.setattr(expak.ResourceReader, "copy_to", recording_copy_to)
+    out_path = str(tmpdir.join("out.pak"))
+    entries = expak.compact_pak(pak_path, trace + ["nothing"], out_path)
+    # Table order is kept; content follows the trace, then the old order.
+    assert [(e.name, e.offset, e.length) for e in entries] == [
+        ("a", 12 + 3 + 5, 4), ("c", 12 + 3, 5), ("d", 12, 3)]
+    assert os.path.getsize(out_path) == 12 + 12 + 3 * expak.TABLE_ENTRY_LEN
+    assert len(copies) == 3
+    with expak.PakArchive(out_path) as pak:
+        assert pak.read("a") == b"aaaa"
+        assert pak.read("c") == b"CCCCC"
+        assert pak.read("d") == b"ddd"
+    # Without a trace, contiguous content is copied in one operation.
+    del copies[:]
+    entries = expak.compact_pak(out_path)
+    assert [(e.name, e.offset) for e in entries] == [
+        ("a", 20), ("c", 15), ("d", 12)]
+    assert copies == [(12, 12)]
+    bad_path = str(tmpdir.join("bad.pak"))
+    make_pak(bad_path, resources)
+    with open(bad_path, 'r+b') as outstream:
+        outstream.truncate(14)
+    with pytest.raises(IOError):
+        expak.compact_pak(bad_path)
+    # No temp files are left behind.
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "bad.pak", "compact.pak", "new_c", "out.pak"]
+
+def test_main_compact(tmpdir, capsys):
+    pak_path = str(tmpdir.join("compact.pak"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    trace_path = str(tmpdir.join("trace.txt"))
+    with open(trace_path, 'w') as outstream:
+        outstream.write("b\n\na\n")
+    assert expak.simple_expak(["--compact", pak_path, trace_path]) == 0
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.info("b").offset == 12
+        assert pak.read("a") == b"aaaa"
+    assert expak.simple_expak(["--compact", NO_PAK]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception compacting pak" in err
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_diff_paks(tmpdir, index_cache, workers):
+    old_path = str(tmpdir.join("old.pak"))
+    new_path = str(tmpdir.join("new.pak"))
+    make_pak(old_path, [("a", b"aaaa"), ("b", b"bb"), ("c", b"ccc"),
+                        ("d", b"dd"), ("z", b"")])
+    make_pak(new_path, [("z", b""), ("e", b"e"), ("c", b"cccc"),
+                        ("b", b"bx"), ("a", b"aaaa")])
+    stats = {}
+    diff = expak.diff_paks(old_path, new_path, workers=workers, stats=stats)
+    assert diff == expak.PakDiff(["e"], ["d"], ["b", "c"], ["a", "z"])
+    # Only resources of equal, nonzero length are read.
+    assert stats == {"hashed": 4, "bytes_hashed": 12}
+    # Digests of unchanged pak files come from the cache.
+    stats = {}
+    assert expak.diff_paks(old_path, new_path, workers=workers,
+                           stats=stats) == diff
+    assert stats == {}
+    expak.index_cache_dir = None
+    assert expak.diff_paks(old_path, old_path, stats=stats) == expak.PakDiff(
+        [], [], [], ["a", "b", "c", "d", "z"])
+    assert stats == {}
+    with pytest.raises(IOError):
+        expak.diff_paks(old_path, os.path.join(FILES_PATH, "doc_a.txt"))
+
+def test_main_diff(tmpdir, capsys):
+    old_path = str(tmpdir.join("old.pak"))
+    new_path = str(tmpdir.join("new.pak"))
+    make_pak(old_path, [("a", b"aaaa"), ("b", b"bb"), ("d", b"dd")])
+    make_pak(new_path, [("a", b"aaab"), ("b", b"bb"), ("c", b"c")])
+    assert expak.simple_expak(["--diff", old_path, new_path]) == 0
+    (out, err) = capsys.readouterr()
+    assert out.splitlines() == ["M a", "A c", "D d"]
+    assert expak.simple_expak(["--diff", old_path, NO_PAK]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception comparing paks" in err
+
+def test_verify_pak(tmpdir, index_cache):
+    pak_path = str(tmpdir.join("verify.pak"))
+    manifest_path = str(tmpdir.join("verify.json"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb"), ("c", b"ccc")])
+    old_umask = os.umask(0o022)
+    try:
+        expak.write_digest_manifest(pak_path, manifest_path, workers=2)
+    finally:
+        os.umask(old_umask)
+    if os.name == 'posix':
+        assert os.stat(manifest_path).st_mode & 0o777 == 0o644
+    stats = {}
+    assert expak.verify_pak(pak_path, manifest_path, stats=stats) == []
+    assert stats == {}
+    new_b = str(tmpdir.join("new_b"))
+    with open(new_b, 'wb') as outstream:
+        outstream.write(b"bx")
+    expak.update_pak(pak_path, [("b", new_b), ("d", new_b)])
+    # Only the content written by the update is hashed again.
+    problems = expak.verify_pak(pak_path, manifest_path, workers=2,
+                                stats=stats)
+    assert stats == {"hashed": 2, "bytes_hashed": 4}
+    assert problems == [
+        pak_path + ": b content does not match the manifest",
+        pak_path + ": d is not in the manifest"]
+    expak.compact_pak(pak_path)
+    stats = {}
+    assert len(expak.verify_pak(pak_path, manifest_path, stats=stats)) == 2
+    assert stats == {}
+    expak.update_pak(pak_path, remove=["a", "d"])
+    problems = expak.verify_pak(pak_path, manifest_path)
+    assert pak_path + ": a is missing" in problems
+    # Structural damage is found without a manifest.
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    assert expak.verify_pak(pak_path) == []
+    with open(pak_path, 'r+b') as outstream:
+        outstream.seek(12)
+        outstream.write(b"a")
+        outstream.seek(0, os.SEEK_END)
+        outstream.write(expak.TABLE_ENTRY.pack(b"", 10000, 1))
+    assert expak.verify_pak(pak_path) == []
+    with open(pak_path, 'r+b') as outstream:
+        outstream.seek(4)
+        outstream.write(expak.struct.pack('<II', 18, 3 * expak.TABLE_ENTRY_LEN))
+    assert expak.verify_pak(pak_path) == [
+        pak_path + ": file table entry with no name",
+        pak_path + ":  content at 10000 (length 1) is outside the file"]
+    with pytest.raises(IOError):
+        expak.write_digest_manifest(pak_path, manifest_path)
+    with open(pak_path, 'r+b') as outstream:
+        outstream.truncate(100)
+    assert expak.verify_pak(pak_path) == [
+        pak_path + ": file table at 18 (length 192) is outside the file"]
+    assert expak.verify_pak(os.path.join(FILES_PATH, "doc_a.txt")) == [
+        os.path.join(FILES_PATH, "doc_a.txt") + ": not a pak file"]
+    with pytest.raises(IOError):
+        expak.verify_pak(pak_path, os.path.join(FILES_PATH, "doc_a.txt"))
+    # A pak file truncated while it is being hashed gives an IOError.
+    make_pak(pak_path, [("a", b"a" * 100)])
+    with open(pak_path, 'rb') as instream:
+        with open(pak_path, 'r+b') as outstream:
+            outstream.truncate(50)
+        with pytest.raises(IOError):
+            expak.range_digests(instream, [(12, 100)], workers=2)
+
+def test_main_verify(tmpdir, capsys):
+    pak_path = str(tmpdir.join("verify.pak"))
+    manifest_path = str(tmpdir.join("verify.json"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    assert expak.simple_expak(["--digest", pak_path, manifest_path]) == 0
+    assert expak.simple_expak(["--verify", pak_path, manifest_path]) == 0
+    assert expak.simple_expak(["--verify", pak_path]) == 0
+    make_pak(pak_path, [("a", b"aaab"), ("b", b"bb")])
+    assert expak.simple_expak(["--verify", pak_path, manifest_path]) == 1
+    (out, err) = capsys.readouterr()
+    assert out.splitlines() == [
+        pak_path + ": a content does not match the manifest"]
+    assert expak.simple_expak(["--verify", NO_PAK]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception verifying pak" in err
+
+def test_resource_cache():
+    cache = expak.ResourceCache(10)
+    cache.put(("p", b"a", 0), b"aaaa")
+    cache.put(("p", b"b", 4), b"bbbb")
+    assert cache.get(("p", b"a", 0)) == b"aaaa"
+    assert cache.get(("p", b"c", 8)) is None
+    # Adding "c" evicts "b", the least recently used.
+    cache.put(("p", b"c", 8), b"cccc")
+    assert cache.get(("p", b"b", 4)) is None
+    assert cache.get(("p", b"c", 8)) == b"cccc"
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 2, 1)
+    assert (len(cache), cache.size) == (2, 8)
+    cache.put(("p", b"a", 0), b"AA")
+    assert cache.size == 6
+    cache.put(("p", b"big", 12), b"x" * 11)
+    assert len(cache) == 2
+    cache.clear()
+    assert (len(cache), cache.size) == (0, 0)
+    assert cache.get(("p", b"a", 0)) is None
+
+def test_resource_cache_readers(tmpdir, monkeypatch):
+    pak_path = str(tmpdir.join("cached.pak"))
+    resources = [("res_{0}".format(i), b"x" * (i + 1)) for i in range(5)]
+    make_pak(pak_path, resources)
+    cache = expak.ResourceCache(1024)
+    monkeypatch.setattr(expak, "resource_cache", cache)
+    def run(**options):
+        stats = {}
+        seen = {}
+        def converter(orig_data, name):
+            if isinstance(orig_data, expak.ResourceReader):
+                orig_data = orig_data.read()
+            seen[name] = bytes(orig_data)
+            return True
+        assert expak.process_resources(pak_path, converter, stats=stats,
+                                       **options)
+        assert seen == dict(resources)
+        return stats.get("reads", 0)
+    assert run() == 1
+    assert (cache.hits, cache.misses, len(cache)) == (0, 5, 5)
+    assert run(workers=2) == 0
+    assert cache.hits == 5
+    # Memory-mapped and streaming reads bypass the cache.
+    run(use_mmap=True)
+    run(stream=True)
+    assert (cache.hits, cache.misses) == (5, 5)
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.read("res_2") == b"xxx"
+    assert cache.hits == 6
+    # A changed pak file doesn't get stale content.
+    make_pak(pak_path, [("res_2", b"yyy")])
+    st = os.stat(pak_path)
+    os.utime(pak_path, (st.st_atime, st.st_mtime + 10))
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.read("res_2") == b"yyy"
+    assert cache.misses == 6
+
+@contextlib.contextmanager
+def running_server(sources):
+    # Run a PakServer on a background event loop; yield its port.
+    loop = asyncio.new_event_loop()
+    server = expak.PakServer(sources, loop)
+    listener = loop.run_until_complete(server.start("127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        yield listener.sockets[0].getsockname()[1]
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.close()
+        loop.close()
+
+@pytest.mark.parametrize("zero_copy", [True, False])
+def test_pak_server(tmpdir, monkeypatch, zero_copy):
+    monkeypatch.setattr(expak, "zero_copy", zero_copy)
+    reads = []
+    real_read_range = expak.PakArchive.read_range
+    def recording_read_range(self, offset, length):
+        reads.append(length)
+        return real_read_range(self, offset, length)
+    monkeypatch.setattr(expak.PakArchive, "read_range", recording_read_range)
+    pak_a = str(tmpdir.join("a.pak"))
+    pak_b = str(tmpdir.join("b.pak"))
+    big = bytes(bytearray(range(256))) * 1200
+    make_pak(pak_a, [("maps/e1m1.bsp", b"old"), ("gfx/big.lmp", big),
+                     ("with space.txt", b"spaced")])
+    make_pak(pak_b, [("maps/e1m1.bsp", b"0123456789")])
+    with running_server([pak_a, pak_b]) as port:
+        conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+        def request(path, method="GET", **headers):
+            conn.request(method, path, headers=dict(
+                (k.replace("_", "-"), v) for (k, v) in headers.items()))
+            response = conn.getresponse()
+            return (response.status, dict(response.getheaders()),
+                    response.read())
+        # Requests share one persistent connection; the last pak wins.
+        (status, headers, body) = request("/maps/e1m1.bsp")
+        assert (status, body) == (200, b"0123456789")
+        assert headers["Content-Length"] == "10"
+        assert headers["Accept-Ranges"] == "bytes"
+        etag = headers["ETag"]
+        modified = headers["Last-Modified"]
+        (status, headers, body) = request("/gfx/big.lmp")
+        assert (status, body) == (200, big)
+        assert headers["ETag"] != etag
+        assert request("/with%20space.txt")[2] == b"spaced"
+        (status, headers, body) = request("/maps/e1m1.bsp", "HEAD")
+        assert (status, headers["Content-Length"], body) == (200, "10", b"")
+        # Ranges.
+        (status, headers, body) = request("/maps/e1m1.bsp", Range="bytes=2-4")
+        assert (status, body) == (206, b"234")
+        assert headers["Content-Range"] == "bytes 2-4/10"
+        assert request("/maps/e1m1.bsp", Range="bytes=-3")[2] == b"789"
+        assert request("/maps/e1m1.bsp", Range="bytes=7-")[2] == b"789"
+        (status, headers, body) = request("/gfx/big.lmp",
+                                          Range="bytes=100000-")
+        assert (status, body) == (206, big[100000:])
+        (status, headers, body) = request("/maps/e1m1.bsp", Range="bytes=10-")
+        assert status == 416
+        assert headers["Content-Range"] == "bytes */10"
+        assert request("/maps/e1m1.bsp", Range="bytes=0-1,4-5")[0] == 200
+        assert request("/maps/e1m1.bsp", Range="lines=1-2")[0] == 200
+        # Conditional requests.
+        assert request("/maps/e1m1.bsp", If_None_Match=etag)[:1] == (304,)
+        assert request("/maps/e1m1.bsp",
+                       If_None_Match='"x", W/' + etag)[0] == 304
+        assert request("/maps/e1m1.bsp", If_None_Match='"x"')[0] == 200
+        assert request("/maps/e1m1.bsp", If_Modified_Since=modified)[0] == 304
+        assert request("/maps/e1m1.bsp",
+                       If_Modified_Since="Thu, 01 Jan 1970 00:00:00 GMT")[0] == 200
+        assert request("/maps/e1m1.bsp", If_Match='"x"')[0] == 412
+        assert request("/maps/e1m1.bsp", If_Match=etag)[0] == 200
+        (status, headers, body) = request("/maps/e1m1.bsp", Range="bytes=0-1",
+                                          If_Range=etag)
+        assert (status, body) == (206, b"01")
+        (status, headers, body) = request("/maps/e1m1.bsp", Range="bytes=0-1",
+                                          If_Range='"x"')
+        assert (status, body) == (200, b"0123456789")
+        # Errors.
+        assert request("/maps/e2m1.bsp")[0] == 404
+        assert request("/maps/e1m1.bsp", "DELETE")[0] == 405
+        conn.close()
+    # With sendfile, content never passes through Python.
+    if zero_copy and hasattr(asyncio.AbstractEventLoop, "sendfile"):
+        assert reads == []
+    else:
+        assert max(reads) == expak.SERVE_CHUNK_SIZE
+
+def test_pak_server_connections(tmpdir):
+    pak_path = str(tmpdir.join("a.pak"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    def exchange(port, data):
+        sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        try:
+            sock.sendall(data)
+            received = b""
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    return received
+                received += chunk
+        finally:
+            sock.close()
+    with running_server(pak_path) as port:
+        # Pipelined requests are answered in order, and the server closes
+        # the connection when asked to.
+        received = exchange(port, b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+                                  b"GET /b HTTP/1.1\r\nConnection: close\r\n\r\n")
+        assert received.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert received.endswith(b"\r\n\r\nbb")
+        assert b"\r\n\r\naaaaHTTP/1.1 200 OK\r\n" in received
+        assert b"Connection: close\r\n" in received
+        # HTTP/1.0 connections close after one response.
+        received = exchange(port, b"GET /b HTTP/1.0\r\n\r\n")
+        assert received.endswith(b"\r\n\r\nbb")
+        received = exchange(port, b"NONSENSE\r\n\r\n")
+        assert received.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+        received = exchange(port, b"GET /a HTTP/1.1\r\n"
+                                  b"Content-Length: 3\r\n\r\nabc")
+        assert received.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+
+def test_pak_server_pipelining(tmpdir):
+    pak_path = str(tmpdir.join("a.pak"))
+    make_pak(pak_path, [("a", b"aaaa"), ("b", b"bb")])
+    count = 5000
+    data = b"HEAD /a HTTP/1.1\r\n\r\n" * count + b"GET /b HTTP/1.1\r\n\r\n"
+    with running_server(pak_path) as port:
+        sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+        def send():
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+        # Send on another thread: the server stops reading requests while
+        # its responses aren't being read.
+        sender = threading.Thread(target=send)
+        sender.start()
+        received = b""
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                received += chunk
+        finally:
+            sender.join()
+            sock.close()
+    # Every request is answered, and the connection is closed after the
+    # last one.
+    assert received.count(b"HTTP/1.1 200 OK\r\n") == count + 1
+    assert received.endswith(b"\r\n\r\nbb")
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = b""
+        self.closed = False
+        self.reading = True
+    def write(self, data):
+        self.written += data
+    def close(self):
+        self.closed = True
+    def pause_reading(self):
+        self.reading = False
+    def resume_reading(self):
+        self.reading = True
+
+def test_pak_server_protocol_paused(tmpdir):
+    pak_path = str(tmpdir.join("a.pak"))
+    make_pak(pak_path, [("a", b"aaaa")])
+    loop = asyncio.new_event_loop()
+    server = expak.PakServer(pak_path, loop=loop)
+    try:
+        protocol = expak.PakServerProtocol(server)
+        transport = FakeTransport()
+        protocol.connection_made(transport)
+        # Nothing is answered while the transport's buffer is full, and
+        # reading stops once too many requests are waiting.
+        protocol.pause_writing()
+        head = b"HEAD /a HTTP/1.1\r\n\r\n"
+        protocol.data_received(head * 3)
+        assert transport.written == b""
+        assert transport.reading
+        protocol.data_received(head * (expak.MAX_REQUEST_HEAD // len(head)))
+        assert not transport.reading
+        protocol.eof_received()
+        protocol.resume_writing()
+        assert transport.written.count(b"HTTP/1.1 200 OK\r\n") == (
+            3 + expak.MAX_REQUEST_HEAD // len(head))
+        assert transport.closed
+    finally:
+        server.close()
+        loop.close()
+
+def test_parse_byte_range():
+    assert expak.parse_byte_range("bytes=0-0", 5) == (0, 0)
+    assert expak.parse_byte_range("bytes=3-100", 5) == (3, 4)
+    assert expak.parse_byte_range("bytes=-100", 5) == (0, 4)
+    assert expak.parse_byte_range("bytes=-0", 5) is False
+    assert expak.parse_byte_range("bytes=0-", 0) is False
+    assert expak.parse_byte_range("bytes=4-2", 5) is None
+    assert expak.parse_byte_range("bytes=a-b", 5) is None
+    assert expak.parse_byte_range("bytes=-", 5) is None
+
+def test_main_serve(capsys):
+    assert expak.simple_expak(["--serve", "8000"]) == 1
+    assert expak.simple_expak(["--serve", "port", PAK_A]) == 1
+    assert expak.simple_expak(["--serve", "0", NO_PAK]) == 1
+    (out, err) = capsys.readouterr()
+    assert "exception serving paks" in err
+
+def test_index_cache_undecodable_path(tmpdir, index_cache):
+    pak_path = os.path.join(str(tmpdir).encode(), b"caf\xff.pak")
+    try:
+        pak_path = os.fsdecode(pak_path)
+    except AttributeError:
+        pass
+    shutil.copyfile(PAK_A, pak_path)
+    assert expak.resource_names(pak_path) == ALL_A_RES
+    assert os.path.exists(expak.index_cache_path(pak_path))
+    assert expak.resource_names(pak_path) == ALL_A_RES
+
+def test_pak_archive_duplicates(tmpdir):
+    pak_path = str(tmpdir.join("dup.pak"))
+    make_pak(pak_path, [("dup", b"second"), ("dup", b"first")],
+             table_order=[1, 0])
+    with expak.PakArchive(pak_path) as pak:
+        # The first table entry wins, whatever the content order.
+        assert pak.read("dup") == b"first"
+        assert pak.names() is pak.names()
+        assert "dup" in pak.names()
+
+def test_offset_order(tmpdir):
+    pak_path = str(tmpdir.join("reversed.pak"))
+    resources = [("res_{0}".format(i), b"x" * (i + 1)) for i in range(10)]
+    make_pak(pak_path, resources, table_order=range(9, -1, -1))
+    order = []
+    def recording_converter(orig_data, name):
+        order.append(name)
+        return len(orig_data) == int(name[4:]) + 1
+    stats = {}
+    targets = set(n for (n, d) in resources)
+    assert expak.process_resources(pak_path, recording_converter, targets,
+                                   stats=stats)
+    assert not targets
+    assert order == [n for (n, d) in resources]
+    assert stats["seek_distance"] == 0
+    # In table order, each read would seek back over two resources.
+    saved = sum(i + (i + 1) for i in range(1, 10))
+    assert stats["seek_distance_saved"] == saved
+    with expak.PakArchive(pak_path) as pak:
+        assert pak.process(recording_converter, stats=stats)
+    assert stats["seek_distance"] == 0
+    assert stats["seek_distance_saved"] == 2 * saved
+
+def test_coalesced_reads(tmpdir, outdir_gen, monkeypatch):
+    pak_path = str(tmpdir.join("small.pak"))
+    resources = [("sound/s_{0}.wav".format(i), os.urandom(i + 1))
+                 for i in range(50)]
+    make_pak(pak_path, resources)
+    contents = dict(resources)
+    def checking_converter(orig_data, name):
+        assert isinstance(orig_data, bytes)
+        return orig_data == contents[name]
+    def count_reads(targets):
+        stats = {}
+        targets = set(targets)
+        assert expak.process_resources(pak_path, checking_converter, targets,
+                                       stats=stats)
+        assert not targets
+        return stats["reads"]
+    assert count_reads(contents) == 1
+    every_other = [n for (n, d) in resources[::2]]
+    assert count_reads(every_other) == 1
+    monkeypatch.setattr(expak, "coalesce_gap", 0)
+    assert count_reads(every_other) == len(every_other)
+    assert count_reads(contents) == 1
+    monkeypatch.setattr(expak, "coalesce_span", 100)
+    assert 1 < count_reads(contents) < len(contents)
+    monkeypatch.setattr(expak, "coalesce_span", 0)
+    assert count_reads(contents) == len(contents)
+
+def test_coalesced_reads_eof(tmpdir):
+    pak_path = str(tmpdir.join("overrun.pak"))
+    with open(pak_path, 'wb') as outstream:
+        outstream.write(expak.PAK_FILE_SIGNATURE)
+        outstream.write(expak.struct.pack('<II', 12 + 20, 2 * expak.TABLE_ENTRY_LEN))
+        outstream.write(b"a" * 10 + b"b" * 10)
+        outstream.write(expak.TABLE_ENTRY.pack(b"ok", 12, 10))
+        outstream.write(expak.TABLE_ENTRY.pack(b"overrun", 22, 500))
+    found = []
+    def recording_converter(orig_data, name):
+        found.append(orig_data)
+        return True
+    targets = set(["ok", "overrun"])
+    assert not expak.process_resources(pak_path, recording_converter, targets)
+    assert targets == set(["overrun"])
+    assert found == [b"a" * 10]
+
+@pytest.mark.parametrize(
+    ("sources",               "resources_in",     "resources_out", "target_fun"),
+   [(PAK_A,                   None,               ALL_A_RES,       None),
+    ([BAD_PAK, PAK_B, PAK_A], None,               ALL_RES,         None),
+    ([PAK_A, PAK_B],          BAD_AND_SOME_RES,   SOME_RES,        None),
+    ([NO_PAK, PAK_A, PAK_B],  BAD_AND_SOME_RES,   SOME_RES,        renamed_targets),
+    ([PAK_A, PAK_B],          BAD_AND_SOME_B_RES, SOME_B_RES,      flat_targets)])
+def test_process_workers(outdir_gen, sources, resources_in, resources_out,
+                         target_fun):
+    expected = expected_error_free(sources)
+    for (func, converter, check_dir) in (
+            (expak.extract_resources, None, FILES_PATH),
+            (expak.process_resources, mangler, MANGLED_FILES_PATH)):
+        if resources_in is None:
+            targets_in = None
+            targets_out = normal_targets(resources_out)
+        elif target_fun:
+            targets_in = target_fun(resources_in)
+            targets_out = target_fun(resources_out)
+        else:
+            targets_in = resources_in.copy()
+            targets_out = normal_targets(resources_out)
+        args = (sources, targets_in) if converter is None else (sources, converter, targets_in)
+        outdir = outdir_gen.next()
+        with temp_workdir(outdir):
+            assert func(*args, workers=4) == expected
+            validate(outdir, check_dir, targets_out)
+        if resources_in is not None:
+            remaining_resources = resources_in.difference(resources_out)
+            assert remaining_resources == set(targets_in)
+
+def test_workers_duplicates(tmpdir):
+    # A resource that appears twice in a pak is only processed a second time
+    # if processing the first copy fails, even when using workers.
+    pak_path = str(tmpdir.join("dup.pak"))
+    resources = [("dup", b"first"), ("other", b"x"), ("dup", b"second")]
+    make_pak(pak_path, resources)
+    for fail_first in (False, True):
+        seen = []
+        def converter(orig_data, name):
+            seen.append(orig_data)
+            return not (fail_first and orig_data == b"first")
+        targets = set(["dup", "other"])
+        assert expak.process_resources(pak_path, converter, targets, workers=3)
+        assert not targets
+        dups = [d for d in seen if d != b"x"]
+        assert dups == ([b"first", b"second"] if fail_first else [b"first"])
+    with temp_workdir(str(tmpdir)):
+        targets = set(["dup", "other"])
+        assert not expak.process_resources(pak_path, bad_converter, targets,
+                                           workers=2)
+        assert targets == set(["dup", "other"])
+
+def test_duplicates_first_entry_wins(tmpdir):
+    # The first table entry of a name wins even when its content comes later
+    # in the pak file.
+    pak_path = str(tmpdir.join("dup.pak"))
+    make_pak(pak_path, [("dup", b"second"), ("other", b"x"), ("dup", b"first")],
+             table_order=[2, 1, 0])
+    for workers in (None, 2):
+        seen = []
+        def converter(orig_data, name):
+            seen.append(bytes(orig_data))
+            return True
+        assert expak.process_resources(pak_path, converter, workers=workers)
+        assert sorted(seen) == [b"first", b"x"]
+    with temp_workdir(str(tmpdir)):
+        assert expak.extract_resources(pak_path)
+        with open("dup", 'rb') as instream:
+            assert instream.read() == b"first"
+        # Worker processes read the content themselves, in streaming mode too.
+        assert expak.process_resources(pak_path, expak.nop_converter,
+                                       stream=True, processes=2)
+        with open("dup", 'rb') as instream:
+            assert instream.read() == b"first"
+
+def view_mangler(orig_data, name):
+    assert isinstance(orig_data, memoryview)
+    return mangler(bytes(orig_data), name)
+
+def failing_mangler(orig_data, name):
+    if name.startswith("subdir_1"):
+        raise IOError
+    return mangler(orig_data, name)
+
+@pytest.mark.parametrize(
+    ("sources",               "resources_in",     "resources_out", "target_fun"),
+   [([BAD_PAK, PAK_B, PAK_A], None,               ALL_RES,         None),
+    ([NO_PAK, PAK_A, PAK_B],  BAD_AND_SOME_RES,   SOME_RES,        renamed_targets)])
+def test_process_processes(outdir_gen, sources, resources_in, resources_out,
+                           target_fun):
+    expected = expected_error_free(sources)
+    for (use_mmap, stream) in ((False, False), (True, False), (False, True)):
+        if resources_in is None:
+            targets_in = None
+            targets_out = normal_targets(resources_out)
+        else:
+            targets_in = target_fun(resources_in)
+            targets_out = target_fun(resources_out)
+        outdir = outdir_gen.next()
+        converter = mangler
+        check_dir = MANGLED_FILES_PATH
+        if stream:
+            (converter, check_dir) = (expak.nop_converter, FILES_PATH)
+        elif use_mmap:
+            converter = view_mangler
+        with temp_workdir(outdir):
+            assert expak.process_resources(sources, converter, targets_in,
+                                           use_mmap=use_mmap, stream=stream,
+                                           processes=2) == expected
+            validate(outdir, check_dir, targets_out)
+        if resources_in is not None:
+            remaining_resources = resources_in.difference(resources_out)
+            assert remaining_resources == set(targets_in)
+
+def test_process_processes_errors(tmpdir):
+    with temp_workdir(str(tmpdir)):
+        targets = ALL_A_RES.copy()
+        assert not expak.process_resources(PAK_A, failing_mangler, targets,
+                                           processes=2)
+        assert targets == set(n for n in ALL_A_RES if n.startswith("subdir_1"))
+        # Unpicklable converters are reported like converter exceptions.
+        targets = ALL_A_RES.copy()
+        assert not expak.process_resources(PAK_A, lambda d, n: True, targets,
+                                           processes=2)
+        assert targets == ALL_A_RES
+
+@pytest.mark.parametrize(
+    ("sources",               "resources_in",     "resources_out", "target_fun"),
+   [([PAK_A, PAK_B],          None,               ALL_RES,         None),
+    ([NO_PAK, PAK_B, PAK_A],  None,               ALL_RES,         None),
+    ([PAK_A, PAK_B],          BAD_AND_SOME_RES,   SOME_RES,        None),
+    ([BAD_PAK, PAK_A, PAK_B], BAD_AND_SOME_RES,   SOME_RES,        renamed_targets),
+    ([NO_PAK, PAK_A, PAK_B],  BAD_AND_SOME_B_RES, SOME_B_RES,      flat_targets)])
+def test_process_concurrent_sources(outdir_gen, sources, resources_in,
+                                    resources_out, target_fun):
+    expected = expected_error_free(sources)
+    if resources_in is None:
+        targets_in = None
+        targets_out = normal_targets(resources_out)
+    elif target_fun:
+        targets_in = target_fun(resources_in)
+        targets_out = target_fun(resources_out)
+    else:
+        targets_in = resources_in.copy()
+        targets_out = normal_targets(resources_out)
+    outdir = outdir_gen.next()
+    with temp_workdir(outdir):
+        assert expak.process_resources(sources, mangler, targets_in,
+                                       concurrency=3, workers=2) == expected
+        validate(outdir, MANGLED_FILES_PATH, targets_out)
+    if resources_in is not None:
+        remaining_resources = resources_in.difference(resources_out)
+        assert remaining_resources == set(targets_in)
+    expected_names = ALL_RES if expected else None
+    assert expak.resource_names(sources, concurrency=3) == expected_names
+
+def test_concurrent_sources_precedence(tmpdir):
+    paks = []
+    for i in range(4):
+        pak_path = str(tmpdir.join("pak{0}.pak".format(i)))
+        make_pak(pak_path, [("shared", str(i).encode()),
+                            ("own_{0}".format(i), b"x")])
+        paks.append(pak_path)
+    for fail_below in (0, 2):
+        calls = []
+        lock = threading.Lock()
+        def converter(orig_data, name):
+            with lock:
+                calls.append((name, orig_data))
+            return name != "shared" or int(orig_data) >= fail_below
+        targets = set(["shared", "own_0", "own_3", "bogus"])
+        assert expak.process_resources(paks, converter, targets, concurrency=4)
+        assert targets == set(["bogus"])
+        shared = [d for (n, d) in calls if n == "shared"]
+        assert shared == [str(i).encode() for i in range(fail_below + 1)]
+        assert len(calls) == len(shared) + 2
+    # Without targets, every copy is processed, in sources order.
+    calls = []
+    assert expak.process_resources(paks, converter, concurrency=2)
+    assert [d for (n, d) in calls if n == "shared"] == [b"0", b"1", b"2", b"3"]
+    assert len(calls) == 8
+
+def test_concurrent_sources_open_bounded(tmpdir, monkeypatch):
+    paks = []
+    for i in range(8):
+        pak_path = str(tmpdir.join("pak{0}.pak".format(i)))
+        make_pak(pak_path, [("shared", b"x"), ("own_{0}".format(i), b"y")])
+        paks.append(pak_path)
+    state = {"open": 0, "peak": 0}
+    lock = threading.Lock()
+    real_init = expak.PakSource.__init__
+    real_close = expak.PakSource.close
+    def counting_init(self, *args, **kwargs):
+        real_init(self, *args, **kwargs)
+        with lock:
+            state["open"] += 1
+            state["peak"] = max(state["peak"], state["open"])
+    def counting_close(self):
+        with lock:
+            state["open"] -= 1
+        real_close(self)
+    monkeypatch.setattr(expak.PakSource, "__init__", counting_init)
+    monkeypatch.setattr(expak.PakSource, "close", counting_close)
+    calls = []
+    def converter(orig_data, name):
+        with lock:
+            calls.append(name)
+        return True
+    assert expak.process_resources(paks, converter, concurrency=3,
+                                   use_mmap=True)
+    assert state["open"] == 0
+    assert 0 < state["peak"] <= 3
+    assert len(calls) == 16
+
+def async_mangler(orig_data, name):
+    # Return a coroutine, as a converter defined with "async def" would.
+    return asyncio.sleep(0, result=mangler(orig_data, name))
+
+@pytest.mark.parametrize("converter", [mangler, async_mangler])
+@pytest.mark.parametrize("workers", [None, 3])
+def test_aprocess_resources(outdir_gen, converter, workers):
+    targets = BAD_AND_SOME_RES.copy()
+    outdir = outdir_gen.next()
+    loop = asyncio.new_event_loop()
+    try:
+        with temp_workdir(outdir):
+            result = expak.aprocess_resources([PAK_A, PAK_B], converter,
+                                              targets, workers=workers,
+                                              loop=loop)
+            assert loop.run_until_complete(result)
+            validate(outdir, MANGLED_FILES_PATH, normal_targets(SOME_RES))
+    finally:
+        loop.close()
+    assert targets == BAD_RES
+
+def collect_async(iterator, loop, limit=None):
+    items = []
+    while limit is None or len(items) < limit:
+        try:
+            items.append(loop.run_until_complete(iterator.__anext__()))
+        except StopAsyncIteration:
+            break
+    return items
+
+@pytest.mark.parametrize("prefetch", [1, 3])
+def test_aiter_resources(prefetch):
+    loop = asyncio.new_event_loop()
+    try:
+        targets = dict((r, r.upper()) for r in BAD_AND_SOME_RES)
+        iterator = expak.aiter_resources([PAK_A, PAK_B], targets,
+                                         prefetch=prefetch, loop=loop)
+        items = collect_async(iterator, loop)
+        assert set(n for (n, d) in items) == set(r.upper() for r in SOME_RES)
+        for (name, data) in items:
+            with open(os.path.join(FILES_PATH, *name.lower().split("/")),
+                      'rb') as instream:
+                assert data == instream.read()
+        assert set(targets) == BAD_RES
+        # Abandon iteration after one resource.
+        targets = ALL_RES.copy()
+        iterator = expak.aiter_resources([PAK_A, PAK_B], targets,
+                                         prefetch=prefetch, loop=loop)
+        items = collect_async(iterator, loop, limit=1)
+        assert loop.run_until_complete(iterator.aclose())
+        assert collect_async(iterator, loop) == []
+        assert targets == ALL_RES.difference([items[0][0]])
+    finally:
+        loop.close()
+
+def run_until(loop, condition):
+    for _ in range(500):
+        if condition():
+            return True
+        loop.run_until_complete(asyncio.sleep(0.01))
+    return condition()
+
+def test_aiter_resources_abandoned(monkeypatch):
+    monkeypatch.setattr(expak, "HANDOFF_POLL_INTERVAL", 0.01)
+    loop = asyncio.new_event_loop()
+    try:
+        targets = ALL_RES.copy()
+        iterator = expak.aiter_resources([PAK_A, PAK_B], targets, loop=loop)
+        items = collect_async(iterator, loop, limit=1)
+        done = iterator.done
+        # Drop the iterator without calling aclose; the worker thread must
+        # not wait for it forever, and no further resources are read.
+        del iterator
+        gc.collect()
+        assert run_until(loop, lambda: targets != ALL_RES)
+        assert done.cancelled()
+        assert targets == ALL_RES.difference([items[0][0]])
+    finally:
+        loop.close()
+
+def test_aprocess_resources_cancel():
+    loop = asyncio.new_event_loop()
+    try:
+        calls = []
+        started = threading.Event()
+        cancelled = threading.Event()
+        def converter(orig_data, name):
+            calls.append(name)
+            started.set()
+            assert cancelled.wait(5)
+            return True
+        targets = ALL_RES.copy()
+        result = expak.aprocess_resources([PAK_A, PAK_B], converter, targets,
+                                          loop=loop)
+        result.add_done_callback(lambda f: cancelled.set())
+        # Cancel from the event loop once the first converter call is in
+        # progress.
+        assert run_until(loop, started.is_set)
+        result.cancel()
+        assert run_until(loop, lambda: targets != ALL_RES)
+        assert result.cancelled()
+        assert len(calls) == 1
+        assert targets == ALL_RES.difference(calls)
+    finally:
+        loop.close()